@@ -0,0 +1,99 @@
+import os
+import contextlib
+import tempfile
+import queue as queue_module
+import torch
+import torch.multiprocessing as mp
+from Other.profiling import peak_rss
+
+# Helpers shared by the benchmarks: list arguments, peak memory, device
+# synchronization, and running measurements in fresh processes.
+
+project_folder_path = os.path.dirname(os.path.abspath(__file__))
+project_folder_path = os.path.join(project_folder_path, "..", "..")
+data_folder = os.path.join(project_folder_path, "Data")
+output_folder = os.path.join(project_folder_path, "Output")
+save_folder = os.path.join(project_folder_path, "SavedModels")
+
+def parse_list(text, type=int):
+    return [type(t.strip()) for t in text.split(',')]
+
+def peak_memory_start(device):
+    if("cuda" in str(device)):
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    return peak_rss()
+
+def peak_memory_end(device, start):
+    # Peak memory (GB) used since peak_memory_start. On CPU this is the
+    # growth of the peak resident set size, so each measurement should
+    # run in a fresh process (see run_isolated).
+    if("cuda" in str(device)):
+        torch.cuda.synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - start) / (1024**3)
+    return (peak_rss() - start) / (1024**3)
+
+def synchronize(device):
+    if("cuda" in str(device)):
+        torch.cuda.synchronize(device)
+
+def _isolated_worker(queue, func, kwargs):
+    try:
+        queue.put(func(**kwargs))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+def run_isolated(func, **kwargs):
+    # Runs func in a fresh process so that peak memory measurements
+    # are not polluted by earlier configurations
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_isolated_worker, args=(queue, func, kwargs))
+    p.start()
+    while(True):
+        try:
+            result = queue.get(timeout=1)
+            break
+        except queue_module.Empty:
+            # The process can be killed without reporting, ex. out of memory
+            if(not p.is_alive()):
+                result = {"error": f"process exited with code {p.exitcode}"}
+                break
+    p.join()
+    return result
+
+def run_concurrent(func, n_processes, **kwargs):
+    # Runs func in n_processes fresh processes at the same time
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    processes = [ctx.Process(target=_isolated_worker, args=(queue, func, kwargs))
+        for _ in range(n_processes)]
+    for p in processes:
+        p.start()
+    results = [queue.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return results
+
+def proportional_memory():
+    # Proportional set size (GB) of this process, pages shared with other
+    # processes are split between them. Falls back to the peak RSS.
+    if(os.path.exists("/proc/self/smaps_rollup")):
+        with open("/proc/self/smaps_rollup", 'r') as f:
+            for line in f:
+                if(line.startswith("Pss:")):
+                    return int(line.split()[1]) / (1024**2)
+    return peak_rss() / (1024**3)
+
+@contextlib.contextmanager
+def scratch_run(opt):
+    # Points a train() run at a temporary folder that is removed afterwards,
+    # so benchmarks do not overwrite saved models or earlier results. An
+    # absolute save_name replaces SavedModels/ in every path train() writes
+    # (the model, profile.json and the tensorboard run), and periodic
+    # checkpoints are turned off.
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as folder:
+        opt['save_name'] = os.path.join(folder, "run")
+        opt['save_every'] = 0
+        yield opt['save_name']
@@ -0,0 +1,242 @@
+import os
+import time
+import itertools
+import numpy as np
+import torch
+from Datasets.samplers import create_sampler, gather_points
+from Datasets.volume_storage import open_volume, raw_cache_location, sidecar_location, \
+    remove_shared_volumes
+from Other.utility_functions import PSNR, CoordGrid, nc_to_tensor, \
+    curl, slab_derived_field, ssim3D
+from Other.metrics import volume_metrics
+from Benchmarks.common import parse_list, peak_memory_start, peak_memory_end, \
+    synchronize, run_isolated, run_concurrent, proportional_memory, data_folder
+
+# Data handling: loading, shared memory volumes, batch sampling, derived
+# fields and volume metrics, each against the implementation it replaced.
+
+def time_loading_method(method, location):
+    mem_start = peak_memory_start("cpu")
+    t0 = time.time()
+    if(method == "nc_to_tensor"):
+        d = nc_to_tensor(location)
+    elif(method == "reader"):
+        d = open_volume(location).read_all()
+    elif(method == "raw_cache"):
+        d = open_volume(location, use_cache=True).read_all()
+    t = time.time() - t0
+    return {
+        "seconds": t,
+        "peak_memory_GB": peak_memory_end("cpu", mem_start),
+        "volume_GB": d.numel() * d.element_size() / (1024**3)
+    }
+
+def benchmark_loading(args):
+    # Load time and peak memory of the legacy nc_to_tensor, the chunked
+    # reader, and the raw memory-mapped cache (created on the first
+    # open, reused on the second)
+    for data in parse_list(args['data'], str):
+        location = os.path.join(data_folder, data)
+        for f in [raw_cache_location(location), 
+            sidecar_location(raw_cache_location(location))]:
+            if(os.path.exists(f)):
+                os.remove(f)
+        for method, label in [("nc_to_tensor", "nc_to_tensor"), ("reader", "reader"),
+            ("raw_cache", "raw cache (create)"), ("raw_cache", "raw cache (open)")]:
+            r = run_isolated(time_loading_method, method=method, location=location)
+            if("error" in r):
+                print(f"{data} {label}: {r['error']}")
+                continue
+            print(f"{data} {label : >18}: {r['seconds'] : 0.03f} seconds, " + \
+                f"{r['peak_memory_GB'] : 0.03f} GB peak for a " + \
+                f"{r['volume_GB'] : 0.03f} GB volume")
+
+def time_shared_job(location, shared_memory, token):
+    t0 = time.time()
+    d = open_volume(location, shared_memory=shared_memory,
+        shared_memory_token=token).read_all()
+    d.sum()
+    return {
+        "seconds": time.time() - t0,
+        "memory_GB": proportional_memory()
+    }
+
+def benchmark_shared(args):
+    # Startup time and memory per job for n_jobs concurrent jobs loading
+    # the same data, with private copies and with the shared segment
+    token = f"benchmark{os.getpid()}"
+    for data in parse_list(args['data'], str):
+        location = os.path.join(data_folder, data)
+        for shared in [False, True]:
+            results = run_concurrent(time_shared_job, args['n_jobs'],
+                location=location, shared_memory=shared, token=token)
+            errors = [r['error'] for r in results if "error" in r]
+            if(len(errors) > 0):
+                print(f"{data}: {errors[0]}")
+                continue
+            seconds = [r['seconds'] for r in results]
+            memory = [r['memory_GB'] for r in results]
+            label = "shared" if shared else "private"
+            print(f"{data} {label : >7} x{args['n_jobs']}: startup " + \
+                f"{np.mean(seconds) : 0.03f} s mean, {np.max(seconds) : 0.03f} s max, " + \
+                f"{np.mean(memory) : 0.03f} GB proportional memory per job")
+        remove_shared_volumes(token)
+
+def legacy_sample(data, index_grid, n_points):
+    # The original get_random_points: a randperm over every voxel and a
+    # nearest neighbor grid_sample at the chosen coordinates
+    samples = torch.randperm(len(index_grid), device=data.device)[:n_points]
+    x = index_grid[samples].unsqueeze(0)
+    for _ in range(len(data.shape[2:])-1):
+        x = x.unsqueeze(-2)
+    y = torch.nn.functional.grid_sample(data, x, mode='nearest',
+        align_corners=index_grid.align_corners)
+    return x.squeeze(), y.flatten(2)[0].T
+
+def time_sampling_method(method, resolution, n_dims, n_channels, n_points,
+    device, repeats=5):
+    # Per iteration cost of drawing a batch from a [resolution]^n_dims
+    # volume. The volume is left uninitialized since only the access
+    # pattern matters.
+    shape = [resolution]*n_dims
+    data = torch.empty([1, n_channels] + shape, device=device)
+    mem_start = peak_memory_start(device)
+    index_grid = CoordGrid(shape, device, align_corners=True)
+    if(method == "legacy"):
+        step = lambda: legacy_sample(data, index_grid, n_points)
+    else:
+        sampler = create_sampler({"sampler": method, "data_device": device,
+            "importance_brick_size": 8, "importance_uniform_fraction": 0.2,
+            "importance_decay": 0.1}, shape)
+        step = lambda: gather_points(data, index_grid, sampler.sample(n_points)[0])
+    step()
+    synchronize(device)
+    t0 = time.time()
+    for _ in range(repeats):
+        step()
+    synchronize(device)
+    t = (time.time() - t0) / repeats
+    return {
+        "seconds_per_batch": t,
+        "peak_memory_GB": peak_memory_end(device, mem_start)
+    }
+
+def benchmark_sampling(args):
+    n_dims = max(parse_list(args['n_dims']))
+    for resolution, n_points in itertools.product(
+        parse_list(args['volume_sizes']), 
+        parse_list(args['points_per_iteration'])):
+        for method in parse_list(args['methods'], str):
+            r = run_isolated(time_sampling_method, method=method,
+                resolution=resolution, n_dims=n_dims, 
+                n_channels=args['n_channels'], n_points=n_points, 
+                device=args['device'], repeats=args['repeats'])
+            if("error" in r):
+                print(f"{method} {resolution}^{n_dims} N={n_points}: {r['error']}")
+                continue
+            print(f"{method : >8} {resolution}^{n_dims} N={n_points : <8} " + \
+                f"{r['seconds_per_batch']*1000 : 10.3f} ms/batch " + \
+                f"{r['peak_memory_GB'] : 0.3f} GB peak")
+
+def legacy_curl(data):
+    # The original curl: six conv3d calls, one per (channel, dimension),
+    # each on a separately padded copy of the channel
+    def gradient(channel, dimension):
+        padded = torch.nn.functional.pad(data[:,channel:channel+1],
+            [1, 1, 1, 1, 1, 1], mode="replicate")
+        weights = torch.zeros([1, 1, 3, 3, 3], device=data.device)
+        lo = [0, 0, 1, 1, 1]
+        hi = [0, 0, 1, 1, 1]
+        lo[4-dimension] = 0
+        hi[4-dimension] = 2
+        weights[tuple(lo)] = -0.5
+        weights[tuple(hi)] = 0.5
+        return torch.nn.functional.conv3d(padded, weights)
+    return torch.cat([gradient(2, 1) - gradient(1, 2),
+        gradient(0, 2) - gradient(2, 0),
+        gradient(1, 0) - gradient(0, 1)], dim=1)
+
+def time_derivative_method(method, resolution, device, slab_size=16, repeats=3):
+    # Time and peak memory to compute the curl of a [resolution]^3 field
+    data = torch.randn([1, 3] + [resolution]*3, device=device)
+    mem_start = peak_memory_start(device)
+    if(method == "legacy"):
+        step = lambda: legacy_curl(data)
+    elif(method == "grouped"):
+        step = lambda: curl(data)
+    else:
+        def step():
+            out = torch.empty_like(data)
+            for start, end, values in slab_derived_field(
+                lambda s, e: data[:, :, s:e], resolution, curl, slab_size):
+                out[:, :, start:end] = values
+            return out
+    with torch.no_grad():
+        step()
+        synchronize(device)
+        t0 = time.time()
+        for _ in range(repeats):
+            step()
+        synchronize(device)
+    return {
+        "seconds": (time.time() - t0) / repeats,
+        "peak_memory_GB": peak_memory_end(device, mem_start)
+    }
+
+def benchmark_derivatives(args):
+    for resolution in parse_list(args['volume_sizes']):
+        for method in parse_list(args['methods'], str):
+            r = run_isolated(time_derivative_method, method=method,
+                resolution=resolution, device=args['device'], 
+                repeats=args['repeats'])
+            if("error" in r):
+                print(f"{method} {resolution}^3: {r['error']}")
+                continue
+            print(f"{method : >8} curl {resolution}^3 {r['seconds'] : 8.3f} seconds " + \
+                f"{r['peak_memory_GB'] : 0.3f} GB peak")
+
+def metric_test_slab(grid, start, end, noise):
+    # Smooth 3 channel field on the rows [start, end) of grid, with an
+    # optional high frequency error standing in for a reconstruction
+    x = grid.slab(start, end)
+    v = torch.sin(3*x) + noise * torch.sin(40*x.flip(-1))
+    return v.T.reshape([1, 3, end-start] + list(grid.grid_shape[1:]))
+
+def time_metrics_method(method, resolution, device, slab_size=16):
+    # Time and peak memory of PSNR + SSIM between two [resolution]^3 fields.
+    # legacy materializes both and uses PSNR and ssim3D, tiled streams them.
+    grid = CoordGrid([resolution]*3, device, align_corners=True)
+    mem_start = peak_memory_start(device)
+    t0 = time.time()
+    with torch.no_grad():
+        if(method == "legacy"):
+            gt = metric_test_slab(grid, 0, resolution, 0.0)
+            rec = metric_test_slab(grid, 0, resolution, 0.05)
+            psnr = PSNR(rec, gt, gt.max() - gt.min()).item()
+            ssim = ssim3D(rec, gt).item()
+        else:
+            m = volume_metrics(
+                lambda s, e: metric_test_slab(grid, s, e, 0.05),
+                lambda s, e: metric_test_slab(grid, s, e, 0.0),
+                resolution, slab_size, device=device)
+            psnr = m['psnr']
+            ssim = m['ssim']
+        synchronize(device)
+    return {
+        "seconds": time.time() - t0,
+        "peak_memory_GB": peak_memory_end(device, mem_start),
+        "psnr": psnr,
+        "ssim": ssim
+    }
+
+def benchmark_metrics(args):
+    for resolution in parse_list(args['volume_sizes']):
+        for method in parse_list(args['methods'], str):
+            r = run_isolated(time_metrics_method, method=method,
+                resolution=resolution, device=args['device'])
+            if("error" in r):
+                print(f"{method} {resolution}^3: {r['error']}")
+                continue
+            print(f"{method : >8} {resolution}^3 {r['seconds'] : 8.3f} seconds " + \
+                f"{r['peak_memory_GB'] : 0.3f} GB peak, PSNR {r['psnr'] : 0.04f} dB, " + \
+                f"SSIM {r['ssim'] : 0.06f}")
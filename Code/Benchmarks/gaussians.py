@@ -0,0 +1,140 @@
+import time
+import itertools
+import numpy as np
+import torch
+from Models import gaussians
+from Benchmarks.common import parse_list, peak_memory_start, peak_memory_end, \
+    synchronize, run_isolated
+
+# Evaluation of the gaussian mixture: every method against the original
+# repeat-based implementation, and throughput and peak memory per method.
+
+def random_gaussians(n_gaussians, n_dims, n_features, device):
+    # Same construction as GMMINR.__init__
+    centers = torch.rand([n_gaussians, n_dims], device=device) * 2 - 1
+    S = torch.eye(n_dims, device=device).unsqueeze(0).repeat(n_gaussians, 1, 1)
+    S *= 1/n_gaussians
+    v = torch.rand([n_gaussians, n_dims, 1], device=device)
+    v /= torch.linalg.norm(v, dim=1, keepdim=True)
+    Q = torch.eye(n_dims, device=device).unsqueeze(0).repeat(n_gaussians, 1, 1) - \
+        2*torch.bmm(v, v.mT)
+    precision = torch.linalg.inv(torch.bmm(torch.bmm(Q, S), Q.mT))
+    features = torch.randn([n_gaussians, n_features], device=device)
+    return centers, precision, features
+
+def reference_gaussian_features(x, centers, precision, features):
+    # The original repeat-based evaluation from GMMINR.forward
+    gauss_dist = x.unsqueeze(1).repeat(1, centers.shape[0], 1)
+    coeff = 1 / (((2* np.pi)**(centers.shape[1]/2)) * \
+        (torch.linalg.det(torch.linalg.inv(precision))**(1/2)))
+    exp_part = torch.exp((-1/2) * \
+        ((gauss_dist-centers.unsqueeze(0)).unsqueeze(-1).mT\
+            .matmul(precision.unsqueeze(0)))\
+                .matmul((gauss_dist-centers.unsqueeze(0)).unsqueeze(-1))).squeeze(-1).squeeze(-1)
+    result = coeff.unsqueeze(0) * exp_part
+    return torch.matmul(result, features)
+
+def culled_gaussian_features(x, centers, precision, features, n_sigma=3.0):
+    # Includes building the grid, which happens after every optimizer step
+    grid = gaussians.GaussianGrid(n_sigma=n_sigma)
+    return gaussians.culled_gaussian_features(x, centers, precision,
+        features, grid)
+
+def tiled_gaussian_features(x, centers, precision, features):
+    return gaussians.tiled_gaussian_features(x, centers, precision,
+        features, 4096)
+
+gaussian_methods = {
+    "reference": reference_gaussian_features,
+    "fused": gaussians.gaussian_features,
+    "culled": culled_gaussian_features,
+    "tiled": tiled_gaussian_features
+}
+
+def gaussian_method(name, culling_sigma=3.0):
+    if(name == "culled"):
+        return lambda x, centers, precision, features: culled_gaussian_features(
+            x, centers, precision, features, culling_sigma)
+    return gaussian_methods[name]
+
+def check_gaussian_methods(device, n_gaussians=64, n_dims=3, n_features=8,
+    n_points=10000, culling_sigma=3.0):
+    # Checks outputs and gradients of every method against the reference
+    centers, precision, features = random_gaussians(n_gaussians, n_dims,
+        n_features, device)
+    x = torch.rand([n_points, n_dims], device=device) * 2 - 1
+    results = {}
+    for name in gaussian_methods.keys():
+        method = gaussian_method(name, culling_sigma)
+        params = [t.clone().double().requires_grad_(True) for t in
+            [x, centers, precision, features]]
+        out = method(*params)
+        out.backward(torch.ones_like(out))
+        results[name] = [out.detach()] + [t.grad for t in params]
+    names = ["output", "x grad", "centers grad", "precision grad", "features grad"]
+    print("Max relative error against the reference implementation")
+    for name in gaussian_methods.keys():
+        if(name == "reference"):
+            continue
+        errors = []
+        for i in range(len(names)):
+            ref = results["reference"][i]
+            err = ((results[name][i] - ref).abs().max() /
+                (ref.abs().max() + 1e-12)).item()
+            errors.append(f"{names[i]}: {err : 0.2e}")
+        print(f"{name : >10} " + ", ".join(errors))
+    print(f"Culling at {culling_sigma} sigma skips gaussians below " + \
+        f"{gaussians.culling_error_bound(culling_sigma) : 0.2e} of their peak density")
+
+def time_gaussian_method(method, n_gaussians, n_dims, n_features, n_points,
+    device, repeats=5, backward=True, culling_sigma=3.0):
+    torch.manual_seed(0)
+    centers, precision, features = random_gaussians(n_gaussians, n_dims,
+        n_features, device)
+    centers.requires_grad_(backward)
+    precision.requires_grad_(backward)
+    features.requires_grad_(backward)
+    x = torch.rand([n_points, n_dims], device=device) * 2 - 1
+
+    def step():
+        out = gaussian_method(method, culling_sigma)(x, centers, precision, features)
+        if(backward):
+            out.sum().backward()
+        return out
+
+    mem_start = peak_memory_start(device)
+    step()
+    synchronize(device)
+    t0 = time.time()
+    for _ in range(repeats):
+        step()
+    synchronize(device)
+    t = (time.time() - t0) / repeats
+    peak_memory = peak_memory_end(device, mem_start)
+    return {
+        "method": method,
+        "n_gaussians": n_gaussians,
+        "n_dims": n_dims,
+        "n_features": n_features,
+        "n_points": n_points,
+        "points_per_sec": n_points / t,
+        "peak_memory_GB": peak_memory
+    }
+
+def benchmark_gaussians(args):
+    check_gaussian_methods(args['device'], culling_sigma=args['culling_sigma'])
+    for n_gaussians, n_dims, n_points in itertools.product(
+        parse_list(args['n_gaussians']), parse_list(args['n_dims']),
+        parse_list(args['points_per_iteration'])):
+        for method in parse_list(args['methods'], str):
+            r = run_isolated(time_gaussian_method, method=method,
+                n_gaussians=n_gaussians, n_dims=n_dims,
+                n_features=parse_list(args['n_features'])[0], n_points=n_points,
+                device=args['device'], repeats=args['repeats'],
+                backward=args['backward'], culling_sigma=args['culling_sigma'])
+            if("error" in r):
+                print(f"{method} G={n_gaussians} D={n_dims} N={n_points}: {r['error']}")
+                continue
+            print(f"{method : >10} G={n_gaussians : <6} D={n_dims} N={n_points : <8} " + \
+                f"{r['points_per_sec'] : 12.1f} points/sec " + \
+                f"{r['peak_memory_GB'] : 0.3f} GB peak")
@@ -0,0 +1,221 @@
+import os
+import time
+import json
+import datetime
+import platform
+import subprocess
+import torch
+from Models.options import Options
+from Models.models import create_model
+from Datasets.datasets import create_dataset
+from Datasets.procedural import write_field, evaluate_field
+from Other.utility_functions import CoordGrid, GridWriter
+from Benchmarks.common import parse_list, peak_memory_start, peak_memory_end, \
+    synchronize, run_isolated, scratch_run, data_folder, output_folder
+from Benchmarks.training import reconstruction_psnr, inference_throughput
+
+# The suite trains and evaluates GMMINR on synthetic data over sweeps of
+# the model and machine configuration, and writes every result to a json
+# file that can be compared against the results of another commit.
+# Each sweep varies one parameter around the base configuration (the
+# first value of every list), and every configuration runs in a fresh
+# process.
+suite_parameters = ["n_gaussians", "n_features", "n_layers", 
+    "nodes_per_layer", "n_dims", "threads"]
+
+# Metric name, whether higher is better
+suite_metrics = [
+    ("train_points_per_sec", True),
+    ("inference_points_per_sec", True),
+    ("peak_memory_GB", False),
+    ("seconds_to_psnr", False)
+]
+
+def suite_data(n_dims, resolution):
+    # ABC flow at resolution^n_dims from the synthetic generators, written
+    # to the data folder once. 2D data is the z=0 slice.
+    name = f"benchmark_ABC_flow_{n_dims}d_{resolution}.nc"
+    location = os.path.join(data_folder, name)
+    if(os.path.exists(location)):
+        return name
+    if(n_dims == 3):
+        write_field("ABC_flow", resolution, location)
+        return name
+    x = CoordGrid([resolution]*2, "cpu", align_corners=True)[:]
+    x = torch.cat([x, torch.zeros_like(x[:, :1])], dim=1)
+    v = evaluate_field("ABC_flow", x)
+    v = v / v.norm(dim=1).max()
+    with GridWriter(location, [resolution]*2, 3, ['u', 'v', 'w']) as writer:
+        writer.write(0, resolution, v.T.reshape([3, resolution, resolution]))
+    return name
+
+def suite_configurations(args):
+    base = {p: parse_list(args[p])[0] for p in suite_parameters}
+    configurations = [dict(base)]
+    for p in suite_parameters:
+        for value in parse_list(args[p])[1:]:
+            c = dict(base)
+            c[p] = value
+            configurations.append(c)
+    return configurations
+
+def configuration_name(config):
+    return ",".join(f"{p}={config[p]}" for p in suite_parameters)
+
+def run_suite_configuration(config, data, device, iterations, 
+    points_per_iteration, target_psnr, eval_every):
+    # Training throughput (after warmup), time to target_psnr, inference
+    # throughput and peak memory of one configuration
+    from train import train
+    torch.set_num_threads(config['threads'])
+    opt = Options.get_default()
+    opt['data'] = data
+    opt['device'] = device
+    opt['data_device'] = device
+    opt['iterations'] = iterations
+    opt['points_per_iteration'] = points_per_iteration
+    for p in suite_parameters[:-1]:
+        opt[p] = config[p]
+    opt['log_image'] = False
+    opt['profile'] = True
+    dataset = create_dataset(opt)
+    # train() logs the data statistics, computed here so their first pass
+    # is not timed
+    dataset.statistics()
+    opt['n_outputs'] = dataset.data.shape[1]
+
+    mem_start = peak_memory_start(device)
+    torch.manual_seed(0)
+    t0 = time.time()
+    model = create_model(opt)
+    warmup = min(5, iterations // 10)
+    state = {"t_warm": None, "eval_time": 0.0, "iterations": 0,
+        "seconds_to_psnr": None, "iterations_to_psnr": None}
+
+    def callback(iteration, model, losses):
+        if(iteration == warmup):
+            synchronize(device)
+            state['t_warm'] = time.time()
+            state['eval_time'] = 0.0
+        state['iterations'] = iteration + 1
+        if(state['seconds_to_psnr'] is None and (iteration+1) % eval_every == 0):
+            t_eval = time.time()
+            psnr = reconstruction_psnr(model, dataset)
+            state['eval_time'] += time.time() - t_eval
+            if(psnr >= target_psnr):
+                state['seconds_to_psnr'] = time.time() - t0 - state['eval_time']
+                state['iterations_to_psnr'] = iteration + 1
+        return False
+
+    with scratch_run(opt) as run_folder:
+        train(opt['device'], model, dataset, opt, callback)
+        synchronize(device)
+        train_seconds = time.time() - state['t_warm'] - state['eval_time']
+        with open(os.path.join(run_folder, "profile.json"), 'r') as fp:
+            profile = json.load(fp)
+    model.eval()
+    return {
+        "train_points_per_sec": points_per_iteration * 
+            (state['iterations'] - warmup) / train_seconds,
+        "inference_points_per_sec": inference_throughput(model, opt['n_dims'],
+            device, n_points=200000),
+        "peak_memory_GB": peak_memory_end(device, mem_start),
+        "seconds_to_psnr": state['seconds_to_psnr'],
+        "iterations_to_psnr": state['iterations_to_psnr'],
+        "final_psnr": reconstruction_psnr(model, dataset),
+        "phase_mean_ms": {k: v['mean_ms'] for k, v in profile['phases'].items()}
+    }
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), 
+            stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "-uno"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip() != ""
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def benchmark_suite(args):
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "host": platform.node(),
+        "torch": torch.__version__,
+        "device": args['device'],
+        "settings": {k: args[k] for k in ["iterations", "target_psnr", 
+            "eval_every", "suite_resolution"]},
+        "results": []
+    }
+    points = parse_list(args['points_per_iteration'])[0]
+    for config in suite_configurations(args):
+        data = suite_data(config['n_dims'], args['suite_resolution'])
+        r = run_isolated(run_suite_configuration, config=config, data=data,
+            device=args['device'], iterations=args['iterations'],
+            points_per_iteration=points, target_psnr=args['target_psnr'],
+            eval_every=args['eval_every'])
+        results['results'].append({"name": configuration_name(config),
+            "config": config, "metrics": r})
+        if("error" in r):
+            print(f"{configuration_name(config)}: {r['error']}")
+            continue
+        to_psnr = f"{r['seconds_to_psnr'] : 0.02f} s" \
+            if r['seconds_to_psnr'] is not None else "not reached"
+        print(f"{configuration_name(config)}: " + \
+            f"train {r['train_points_per_sec'] : 0.1f} points/sec, " + \
+            f"inference {r['inference_points_per_sec'] : 0.1f} points/sec, " + \
+            f"{r['peak_memory_GB'] : 0.3f} GB peak, " + \
+            f"{args['target_psnr']} dB: {to_psnr}, final {r['final_psnr'] : 0.02f} dB")
+
+    location = args['results']
+    if(location is None):
+        location = os.path.join(output_folder, "benchmarks", 
+            f"suite_{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(location)), exist_ok=True)
+    with open(location, 'w') as fp:
+        json.dump(results, fp, indent=4)
+    print(f"Saved results to {location}")
+    if(args['baseline'] is not None):
+        return compare_results(args['baseline'], location, 
+            args['regression_threshold'])
+    return True
+
+def compare_results(baseline_location, results_location, threshold):
+    # Compares every configuration present in both files. A metric
+    # regresses when it is worse than the baseline by more than threshold
+    # (relative), or when the target PSNR is no longer reached.
+    with open(baseline_location, 'r') as fp:
+        baseline = json.load(fp)
+    with open(results_location, 'r') as fp:
+        results = json.load(fp)
+    print(f"Comparing {results['commit']} to baseline {baseline['commit']}")
+    base = {r['name']: r['metrics'] for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        if(r['name'] not in base or "error" in r['metrics'] or 
+           "error" in base[r['name']]):
+            continue
+        for metric, higher_is_better in suite_metrics:
+            old = base[r['name']][metric]
+            new = r['metrics'][metric]
+            if(old is None):
+                continue
+            if(new is None):
+                regressions.append(f"{r['name']} {metric}: reached before, not now")
+                continue
+            change = (new - old) / max(abs(old), 1e-12)
+            worse = -change if higher_is_better else change
+            marker = "REGRESSION" if worse > threshold else ""
+            print(f"{r['name']} {metric : >25} {old : 14.4g} -> {new : 14.4g} " + \
+                f"({100 * change :+7.1f}%) {marker}")
+            if(worse > threshold):
+                regressions.append(f"{r['name']} {metric}: {100 * change :+0.1f}%")
+    if(len(regressions) > 0):
+        print(f"{len(regressions)} regressions beyond {100 * threshold : 0.0f}%:")
+        for line in regressions:
+            print("  " + line)
+        return False
+    print(f"No regressions beyond {100 * threshold : 0.0f}%")
+    return True
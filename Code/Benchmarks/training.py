@@ -0,0 +1,205 @@
+import os
+import time
+import itertools
+import numpy as np
+import torch
+from Models.options import Options, load_options
+from Models.models import create_model, load_model, sample_grid, forward_maxpoints, \
+    reconstruction_metrics
+from Models.initialization import initialize_from_data
+from Datasets.datasets import create_dataset
+from Other.utility_functions import PSNR
+from Benchmarks.common import parse_list, synchronize, run_isolated, \
+    scratch_run, save_folder
+
+# Training: time to a target PSNR with different initializations and
+# samplers, the optimizer parameter layouts, and baked inference.
+
+def reconstruction_psnr(model, dataset):
+    return reconstruction_metrics(model, dataset, compute_ssim=False)['psnr']
+
+def dataset_options(args, data, sampler="uniform"):
+    opt = Options.get_default()
+    opt['sampler'] = sampler
+    opt['data'] = data
+    opt['device'] = args['device']
+    opt['data_device'] = args['device']
+    opt['iterations'] = args['iterations']
+    opt['points_per_iteration'] = parse_list(args['points_per_iteration'])[0]
+    opt['n_gaussians'] = parse_list(args['n_gaussians'])[0]
+    opt['n_features'] = parse_list(args['n_features'])[0]
+    opt['log_image'] = False
+    dataset = create_dataset(opt)
+    # train() logs the data statistics, computed here so their first pass
+    # is not timed
+    dataset.statistics()
+    opt['n_dims'] = len(dataset.data.shape) - 2
+    opt['n_outputs'] = dataset.data.shape[1]
+    return opt, dataset
+
+def time_to_psnr(opt, dataset, target_psnr, eval_every, setup=None):
+    # Trains with train.train until the reconstruction reaches target_psnr.
+    # Wall clock time includes model setup but not the PSNR evaluations.
+    from train import train
+    torch.manual_seed(0)
+    t0 = time.time()
+    model = create_model(opt)
+    if(setup is not None):
+        setup(model, dataset, opt)
+    result = {"iterations": None, "seconds": None, "psnr": None}
+    eval_time = [0.0]
+
+    def callback(iteration, model, losses):
+        if((iteration+1) % eval_every != 0):
+            return False
+        t_eval = time.time()
+        psnr = reconstruction_psnr(model, dataset)
+        eval_time[0] += time.time() - t_eval
+        result['psnr'] = psnr
+        if(psnr >= target_psnr):
+            result['iterations'] = iteration+1
+            result['seconds'] = time.time() - t0 - eval_time[0]
+            return True
+        return False
+
+    with scratch_run(opt):
+        train(opt['device'], model, dataset, opt, callback)
+    return result
+
+def benchmark_initialization(args):
+    for data in parse_list(args['data'], str):
+        opt, dataset = dataset_options(args, data)
+        for init in ["random", "data"]:
+            opt['gaussian_initialization'] = init
+            setup = initialize_from_data if init == "data" else None
+            r = time_to_psnr(dict(opt), dataset, args['target_psnr'],
+                args['eval_every'], setup)
+            if(r['iterations'] is None):
+                print(f"{data} {init : >6} init: did not reach {args['target_psnr']} dB " + \
+                    f"in {opt['iterations']} iterations (final {r['psnr'] : 0.02f} dB)")
+            else:
+                print(f"{data} {init : >6} init: {args['target_psnr']} dB after " + \
+                    f"{r['iterations']} iterations, {r['seconds'] : 0.02f} seconds")
+
+def benchmark_importance(args):
+    # Iterations to the target PSNR with uniform and importance sampling
+    for data in parse_list(args['data'], str):
+        for sampler in ["uniform", "importance"]:
+            opt, dataset = dataset_options(args, data, sampler=sampler)
+            r = time_to_psnr(opt, dataset, args['target_psnr'], args['eval_every'])
+            if(r['iterations'] is None):
+                print(f"{data} {sampler : >10} sampling: did not reach {args['target_psnr']} dB " + \
+                    f"in {opt['iterations']} iterations (final {r['psnr'] : 0.02f} dB)")
+            else:
+                print(f"{data} {sampler : >10} sampling: {args['target_psnr']} dB after " + \
+                    f"{r['iterations']} iterations, {r['seconds'] : 0.02f} seconds")
+
+def trained_model(args, opt, dataset):
+    # Loads --load_from if given, otherwise trains a model for --iterations
+    if(args['load_from'] is not None):
+        opt = load_options(os.path.join(save_folder, args['load_from']))
+        opt['device'] = args['device']
+        opt['data_device'] = args['device']
+        opt['save_name'] = args['load_from']
+        return load_model(opt, args['device']), opt
+    from train import train
+    torch.manual_seed(0)
+    model = create_model(opt)
+    with scratch_run(opt):
+        train(opt['device'], model, dataset, opt)
+    return model, opt
+
+@torch.no_grad()
+def inference_throughput(model, n_dims, device, n_points=1000000, repeats=3):
+    x = torch.rand([n_points, n_dims], device=device) * 2 - 1
+    forward_maxpoints(model, x[:1000])
+    synchronize(device)
+    t0 = time.time()
+    for _ in range(repeats):
+        forward_maxpoints(model, x)
+    synchronize(device)
+    return n_points * repeats / (time.time() - t0)
+
+def benchmark_bake(args):
+    data = parse_list(args['data'], str)[0]
+    opt, dataset = dataset_options(args, data)
+    model, opt = trained_model(args, opt, dataset)
+    model.eval()
+    gt_psnr = reconstruction_psnr(model, dataset)
+    with torch.no_grad():
+        exact = sample_grid(model, list(dataset.data.shape[2:]))
+    exact_throughput = inference_throughput(model, opt['n_dims'], args['device'])
+    print(f"exact: {gt_psnr : 0.02f} dB vs data, {exact_throughput : 0.1f} points/sec")
+    for res in parse_list(args['bake_resolutions']):
+        t0 = time.time()
+        model.bake([res]*opt['n_dims'])
+        bake_time = time.time() - t0
+        with torch.no_grad():
+            baked = sample_grid(model, list(dataset.data.shape[2:]))
+        baked_psnr = reconstruction_psnr(model, dataset)
+        vs_exact = PSNR(baked, exact, exact.max() - exact.min()).item()
+        throughput = inference_throughput(model, opt['n_dims'], args['device'])
+        print(f"baked {res}^{opt['n_dims']}: {baked_psnr : 0.02f} dB vs data, " + \
+            f"{vs_exact : 0.02f} dB vs exact, {throughput : 0.1f} points/sec " + \
+            f"({throughput / exact_throughput : 0.2f}x), baked in {bake_time : 0.02f} seconds")
+        model.unbake()
+
+def time_parameter_layout(layout, n_gaussians, n_dims, n_features, n_points,
+    device, repeats=50):
+    # Training iterations on random points. With small batches, zeroing
+    # gradients and stepping the optimizers is a large share of each one.
+    from train import create_optimizers
+    torch.manual_seed(0)
+    opt = Options.get_default()
+    opt.update(n_gaussians=n_gaussians, n_dims=n_dims, n_features=n_features,
+        n_outputs=1, device=device, parameter_layout=layout)
+    model = create_model(opt)
+    optimizers = create_optimizers(model, opt)
+    x = torch.rand([n_points, n_dims], device=device) * 2 - 1
+    y = torch.rand([n_points, 1], device=device)
+
+    def step():
+        # Seconds of the whole iteration and of the optimizers in it
+        synchronize(device)
+        t0 = time.perf_counter()
+        for o in optimizers:
+            o.zero_grad()
+        synchronize(device)
+        t_optimizer = time.perf_counter() - t0
+        (model(x) - y).abs().mean().backward()
+        synchronize(device)
+        t = time.perf_counter()
+        for o in optimizers:
+            o.step()
+        synchronize(device)
+        t_end = time.perf_counter()
+        return t_end - t0, t_optimizer + t_end - t
+
+    for _ in range(5):
+        step()
+    # Medians, the iterations are short enough for scheduling noise to
+    # dominate a mean
+    times = np.array([step() for _ in range(repeats)])
+    iteration, optimizer = np.median(times, axis=0)
+    return {
+        "layout": layout,
+        "iterations_per_sec": 1 / iteration,
+        "optimizer_ms": 1000 * optimizer,
+        "n_parameters": sum(p.numel() for p in model.parameters())
+    }
+
+def benchmark_optimizer(args):
+    for n_gaussians, n_points in itertools.product(
+        parse_list(args['n_gaussians']), parse_list(args['points_per_iteration'])):
+        for layout in parse_list(args['methods'], str):
+            r = run_isolated(time_parameter_layout, layout=layout,
+                n_gaussians=n_gaussians, n_dims=parse_list(args['n_dims'])[0],
+                n_features=parse_list(args['n_features'])[0], n_points=n_points,
+                device=args['device'], repeats=args['repeats'])
+            if("error" in r):
+                print(f"{layout} G={n_gaussians} N={n_points}: {r['error']}")
+                continue
+            print(f"{layout : >9} G={n_gaussians : <6} N={n_points : <8} " + \
+                f"{r['iterations_per_sec'] : 10.1f} iterations/sec, " + \
+                f"optimizer {r['optimizer_ms'] : 0.3f} ms/iteration " + \
+                f"({r['n_parameters']} parameters)")
@@ -0,0 +1,112 @@
+import threading
+import numpy as np
+import torch
+
+class BrickWorkingSet():
+    # Out-of-core sampling for volumes that do not fit on data_device.
+    # A working set of resident_bricks bricks is kept on data_device, and a
+    # background thread keeps replacing the oldest one with a brick read
+    # from disk, bricks_per_batch bricks for every batch sampled.
+    # Every slot is filled with a brick drawn with probability proportional
+    # to its voxel count, and a batch picks a slot uniformly and a voxel
+    # uniformly within it. Averaged over the rotation, each voxel of the
+    # domain is then sampled with probability 1/N, so training sees the
+    # same objective as uniform in-core sampling.
+    # NetCDF and HDF5 handles are not thread safe, so every read of the
+    # volume, here and on other threads (see Dataset.volume_lock), holds
+    # read_lock.
+    def __init__(self, volume, device, resident_bricks=64, bricks_per_batch=4):
+        self.volume = volume
+        self.device = device
+        self.brick_size = volume.brick_size
+        self.n_dims = volume.n_dims
+        self.shape = volume.shape
+        self.brick_grid = volume.brick_grid()
+        self.n_slots = resident_bricks
+        self.bricks_per_batch = bricks_per_batch
+
+        # Voxel count of every brick, smaller at the upper edges
+        counts = np.ones(self.brick_grid)
+        for axis, n in enumerate(self.shape):
+            extent = np.full([self.brick_grid[axis]], self.brick_size)
+            extent[-1] = n - self.brick_size * (self.brick_grid[axis] - 1)
+            view = [1] * self.n_dims
+            view[axis] = -1
+            counts = counts * extent.reshape(view)
+        self.brick_probability = torch.tensor(counts.flatten() / counts.sum())
+
+        self.bricks = torch.zeros([self.n_slots, volume.n_channels,
+            self.brick_size**self.n_dims], device=device)
+        self.slot_start = torch.zeros([self.n_slots, self.n_dims],
+            dtype=torch.long, device=device)
+        self.slot_extent = torch.ones([self.n_slots, self.n_dims],
+            dtype=torch.long, device=device)
+        self.next_slot = 0
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.swaps_requested = threading.Semaphore(0)
+        self.swaps_pending = 0
+        self.stopped = False
+        self.bricks_loaded = 0
+
+        for _ in range(self.n_slots):
+            self.swap_in(*self.load_brick())
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def load_brick(self):
+        flat = torch.multinomial(self.brick_probability, 1).item()
+        brick_index = np.unravel_index(flat, self.brick_grid)
+        with self.read_lock:
+            b = self.volume.brick(brick_index)
+        starts, ends = self.volume.brick_region(brick_index)
+        padded = torch.zeros([self.volume.n_channels] + [self.brick_size]*self.n_dims)
+        padded[(slice(None),) + tuple(slice(0, e-s) for s, e in zip(starts, ends))] = \
+            torch.from_numpy(np.ascontiguousarray(b))
+        return padded.flatten(1), starts, [e-s for s, e in zip(starts, ends)]
+
+    def swap_in(self, brick, starts, extents):
+        brick = brick.to(self.device)
+        with self.lock:
+            slot = self.next_slot
+            self.bricks[slot] = brick
+            self.slot_start[slot] = torch.tensor(starts, device=self.device)
+            self.slot_extent[slot] = torch.tensor(extents, device=self.device)
+            self.next_slot = (self.next_slot + 1) % self.n_slots
+            self.bricks_loaded += 1
+
+    def worker(self):
+        while(True):
+            self.swaps_requested.acquire()
+            if(self.stopped):
+                break
+            self.swap_in(*self.load_brick())
+            with self.lock:
+                self.swaps_pending -= 1
+
+    def sample(self, n_points):
+        # Flat voxel indices [n] into the whole volume and their values [n, C]
+        with self.lock:
+            slots = torch.randint(self.n_slots, [n_points], device=self.device)
+            offsets = (torch.rand([n_points, self.n_dims], device=self.device) *
+                self.slot_extent[slots]).long()
+            offsets = torch.minimum(offsets, self.slot_extent[slots] - 1)
+            local = torch.zeros([n_points], dtype=torch.long, device=self.device)
+            indices = torch.zeros([n_points], dtype=torch.long, device=self.device)
+            for axis in range(self.n_dims):
+                local = local * self.brick_size + offsets[:, axis]
+                indices = indices * self.shape[axis] + \
+                    self.slot_start[slots, axis] + offsets[:, axis]
+            values = self.bricks[slots, :, local]
+            # Requests pile up at most one working set deep when the disk
+            # is slower than training
+            n_swaps = min(self.bricks_per_batch, self.n_slots - self.swaps_pending)
+            self.swaps_pending += n_swaps
+        for _ in range(n_swaps):
+            self.swaps_requested.release()
+        return indices, values
+
+    def close(self):
+        self.stopped = True
+        self.swaps_requested.release()
+        self.thread.join(timeout=5)
@@ -1,6 +1,13 @@
 import os
+import contextlib
+import numpy as np
 import torch
-from Other.utility_functions import make_coord_grid, nc_to_tensor, curl
+from Other.utility_functions import CoordGrid
+from Datasets.samplers import create_sampler, gather_points
+from Datasets.volume_storage import open_volume
+from Datasets.derived_fields import open_derived_volume
+from Datasets.brick_streaming import BrickWorkingSet
+from Datasets.volume_statistics import load_or_compute_statistics
 import torch.nn.functional as F
 
 project_folder_path = os.path.dirname(os.path.abspath(__file__))
@@ -13,48 +20,103 @@ class Dataset(torch.utils.data.Dataset):
     def __init__(self, opt):
         
         self.opt = opt
-        self.min_ = None
-        self.max_ = None
-        self.mean_ = None
-        self.full_coord_grid = None
+        self.statistics_ = None
         folder_to_load = os.path.join(data_folder, self.opt['data'])
+        self.location = folder_to_load
 
         print(f"Initializing dataset - reading {folder_to_load}")
         
-        d = nc_to_tensor(folder_to_load).to(opt['data_device'])
+        self.volume = open_volume(folder_to_load, 
+            use_cache=self.opt['volume_cache'],
+            brick_size=self.opt['brick_size'], 
+            cache_bricks=self.opt['brick_cache_size'],
+            shared_memory=self.opt['shared_memory_data'],
+            shared_memory_token=self.opt['shared_memory_token'])
+        # Train on the vorticity of the data, computed once and cached
+        self.field = "vorticity" if self.opt['vorticity'] else None
+        if(self.field is not None):
+            self.volume = open_derived_volume(folder_to_load, self.volume, 
+                self.field)
+        self.out_of_core = self.opt['out_of_core']
+        # Out-of-core batches come from the brick working set, another
+        # sampler would be ignored
+        if(self.out_of_core and self.opt['sampler'] != "uniform"):
+            raise ValueError("out_of_core only supports the uniform sampler, " + \
+                f"not {self.opt['sampler']}")
+        if(self.out_of_core):
+            # Only a working set of bricks is resident, data is a meta
+            # tensor that just carries the shape
+            d = torch.empty([1, self.volume.n_channels] + self.volume.shape,
+                device='meta')
+            self.working_set = BrickWorkingSet(self.volume, 
+                self.opt['data_device'], self.opt['resident_bricks'], 
+                self.opt['bricks_per_batch'])
+        else:
+            d = self.volume.read_all().to(opt['data_device'])
         self.data = d
             
-        self.index_grid = make_coord_grid(
+        # Lazy, coordinates are computed only for the sampled indices
+        self.index_grid = CoordGrid(
             self.data.shape[2:], 
             self.opt['data_device'],
-            flatten=True,
             align_corners=self.opt['align_corners'])
+        self.sampler = create_sampler(self.opt, self.data.shape[2:])
+
+    def volume_lock(self):
+        # Held for reads of the volume, which the brick working set reads
+        # from its own thread when out of core
+        if(self.out_of_core):
+            return self.working_set.read_lock
+        return contextlib.nullcontext()
+
+    def statistics(self):
+        # Streaming statistics of the data file, persisted next to it
+        if self.statistics_ is None:
+            with self.volume_lock():
+                self.statistics_ = load_or_compute_statistics(self.location, 
+                    self.volume, field=self.field)
+        return self.statistics_
 
     def min(self):
-        if self.min_ is not None:
-            return self.min_
-        else:
-            self.min_ = self.data.min()
-            return self.min_
+        return torch.tensor(self.statistics().global_min(), 
+            device=self.opt['data_device'])
     def mean(self):
-        if self.mean_ is not None:
-            return self.mean_
-        else:
-            self.mean_ = self.data.mean()
-            return self.mean_
+        return torch.tensor(self.statistics().global_mean(), 
+            device=self.opt['data_device'])
     def max(self):
-        if self.max_ is not None:
-            return self.max_
-        else:
-            self.max_ = self.data.max()
-            return self.max_
+        return torch.tensor(self.statistics().global_max(), 
+            device=self.opt['data_device'])
+    def channel_range(self):
+        # Per channel min and max [C] of the data
+        stats = self.statistics()
+        return torch.tensor(stats.min, dtype=torch.float32, 
+            device=self.opt['data_device']), \
+            torch.tensor(stats.max, dtype=torch.float32, 
+            device=self.opt['data_device'])
 
     def get_2D_slice(self):
+        if(self.out_of_core):
+            shape = self.volume.shape
+            with self.volume_lock():
+                if(len(shape) == 2):
+                    return torch.from_numpy(self.volume.read([0, 0], shape))
+                mid = int(shape[2]/2)
+                return torch.from_numpy(self.volume.read([0, 0, mid], 
+                    [shape[0], shape[1], mid+1])[..., 0])
         if(len(self.data.shape) == 4):
             return self.data[0].clone()
         else:
             return self.data[0,:,:,:,int(self.data.shape[4]/2)].clone()
 
+    def get_slab(self, start, end):
+        # Rows [start, end) of the first spatial axis as [1, C, end-start, ...]
+        if(self.out_of_core):
+            shape = self.volume.shape
+            with self.volume_lock():
+                return torch.from_numpy(np.ascontiguousarray(self.volume.read(
+                    [start] + [0]*(len(shape)-1), [end] + shape[1:]))).unsqueeze(0)
+        return self.data[:, :, start:end]
+
     def sample_rect(self, starts, widths, samples):
         positions = []
         for i in range(len(starts)):
@@ -80,49 +142,56 @@ class Dataset(torch.utils.data.Dataset):
         return t
 
     def get_full_coord_grid(self):
-        if self.full_coord_grid is None:
-            self.full_coord_grid = make_coord_grid(self.data.shape[2:], 
-                    self.opt['data_device'], flatten=True, 
-                    align_corners=self.opt['align_corners'])
-        return self.full_coord_grid
+        # Lazy CoordGrid over every voxel, index it for coordinates
+        return self.index_grid
 
-    def get_random_points(self, n_points):        
-        possible_spots = self.index_grid
+    def get_points(self, indices):
+        return gather_points(self.data, self.index_grid, indices)
 
+    def get_random_points(self, n_points):        
+        if(self.out_of_core):
+            indices, y = self.working_set.sample(n_points)
+            return {
+                "inputs": self.index_grid[indices],
+                "data": y,
+                "indices": indices
+            }
         if(self.opt['interpolate']):
             x = torch.rand([1, 1, 1, n_points, self.opt['n_dims']], 
                 device=self.opt['data_device']) * 2 - 1
             y = F.grid_sample(self.data,
                 x, mode='bilinear', 
                 align_corners=self.opt['align_corners'])
+            x = x.squeeze()
+            y = y.squeeze()
+            if(len(y.shape) == 1):
+                y = y.unsqueeze(0)    
+            y = y.permute(1,0)
+            indices = None
+            weights = None
         else:
-            if(n_points >= possible_spots.shape[0]):
-                x = possible_spots.clone().unsqueeze_(0)
+            if(n_points >= self.total_points()):
+                indices = torch.arange(self.total_points(), 
+                    device=self.opt['data_device'])
+                weights = None
             else:
-                samples = torch.randperm(possible_spots.shape[0], 
-                    dtype=torch.long, device=self.opt['data_device'])[:n_points]
-                # Change above to not use CPU when not on MPS
-                # Verify that the bottom two lines do the same thing
-                x = torch.index_select(possible_spots, 0, samples).clone().unsqueeze_(0)
-                #x = possible_spots[samples].clone().unsqueeze_(0)
-            for _ in range(len(self.data.shape[2:])-1):
-                x = x.unsqueeze(-2)
-            
-
-            y = F.grid_sample(self.data, 
-                x, mode='nearest', 
-                align_corners=self.opt['align_corners'])
-        
-        x = x.squeeze()
-        y = y.squeeze()
-        if(len(y.shape) == 1):
-            y = y.unsqueeze(0)    
-        
-        y = y.permute(1,0)
+                indices, weights = self.sampler.sample(n_points)
+            x, y = self.get_points(indices)
 
         to_return = {
             "inputs": x,
             "data": y
         }
+        if(indices is not None):
+            to_return['indices'] = indices
+        if(weights is not None):
+            to_return['weights'] = weights
         
         return to_return
+
+def create_dataset(opt):
+    # procedural:<name> data is generated from an analytic field
+    if(opt['data'].startswith("procedural:")):
+        from Datasets.procedural import ProceduralDataset
+        return ProceduralDataset(opt)
+    return Dataset(opt)
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import torch
+from Other.utility_functions import curl, jacobian
+from Datasets.volume_storage import VolumeReader, RawVolume, convert_to_raw, \
+    raw_cache_location, raw_cache_valid
+
+# Fields derived from a volume with stencil operators (one voxel reach),
+# as (operator on [1, C, ...] tensors, output channel names)
+derived_fields = {
+    "vorticity": (curl, ['vort_x', 'vort_y', 'vort_z']),
+    "jacobian": (lambda d: jacobian(d, normalize=False).flatten(1, 2),
+        [f"d{c}d{x}" for c in "uvw" for x in "xyz"])
+}
+
+class DerivedVolume(VolumeReader):
+    # A derived field of a source volume, computed lazily region by region.
+    # Each region is read from the source with a one voxel halo, so any
+    # brick or slab matches the operator applied to the whole volume.
+    def __init__(self, source, field, location=None, brick_size=64, 
+        cache_bricks=64):
+        # location is the data file the source was opened from, when the
+        # source is a raw or shared memory copy of it
+        super().__init__(location or source.location, brick_size, cache_bricks)
+        if(field not in derived_fields):
+            raise ValueError(f"Unknown derived field {field}")
+        self.source = source
+        self.field = field
+        self.fn, self.channel_names = derived_fields[field]
+        self.shape = source.shape
+
+    def read(self, starts, ends):
+        lo = [max(s - 1, 0) for s in starts]
+        hi = [min(e + 1, n) for e, n in zip(ends, self.shape)]
+        region = torch.from_numpy(np.ascontiguousarray(
+            self.source.read(lo, hi))).unsqueeze(0)
+        with torch.no_grad():
+            out = self.fn(region)[0]
+        crop = tuple(slice(s-l, e-l) for s, e, l in zip(starts, ends, lo))
+        return out[(slice(None),) + crop].numpy()
+
+    def read_channel(self, channel, slices):
+        return self.read([s.start for s in slices], 
+            [s.stop for s in slices])[channel]
+
+    def read_all(self):
+        return torch.from_numpy(self.read([0]*self.n_dims, self.shape)).unsqueeze(0)
+
+    def close(self):
+        super().close()
+        self.source.close()
+
+def open_derived_volume(location, source, field, use_cache=True):
+    # The derived field of source, opened from the data file at location.
+    # With use_cache, it is computed once in slabs into a raw file next to
+    # the data file and memory-mapped after that, recomputed only when the
+    # data file changes.
+    derived = DerivedVolume(source, field, location, source.brick_size, 
+        source.cache_bricks)
+    if(not use_cache):
+        return derived
+    raw = raw_cache_location(location, field)
+    if(not raw_cache_valid(location, field)):
+        print(f"Computing {field} into {raw}")
+        try:
+            convert_to_raw(derived, raw)
+        except OSError:
+            # Read only data folders compute the field on the fly
+            return derived
+    source.close()
+    return RawVolume(raw, source.brick_size, source.cache_bricks)
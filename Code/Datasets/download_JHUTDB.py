@@ -10,6 +10,7 @@ import time
 import h5py
 import torch
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from Datasets.volume_statistics import compute_statistics, array_slabs
 
 
 client = zeep.Client('http://turbulence.pha.jhu.edu/service/turbulence.asmx?WSDL')
@@ -139,8 +140,9 @@ for i in range(startts, endts, ts_skip):
     "u", 3, 
     16)    
     print(f.shape)
-    mags = np.linalg.norm(f, axis=3)
-    f *= (1/mags.max())
+    # Streaming pass, a full size magnitude array would be another 4 GB
+    stats = compute_statistics(array_slabs(np.moveaxis(f, 3, 0)), f.shape[3])
+    f *= (1/stats.magnitude_max)
     #print(f.shape)
     # If 2D do next 2 lines
     # f = f[...,0]
@@ -151,7 +153,8 @@ for i in range(startts, endts, ts_skip):
     f = np.transpose(f, (0, 4, 1, 2, 3))
     print(f.shape)
     #frames.append(f)
-    tensor_to_cdf(torch.tensor(f), "vf")
+    # One file per timestep, train with --time_series "vf_*.nc"
+    tensor_to_cdf(torch.tensor(f), os.path.join(save_folder, f"vf_{i:04d}.nc"))
     print("Finished " + str(i))
     count += 1
 print("finished")
@@ -7,6 +7,7 @@ from math import pi, sin, atan, cos, tan
 import skimage
 from torch import tensor
 from Other.utility_functions import tensor_to_cdf, tensor_to_h5, jacobian, normal, binormal
+from Datasets.procedural import write_field
 import h5py
 
 
@@ -38,105 +39,19 @@ def vortex_z(x, y, z, x0, y0, z0, A=720):
     return num / denom
 
 def generate_vortices_data(resolution = 128):
-
-    # [channels, u, v, w]
-    a = np.zeros([3, resolution, resolution, resolution], dtype=np.float32)
-
-    # max vf mag = 6.78233, divide all components by that
-    i = 0
-    start = 1 
-    end = 10
-    for x in np.arange(start, end + (end-start) / resolution, (end-start) / (resolution-1)):        
-        j = 0
-        for y in np.arange(start, end + (end-start) / resolution, (end-start) / (resolution-1)): 
-            k = 0
-            for z in np.arange(start, end + (end-start) / resolution, (end-start) / (resolution-1)):
-                u = 0.5 * (vortex_x(x, y, z, -5.5, -5.5, -5.5) + \
-                    vortex_x(x, y, z, 15.0, 15.0, 15.0))
-                v = 0.5 * (vortex_y(x, y, z, -5.5, -5.5, -5.5) + \
-                    vortex_y(x, y, z, 15.0, 15.0, 15.0))
-                w = 0.5 * (vortex_z(x, y, z, -5.5, -5.5, -5.5) + \
-                    vortex_z(x, y, z, 15.0, 15.0, 15.0))
-                a[:,k,j,i] = np.array([u, v, w], dtype=np.float32)
-                print("%0.02f %0.02f %0.02f" % (x, y, z))
-                print("%i %i %i" % (i, j, k))
-                k += 1
-            j += 1
-        i += 1
-    print(a.max())
-    print(a.min())
-    print(a.mean())
-    print(np.linalg.norm(a, axis=0).max())
-    a /= np.linalg.norm(a, axis=0).max()
-    
-    channel_names = ['u', 'v', 'w']
-    tensor_to_h5(torch.tensor(a).unsqueeze(0).type(torch.float32), 
-        "vortices.h5", channel_names) 
-    tensor_to_cdf(torch.tensor(a).unsqueeze(0).type(torch.float32), 
-        "vortices.nc", channel_names) 
+    # Vectorized and written in slabs, see Datasets/procedural.py
+    write_field("vortices", resolution, "vortices.h5")
+    write_field("vortices", resolution, "vortices.nc")
 
 def generate_flow_past_cylinder(resolution = 128, a=1):
-    start = - 2.5
-    end = 2.5
-    
-    zyx = torch.meshgrid(
-        [torch.linspace(start, end, steps=resolution),
-        torch.linspace(start, end, steps=resolution),
-        torch.linspace(start, end, steps=resolution)],
-        indexing='ij'
-    )
-    zyx = torch.stack(zyx).type(torch.float32)
-    x = zyx[2].clone()
-    y = zyx[1].clone()
-    z = zyx[0].clone()
-    r = (x**2 + y**2)**0.5
-    theta = torch.atan(y/x)
-
-    u = torch.cos(2*theta) / r**2 - 1
-    v = torch.sin(2*theta) / r**2
-    w = torch.zeros_like(u)
-    
-    vf = torch.stack([u, v, w], dim=0)
-    
-    tensor_to_cdf(torch.tensor(vf).unsqueeze(0).type(torch.float32), 
-        "flow_past_cylinder.nc")    
-    tensor_to_h5(torch.tensor(vf).unsqueeze(0).type(torch.float32), 
-        "flow_past_cylinder.h5")
+    write_field("flow_past_cylinder", resolution, "flow_past_cylinder.nc")
+    write_field("flow_past_cylinder", resolution, "flow_past_cylinder.h5")
 
 def generate_ABC_flow(resolution = 128, 
                       A=np.sqrt(3), B=np.sqrt(2), C=1):
-    
-    start = 0
-    end = 2*np.pi
-    
-    zyx = torch.meshgrid(
-        [torch.linspace(start, end, steps=resolution),
-        torch.linspace(start, end, steps=resolution),
-        torch.linspace(start, end, steps=resolution)],
-        indexing='ij'
-    )
-    zyx = torch.stack(zyx).type(torch.float32)
-    x = zyx[2].clone()
-    y = zyx[1].clone()
-    z = zyx[0].clone()
-    
-    u = A*torch.sin(z) + C*torch.cos(y)
-    v = B*torch.sin(x) + A*torch.cos(z)
-    w = C*torch.sin(y) + B*torch.cos(x)
-    
-    abc = torch.stack([u,v,w], dim=0).unsqueeze(0)
-    print(abc.shape)
-    print(abc.max())
-    print(abc.min())
-    print(abc.mean())
-    print(abc.norm(dim=1).max())
-    abc /= abc.norm(dim=1).max()
-    
-    channel_names = ['u', 'v', 'w']
-    tensor_to_cdf(abc.type(torch.float32), 
-        "ABC_flow.h5", channel_names)
-    tensor_to_cdf(abc.type(torch.float32), 
-        "ABC_flow.nc", channel_names)
+    field_args = {"A": A, "B": B, "C": C}
+    write_field("ABC_flow", resolution, "ABC_flow.h5", field_args=field_args)
+    write_field("ABC_flow", resolution, "ABC_flow.nc", field_args=field_args)
 
 def isabel_from_bin():
     u = np.fromfile('U.bin', dtype='>f')
@@ -0,0 +1,163 @@
+import threading
+import queue
+import time
+import torch
+from Models.checkpoint import rng_state, to_cpu
+
+class BatchPrefetcher():
+    # Produces training batches from dataset.get_random_points on a
+    # background thread, up to n_batches ahead of the training loop, so
+    # sampling overlaps the forward/backward pass. When the batches are
+    # sampled on the CPU for a CUDA device, they are staged in a ring of
+    # preallocated pinned buffers and copied with non_blocking transfers;
+    # a slot is only refilled after its copy has finished. Otherwise the
+    # sampled tensors are handed over directly.
+    # next() records how long the loop waited for data, and the wall time
+    # since the previous call, to report how much of each iteration was
+    # stalled on data.
+    # The worker holds lock while it draws from the dataset, and code on
+    # the training thread that reads or changes the dataset or its sampler
+    # (density control, checkpoints) holds it too, so a batch is never
+    # drawn from half-updated state. Frequent changes (the importance
+    # sampler's update every iteration) are queued with run() instead and
+    # applied by the worker before its next draw, without blocking.
+    # The worker's sampler and RNG state are batches ahead of the loop, so
+    # with snapshot each batch carries the state right after it was drawn,
+    # which the next draw starts from, and consumed_state is that of the
+    # last batch next() returned. A checkpoint taken after an iteration
+    # stores it, so the batches drawn ahead are drawn again on resume.
+    # Queued updates are applied at whichever draw follows them, so with
+    # the importance sampler batches depend on timing and runs are not
+    # reproducible, resumed or not.
+    def __init__(self, dataset, n_points, device, n_batches=2, pin_memory=True,
+        snapshot=False):
+        self.dataset = dataset
+        self.n_points = n_points
+        self.device = device
+        self.staged = pin_memory and "cuda" in str(device) and \
+            "cuda" not in str(dataset.opt['data_device'])
+        n_slots = n_batches + 2
+        self.buffers = [None] * n_slots
+        self.events = [None] * n_slots
+        self.ready = queue.Queue(maxsize=n_batches)
+        self.free = queue.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+        self.held_slot = None
+        self.snapshot = snapshot
+        self.consumed_state = None
+        self.lock = threading.Lock()
+        self.updates = queue.Queue()
+
+        self.last_wait = 0.0
+        self.last_iteration_time = 0.0
+        self.total_wait = 0.0
+        self.total_time = 0.0
+        self.last_call = None
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def fill(self, slot, batch):
+        buffer = self.buffers[slot]
+        if(buffer is None or buffer.keys() != batch.keys() or
+           any(buffer[k].shape != batch[k].shape for k in batch.keys())):
+            buffer = {k: torch.empty(v.shape, dtype=v.dtype,
+                pin_memory=True) for k, v in batch.items()}
+            self.buffers[slot] = buffer
+        for k in batch.keys():
+            buffer[k].copy_(batch[k])
+        return buffer
+
+    def worker(self):
+        try:
+            while(not self.stopped):
+                slot = self.free.get()
+                if(slot is None):
+                    break
+                if(self.events[slot] is not None):
+                    self.events[slot].synchronize()
+                with self.lock:
+                    self.apply_updates()
+                    batch = self.dataset.get_random_points(self.n_points)
+                    state = self.draw_state() if self.snapshot else None
+                if(self.staged):
+                    batch = self.fill(slot, batch)
+                self.ready.put((slot, batch, state))
+        except Exception as e:
+            self.ready.put((None, e, None))
+
+    def draw_state(self):
+        # Sampler and RNG state the next draw starts from, as
+        # training_state stores them
+        sampler = self.dataset.sampler
+        return to_cpu({
+            "sampler": sampler.state_dict() if sampler is not None else None,
+            "rng": rng_state()
+        })
+
+    def run(self, fn, *args):
+        # Calls fn(*args) on the worker before its next draw
+        self.updates.put((fn, args))
+
+    def apply_updates(self):
+        try:
+            while(True):
+                fn, args = self.updates.get_nowait()
+                fn(*args)
+        except queue.Empty:
+            pass
+
+    def next(self):
+        t0 = time.perf_counter()
+        # Batches handed over directly stay valid until the next call
+        if(self.held_slot is not None):
+            self.free.put(self.held_slot)
+            self.held_slot = None
+        slot, batch, state = self.ready.get()
+        if(slot is None):
+            raise batch
+        self.consumed_state = state
+        if(self.staged):
+            batch = {k: v.to(self.device, non_blocking=True)
+                for k, v in batch.items()}
+            event = torch.cuda.Event()
+            event.record()
+            self.events[slot] = event
+            self.free.put(slot)
+        else:
+            self.held_slot = slot
+        now = time.perf_counter()
+
+        self.last_wait = now - t0
+        if(self.last_call is not None):
+            self.last_iteration_time = now - self.last_call
+            self.total_wait += self.last_wait
+            self.total_time += self.last_iteration_time
+        self.last_call = now
+        return batch
+
+    def stall_fraction(self):
+        # Fraction of the last iteration's wall time spent waiting on data
+        if(self.last_iteration_time == 0):
+            return 0.0
+        return self.last_wait / self.last_iteration_time
+
+    def summary(self):
+        if(self.total_time == 0):
+            return "No iterations timed"
+        return f"Waited on data for {self.total_wait : 0.02f} of " + \
+            f"{self.total_time : 0.02f} seconds " + \
+            f"({100 * self.total_wait / self.total_time : 0.01f}%)"
+
+    def close(self):
+        self.stopped = True
+        # Unblock the worker if it is waiting for a slot or a queue spot
+        self.free.put(None)
+        try:
+            while(True):
+                self.ready.get_nowait()
+        except queue.Empty:
+            pass
+        self.thread.join(timeout=5)
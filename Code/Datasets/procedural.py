@@ -0,0 +1,147 @@
+import numpy as np
+import torch
+from math import pi
+from Datasets.datasets import Dataset
+from Datasets.volume_statistics import compute_statistics
+from Other.utility_functions import CoordGrid, GridWriter
+
+# Analytic vector fields evaluated in vectorized form at any coordinates.
+# Each generator takes the physical x, y, z coordinates as tensors of any
+# (matching) shape and returns [..., 3] (u, v, w). fields maps a name to
+# the generator and the physical extent of the domain, which is mapped to
+# the [-1, 1]^3 coordinates the model trains on.
+
+def abc_flow(x, y, z, A=np.sqrt(3), B=np.sqrt(2), C=1):
+    u = A*torch.sin(z) + C*torch.cos(y)
+    v = B*torch.sin(x) + A*torch.cos(z)
+    w = C*torch.sin(y) + B*torch.cos(x)
+    return torch.stack([u, v, w], dim=-1)
+
+def flow_past_cylinder(x, y, z):
+    r = (x**2 + y**2)**0.5
+    theta = torch.atan(y/x)
+    u = torch.cos(2*theta) / r**2 - 1
+    v = torch.sin(2*theta) / r**2
+    w = torch.zeros_like(u)
+    return torch.stack([u, v, w], dim=-1)
+
+def vortex(x, y, z, x0, y0, z0, A=720):
+    # Vectorized vortex_x, vortex_y and vortex_z from generate_synthetic_data
+    sym = torch.where(z - z0 <= 0, 1.0, -1.0)
+    dist = (x-x0)**2 + (y-y0)**2 + (z-z0)**2
+    r = ((x-x0)**2 + (y-y0)**2)**0.5
+    u = sym * -A * (z - z0) * (x - x0) / ((2*pi) * dist * r)
+    v = sym * -A * (z - z0) * (y - y0) / ((2*pi) * dist * r)
+    w = sym * A * r / ((2*pi) * dist)
+    return torch.stack([u, v, w], dim=-1)
+
+def vortices(x, y, z):
+    return 0.5 * (vortex(x, y, z, -5.5, -5.5, -5.5) +
+        vortex(x, y, z, 15.0, 15.0, 15.0))
+
+fields = {
+    "ABC_flow": (abc_flow, 0, 2*np.pi),
+    "flow_past_cylinder": (flow_past_cylinder, -2.5, 2.5),
+    "vortices": (vortices, 1, 10)
+}
+
+# Fields normalized by their max magnitude over the grid, as the files
+# generate_synthetic_data used to write
+normalized_fields = ["ABC_flow", "vortices"]
+
+def evaluate_field(name, coords, field_args={}):
+    # Field at coordinates [..., 3] in [-1, 1] ordered (x, y, z), 
+    # field_args are passed on to the generator
+    generator, start, end = fields[name]
+    p = start + (coords + 1) * 0.5 * (end - start)
+    return generator(p[..., 0], p[..., 1], p[..., 2], **field_args)
+
+def field_slabs(name, grid, max_points=2**20, scale=1.0, field_args={}):
+    # Slabs [3, t, *grid[1:]] of the field sampled on grid (the CoordGrid
+    # order, first axis is z), generated one slab at a time
+    slice_points = len(grid) // grid.grid_shape[0]
+    slab_size = max(1, max_points // slice_points)
+    for start in range(0, grid.grid_shape[0], slab_size):
+        end = min(start + slab_size, grid.grid_shape[0])
+        values = evaluate_field(name, grid.slab(start, end), field_args) * scale
+        yield start, end, values.T.reshape([3, end-start] + grid.grid_shape[1:])
+
+def field_scale(name, grid, max_points=2**20, field_args={}):
+    if(name not in normalized_fields):
+        return 1.0
+    stats = compute_statistics((s.cpu().numpy() for _, _, s in
+        field_slabs(name, grid, max_points, field_args=field_args)), 3)
+    return 1.0 / stats.magnitude_max
+
+def write_field(name, resolution, location, align_corners=True,
+    max_points=2**20, field_args={}):
+    # Writes the field at any resolution to .nc/.h5/.npy in slabs
+    grid = CoordGrid([resolution]*3, "cpu", align_corners=align_corners)
+    scale = field_scale(name, grid, max_points, field_args)
+    slab_size = max(1, max_points // (resolution*resolution))
+    with GridWriter(location, grid.grid_shape, 3, ['u', 'v', 'w'], 
+        slab_size) as writer:
+        for start, end, values in field_slabs(name, grid, max_points, scale, 
+            field_args):
+            writer.write(start, end, values)
+
+class ProceduralDataset(Dataset):
+    # Dataset whose values come from an analytic field, selected with
+    # --data procedural:<name>. Batches are drawn at continuous random
+    # coordinates, so training samples off-grid and no volume is stored.
+    # procedural_resolution sets the nominal grid used for normalization,
+    # statistics, logging and evaluation.
+    def __init__(self, opt):
+        self.opt = opt
+        self.statistics_ = None
+        self.name = opt['data'].split(":", 1)[1]
+        if(self.name not in fields):
+            raise ValueError(f"Unknown procedural field {self.name}")
+        # Points are drawn uniformly at continuous coordinates, there are
+        # no voxel indices for another sampler to weight
+        if(self.opt['sampler'] != "uniform"):
+            raise ValueError("Procedural data only supports the uniform sampler, " + \
+                f"not {self.opt['sampler']}")
+        print(f"Initializing procedural dataset {self.name}")
+        resolution = self.opt['procedural_resolution']
+        # No file or volume backs the field
+        self.location = None
+        self.field = None
+        self.volume = None
+        self.sampler = None
+        self.out_of_core = False
+        # Nothing is stored, data is a meta tensor that only carries the shape
+        self.data = torch.empty([1, 3] + [resolution]*3, device='meta')
+        self.index_grid = CoordGrid(self.data.shape[2:],
+            self.opt['data_device'], align_corners=self.opt['align_corners'])
+        self.scale = field_scale(self.name, self.index_grid)
+
+    def statistics(self):
+        if self.statistics_ is None:
+            self.statistics_ = compute_statistics((s.cpu().numpy() for _, _, s in
+                field_slabs(self.name, self.index_grid, scale=self.scale)), 3)
+        return self.statistics_
+
+    def get_2D_slice(self):
+        # Middle slice of the last axis, as Dataset.get_2D_slice
+        shape = list(self.data.shape[2:])
+        indices = torch.arange(shape[0]*shape[1], 
+            device=self.opt['data_device']) * shape[2] + shape[2]//2
+        coords = self.index_grid[indices].view(shape[0], shape[1], 3)
+        return (evaluate_field(self.name, coords) * self.scale).permute(2, 0, 1)
+
+    def get_slab(self, start, end):
+        shape = list(self.data.shape[2:])
+        values = evaluate_field(self.name, self.index_grid.slab(start, end)) * self.scale
+        return values.T.reshape([1, 3, end-start] + shape[1:])
+
+    def get_points(self, indices):
+        x = self.index_grid[indices]
+        return x, evaluate_field(self.name, x) * self.scale
+
+    def get_random_points(self, n_points):
+        x = torch.rand([n_points, 3], device=self.opt['data_device']) * 2 - 1
+        return {
+            "inputs": x,
+            "data": evaluate_field(self.name, x) * self.scale
+        }
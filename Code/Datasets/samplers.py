@@ -0,0 +1,240 @@
+import math
+import torch
+
+# Samplers draw flat voxel indices (C order over the spatial dims of the
+# dataset) in O(k) for a batch of k points. Coordinates and values for the
+# indices are then looked up by Dataset.get_points, so nothing proportional
+# to the number of voxels is allocated per iteration.
+# sample returns (indices, weights), where weights are the per point loss
+# weights that keep the objective equal to the uniform one (None when
+# sampling is already uniform). update receives the per point residuals
+# of the last batch for samplers that adapt to the error.
+
+def gather_points(data, index_grid, indices):
+    # Coordinates [k, n_dims] and values [k, C] of data [1, C, ...] at flat
+    # voxel indices, values are read with an integer gather
+    x = index_grid[indices]
+    y = data.flatten(2)[0].index_select(1, indices).T
+    return x, y
+
+class FeistelPermutation():
+    # Random permutation of [0, n) evaluated at any index without storing
+    # it: a keyed Feistel network is a bijection on [0, 2^bits) and cycle
+    # walking restricts it to [0, n), so the i-th element of the
+    # permutation is computed directly from i. rekey draws a new one.
+    def __init__(self, n, rounds=4):
+        self.n = n
+        self.rounds = rounds
+        bits = max(2, math.ceil(math.log2(max(n, 2))))
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.rekey()
+
+    def rekey(self):
+        self.keys = torch.randint(0, 2**31-1, [self.rounds]).tolist()
+
+    def round_function(self, r, key):
+        # Integer hash, kept below 2^63 so no int64 product overflows
+        h = ((r ^ key) & 0x7FFFFFFF) * 0x9E3779B1
+        h = h ^ (h >> 15)
+        h = (h & 0x7FFFFFFF) * 0x85EBCA77
+        h = h ^ (h >> 13)
+        return h & self.half_mask
+
+    def feistel(self, x):
+        left = x >> self.half_bits
+        right = x & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ self.round_function(right, key)
+        return (left << self.half_bits) | right
+
+    def __call__(self, i):
+        x = self.feistel(i)
+        outside = x >= self.n
+        while(outside.any()):
+            x[outside] = self.feistel(x[outside])
+            outside = x >= self.n
+        return x
+
+class UniformSampler():
+    # Uniform draws without replacement within a batch, as
+    # randperm(n_points_total)[:n_points] but without the O(N)
+    # permutation: the first n_points of a freshly keyed permutation
+    def __init__(self, n_points_total, device):
+        self.n_points_total = n_points_total
+        self.device = device
+        self.permutation = FeistelPermutation(n_points_total)
+
+    def sample(self, n_points):
+        self.permutation.rekey()
+        n_points = min(n_points, self.n_points_total)
+        return self.permutation(torch.arange(n_points, dtype=torch.long,
+            device=self.device)), None
+
+    def update(self, indices, residuals):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+class ReplacementSampler(UniformSampler):
+    # Independent uniform draws with replacement, the cheapest sampler.
+    # A batch holds duplicates once it is a sizeable fraction of the
+    # volume (about 30% for 200k points of a 512^2 image).
+    def sample(self, n_points):
+        return torch.randint(self.n_points_total, [n_points],
+            dtype=torch.long, device=self.device), None
+
+class EpochSampler():
+    # Every voxel is visited exactly once per epoch in a random order, the
+    # order being consumed in slices of n_points. The order is a
+    # FeistelPermutation, rekeyed every epoch.
+    def __init__(self, n_points_total, device, rounds=4):
+        self.n_points_total = n_points_total
+        self.device = device
+        self.permutation = FeistelPermutation(n_points_total, rounds)
+        self.position = 0
+        self.epoch = 1
+
+    def new_epoch(self):
+        self.permutation.rekey()
+        self.position = 0
+        self.epoch += 1
+
+    def sample(self, n_points):
+        samples = []
+        while(n_points > 0):
+            n = min(n_points, self.n_points_total - self.position)
+            samples.append(self.permutation(torch.arange(self.position,
+                self.position+n, dtype=torch.long, device=self.device)))
+            self.position += n
+            n_points -= n
+            if(self.position >= self.n_points_total):
+                self.new_epoch()
+        return torch.cat(samples), None
+
+    def update(self, indices, residuals):
+        pass
+
+    def state_dict(self):
+        return {"keys": list(self.permutation.keys), "position": self.position, 
+            "epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.permutation.keys = list(state['keys'])
+        self.position = state['position']
+        self.epoch = state['epoch']
+
+class ImportanceSampler():
+    # Draws points in proportion to a per brick estimate of the model's
+    # error, mixed with a uniform floor so every voxel keeps a nonzero
+    # probability. A brick is drawn from the mixture, then a voxel uniformly
+    # within it, so voxel i has probability p(i) = P(brick)/voxels(brick)
+    # and the loss weight 1/(N p(i)) makes the weighted mean an unbiased
+    # estimate of the uniform mean. The error estimate is an exponential
+    # moving average of the residuals seen in training batches.
+    def __init__(self, shape, device, brick_size=8, uniform_fraction=0.2,
+        decay=0.1):
+        self.shape = [int(n) for n in shape]
+        self.device = device
+        self.brick_size = brick_size
+        self.uniform_fraction = uniform_fraction
+        self.decay = decay
+        self.n_points_total = 1
+        for n in self.shape:
+            self.n_points_total *= n
+        self.brick_shape = [(n + brick_size - 1) // brick_size for n in self.shape]
+
+        # Voxels per brick, smaller at the upper edges of the volume
+        counts = torch.ones(self.brick_shape, device=device)
+        for axis, n in enumerate(self.shape):
+            extent = torch.full([self.brick_shape[axis]], float(brick_size),
+                device=device)
+            extent[-1] = n - brick_size * (self.brick_shape[axis] - 1)
+            view = [1] * len(self.shape)
+            view[axis] = -1
+            counts = counts * extent.view(view)
+        self.brick_voxels = counts.flatten()
+        self.brick_error = None
+        self.brick_probability = self.brick_voxels / self.n_points_total
+
+    def unravel(self, flat, shape):
+        coords = []
+        for n in reversed(shape):
+            coords.append(flat % n)
+            flat = torch.div(flat, n, rounding_mode='floor')
+        return coords[::-1]
+
+    def ravel(self, coords, shape):
+        flat = torch.zeros_like(coords[0])
+        for c, n in zip(coords, shape):
+            flat = flat * n + c
+        return flat
+
+    def brick_of(self, indices):
+        coords = self.unravel(indices, self.shape)
+        return self.ravel([torch.div(c, self.brick_size, rounding_mode='floor')
+            for c in coords], self.brick_shape)
+
+    def sample(self, n_points):
+        bricks = torch.multinomial(self.brick_probability, n_points,
+            replacement=True)
+        coords = []
+        for axis, b in enumerate(self.unravel(bricks, self.brick_shape)):
+            start = b * self.brick_size
+            extent = (self.shape[axis] - start).clamp(max=self.brick_size)
+            offset = (torch.rand([n_points], device=self.device) * extent).long()
+            coords.append(start + torch.minimum(offset, extent - 1))
+        indices = self.ravel(coords, self.shape)
+        p = self.brick_probability[bricks] / self.brick_voxels[bricks]
+        weights = 1.0 / (self.n_points_total * p)
+        return indices, weights
+
+    @torch.no_grad()
+    def update(self, indices, residuals):
+        bricks = self.brick_of(indices.to(self.device))
+        residuals = residuals.to(self.device).float()
+        if(self.brick_error is None):
+            self.brick_error = torch.full_like(self.brick_voxels,
+                residuals.mean().item())
+        sums = torch.zeros_like(self.brick_error).index_add_(0, bricks, residuals)
+        seen = torch.bincount(bricks, minlength=self.brick_error.shape[0])
+        touched = seen > 0
+        self.brick_error[touched] = (1 - self.decay) * self.brick_error[touched] + \
+            self.decay * sums[touched] / seen[touched]
+
+        error_mass = self.brick_error * self.brick_voxels
+        self.brick_probability = (1 - self.uniform_fraction) * \
+            error_mass / error_mass.sum().clamp(min=1e-12) + \
+            self.uniform_fraction * self.brick_voxels / self.n_points_total
+
+    def state_dict(self):
+        return {"brick_error": self.brick_error, 
+            "brick_probability": self.brick_probability}
+
+    def load_state_dict(self, state):
+        self.brick_error = state['brick_error']
+        if(self.brick_error is not None):
+            self.brick_error = self.brick_error.to(self.device)
+        self.brick_probability = state['brick_probability'].to(self.device)
+
+def create_sampler(opt, shape):
+    n_points_total = 1
+    for n in shape:
+        n_points_total *= int(n)
+    if(opt['sampler'] == "uniform"):
+        return UniformSampler(n_points_total, opt['data_device'])
+    elif(opt['sampler'] == "uniform_replacement"):
+        return ReplacementSampler(n_points_total, opt['data_device'])
+    elif(opt['sampler'] == "epoch"):
+        return EpochSampler(n_points_total, opt['data_device'])
+    elif(opt['sampler'] == "importance"):
+        return ImportanceSampler(shape, opt['data_device'],
+            opt['importance_brick_size'], opt['importance_uniform_fraction'],
+            opt['importance_decay'])
+    else:
+        raise ValueError(f"Unknown sampler {opt['sampler']}")
@@ -0,0 +1,182 @@
+import os
+import json
+import numpy as np
+
+# One pass, chunked statistics of a volume [C, ...]: per channel count,
+# min, max, mean and std, the max of the magnitude over channels, and
+# histograms of every channel and of the magnitude. Chunks are merged with
+# Chan et al.'s parallel variance update, and histograms grow their range
+# by doubling it and merging bin pairs, so counts stay exact without
+# knowing the range up front. Results are persisted next to the data file
+# in <data>.stats.json, keyed by the file's mtime and size.
+
+class StreamingStatistics():
+    def __init__(self, n_channels, bins=256):
+        self.n_channels = n_channels
+        self.bins = bins
+        self.count = 0
+        self.min = np.full([n_channels], np.inf)
+        self.max = np.full([n_channels], -np.inf)
+        self.mean = np.zeros([n_channels])
+        self.m2 = np.zeros([n_channels])
+        self.magnitude_max = 0.0
+        # Channels then the magnitude
+        self.histograms = np.zeros([n_channels+1, bins], dtype=np.int64)
+        self.histogram_low = np.zeros([n_channels+1])
+        self.histogram_width = np.zeros([n_channels+1])
+
+    def grow_histogram(self, i, low, high):
+        # Doubles the range of histogram i until it covers [low, high]
+        if(self.histogram_width[i] == 0):
+            self.histogram_low[i] = low
+            self.histogram_width[i] = max(high - low, 1e-12) * (1 + 1e-6)
+            return
+        while(low < self.histogram_low[i] or
+              high >= self.histogram_low[i] + self.histogram_width[i]):
+            merged = self.histograms[i].reshape(-1, 2).sum(axis=1)
+            zeros = np.zeros_like(merged)
+            if(low < self.histogram_low[i]):
+                self.histograms[i] = np.concatenate([zeros, merged])
+                self.histogram_low[i] -= self.histogram_width[i]
+            else:
+                self.histograms[i] = np.concatenate([merged, zeros])
+            self.histogram_width[i] *= 2
+
+    def add_to_histogram(self, i, values):
+        self.grow_histogram(i, values.min(), values.max())
+        idx = ((values - self.histogram_low[i]) / self.histogram_width[i] *
+            self.bins).astype(np.int64)
+        self.histograms[i] += np.bincount(np.clip(idx, 0, self.bins-1),
+            minlength=self.bins)
+
+    def update(self, chunk):
+        # chunk is a numpy array [C, ...]
+        chunk = np.asarray(chunk, dtype=np.float32).reshape(self.n_channels, -1)
+        n = chunk.shape[1]
+        if(n == 0):
+            return
+        chunk64 = chunk.astype(np.float64)
+        chunk_mean = chunk64.mean(axis=1)
+        chunk_m2 = ((chunk64 - chunk_mean[:, None])**2).sum(axis=1)
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += chunk_m2 + delta**2 * self.count * n / total
+        self.count = total
+        self.min = np.minimum(self.min, chunk.min(axis=1))
+        self.max = np.maximum(self.max, chunk.max(axis=1))
+        magnitude = np.sqrt((chunk64**2).sum(axis=0))
+        self.magnitude_max = max(self.magnitude_max, float(magnitude.max()))
+        for c in range(self.n_channels):
+            self.add_to_histogram(c, chunk[c])
+        self.add_to_histogram(self.n_channels, magnitude)
+
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "mean": self.mean.tolist(),
+            "std": self.std().tolist(),
+            "m2": self.m2.tolist(),
+            "magnitude_max": self.magnitude_max,
+            "bins": self.bins,
+            "histograms": self.histograms.tolist(),
+            "histogram_low": self.histogram_low.tolist(),
+            "histogram_width": self.histogram_width.tolist()
+        }
+
+    def from_dict(d):
+        s = StreamingStatistics(len(d['min']), d['bins'])
+        s.count = d['count']
+        s.min = np.array(d['min'])
+        s.max = np.array(d['max'])
+        s.mean = np.array(d['mean'])
+        s.m2 = np.array(d['m2'])
+        s.magnitude_max = d['magnitude_max']
+        s.histograms = np.array(d['histograms'], dtype=np.int64)
+        s.histogram_low = np.array(d['histogram_low'])
+        s.histogram_width = np.array(d['histogram_width'])
+        return s
+
+    def global_min(self):
+        return float(self.min.min())
+
+    def global_max(self):
+        return float(self.max.max())
+
+    def global_mean(self):
+        return float(self.mean.mean())
+
+    def summary(self):
+        lines = []
+        for c in range(self.n_channels):
+            lines.append(f"channel {c}: min {self.min[c] : 0.04f}, max {self.max[c] : 0.04f}, " + \
+                f"mean {self.mean[c] : 0.04f}, std {self.std()[c] : 0.04f}")
+        lines.append(f"magnitude max {self.magnitude_max : 0.04f}")
+        return "\n".join(lines)
+
+def array_slabs(data, max_slab_voxels=2**22):
+    # Slabs [C, t, ...] along the first spatial axis of an array [C, ...]
+    voxels_per_slice = int(np.prod(data.shape[2:])) * data.shape[0]
+    slab_size = max(1, max_slab_voxels // max(voxels_per_slice, 1))
+    for start in range(0, data.shape[1], slab_size):
+        yield data[:, start:start+slab_size]
+
+def volume_slabs(volume, max_slab_voxels=2**22):
+    # Slabs read from a VolumeReader, only one slab is resident at a time
+    voxels_per_slice = int(np.prod(volume.shape[1:])) * volume.n_channels
+    slab_size = max(1, max_slab_voxels // max(voxels_per_slice, 1))
+    for start in range(0, volume.shape[0], slab_size):
+        end = min(start + slab_size, volume.shape[0])
+        yield volume.read([start] + [0]*(volume.n_dims-1),
+            [end] + volume.shape[1:])
+
+def compute_statistics(slabs, n_channels, bins=256):
+    stats = StreamingStatistics(n_channels, bins)
+    for slab in slabs:
+        stats.update(slab)
+    return stats
+
+def statistics_location(location, field=None):
+    if(field is not None):
+        return f"{location}.{field}.stats.json"
+    return location + ".stats.json"
+
+def load_cached_statistics(location, bins=256, field=None):
+    # Persisted statistics for the data file at location (or its derived
+    # field) if they are still valid, otherwise None
+    stat = os.stat(location)
+    cache = statistics_location(location, field)
+    if(os.path.exists(cache)):
+        with open(cache, 'r') as fp:
+            d = json.load(fp)
+        if(d.get('source_mtime') == stat.st_mtime and
+           d.get('source_size') == stat.st_size and d.get('bins') == bins):
+            return StreamingStatistics.from_dict(d)
+    return None
+
+def load_or_compute_statistics(location, volume, bins=256, field=None):
+    # Persisted statistics if they are still valid, otherwise one streaming
+    # pass over volume
+    stats = load_cached_statistics(location, bins, field)
+    if(stats is not None):
+        return stats
+    stat = os.stat(location)
+    cache = statistics_location(location, field)
+    stats = compute_statistics(volume_slabs(volume), volume.n_channels, bins)
+    d = stats.to_dict()
+    d['source_mtime'] = stat.st_mtime
+    d['source_size'] = stat.st_size
+    try:
+        tmp = f"{cache}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as fp:
+            json.dump(d, fp)
+        os.replace(tmp, cache)
+    except OSError:
+        # Read only data folders still get the statistics, just not cached
+        pass
+    return stats
@@ -0,0 +1,299 @@
+import os
+import json
+import collections
+import abc
+import hashlib
+import tempfile
+import numpy as np
+import torch
+
+# Lazy, chunk addressable access to volume files. A volume is viewed as
+# [C, *spatial] float32 and split into bricks of brick_size^n_dims voxels.
+# Regions are read straight from the file (NetCDF variables or HDF5
+# datasets are hyperslab-sliced, nothing else is loaded), and recently used
+# bricks are kept in an LRU cache. A volume can also be converted once into
+# a raw float32 file with a json sidecar, which later runs memory-map: it
+# opens instantly and the page cache is shared by every process using it.
+# The same raw format in shared memory (/dev/shm) lets concurrent jobs on a
+# node decode a volume once and map the same physical pages.
+
+class VolumeReader(abc.ABC):
+    def __init__(self, location, brick_size=64, cache_bricks=64):
+        self.location = location
+        self.brick_size = brick_size
+        self.cache_bricks = cache_bricks
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shape = []
+        self.channel_names = []
+
+    @property
+    def n_channels(self):
+        return len(self.channel_names)
+
+    @property
+    def n_dims(self):
+        return len(self.shape)
+
+    @abc.abstractmethod
+    def read_channel(self, channel, slices):
+        # Channel c of the region given by a tuple of slices, as numpy
+        pass
+
+    def read(self, starts, ends):
+        # Region [starts, ends) of every channel as a numpy array [C, ...]
+        slices = tuple(slice(s, e) for s, e in zip(starts, ends))
+        region = np.empty([self.n_channels] + [e-s for s, e in zip(starts, ends)],
+            dtype=np.float32)
+        for c in range(self.n_channels):
+            region[c] = self.read_channel(c, slices)
+        return region
+
+    def brick_grid(self):
+        return [(n + self.brick_size - 1) // self.brick_size for n in self.shape]
+
+    def brick_region(self, brick_index):
+        starts = [b * self.brick_size for b in brick_index]
+        ends = [min(s + self.brick_size, n) for s, n in zip(starts, self.shape)]
+        return starts, ends
+
+    def brick(self, brick_index):
+        # Brick at brick_index (a tuple in brick_grid) as [C, ...], cached
+        brick_index = tuple(int(b) for b in brick_index)
+        if(brick_index in self.cache):
+            self.hits += 1
+            self.cache.move_to_end(brick_index)
+            return self.cache[brick_index]
+        self.misses += 1
+        starts, ends = self.brick_region(brick_index)
+        b = self.read(starts, ends)
+        self.cache[brick_index] = b
+        while(len(self.cache) > self.cache_bricks):
+            self.cache.popitem(last=False)
+        return b
+
+    def read_all(self):
+        # The whole volume as a tensor [1, C, ...], read into a single
+        # preallocated buffer one channel at a time
+        d = torch.empty([1, self.n_channels] + self.shape, dtype=torch.float32)
+        buffer = d.numpy()
+        full = tuple(slice(0, n) for n in self.shape)
+        for c in range(self.n_channels):
+            buffer[0, c] = self.read_channel(c, full)
+        return d
+
+    def close(self):
+        self.cache.clear()
+
+class NetCDFVolume(VolumeReader):
+    # Every variable is a channel, as in nc_to_tensor
+    def __init__(self, location, brick_size=64, cache_bricks=64):
+        super().__init__(location, brick_size, cache_bricks)
+        import netCDF4 as nc
+        self.file = nc.Dataset(location, 'r')
+        self.file.set_auto_mask(False)
+        self.channel_names = list(self.file.variables)
+        self.shape = list(self.file[self.channel_names[0]].shape)
+
+    def read_channel(self, channel, slices):
+        return self.file[self.channel_names[channel]][slices]
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+class HDF5Volume(VolumeReader):
+    # Either a single 'data' dataset [C, ...] (as written by tensor_to_h5),
+    # or one dataset per channel
+    def __init__(self, location, brick_size=64, cache_bricks=64):
+        super().__init__(location, brick_size, cache_bricks)
+        import h5py
+        self.file = h5py.File(location, 'r')
+        if('data' in self.file):
+            self.stacked = True
+            self.shape = list(self.file['data'].shape[1:])
+            self.channel_names = [f"channel_{c}" for c in
+                range(self.file['data'].shape[0])]
+        else:
+            self.stacked = False
+            self.channel_names = list(self.file.keys())
+            self.shape = list(self.file[self.channel_names[0]].shape)
+
+    def read_channel(self, channel, slices):
+        if(self.stacked):
+            return self.file['data'][(channel,) + slices]
+        return self.file[self.channel_names[channel]][slices]
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+class RawVolume(VolumeReader):
+    # Raw float32 [C, ...] file described by a json sidecar, memory-mapped
+    # copy-on-write so tensors can wrap it without copying or writing back
+    def __init__(self, location, brick_size=64, cache_bricks=64):
+        super().__init__(location, brick_size, cache_bricks)
+        with open(sidecar_location(location), 'r') as fp:
+            meta = json.load(fp)
+        self.shape = meta['shape']
+        self.channel_names = meta['channel_names']
+        self.memmap = np.memmap(location, dtype=np.float32, mode='c',
+            shape=tuple([self.n_channels] + self.shape))
+
+    def read_channel(self, channel, slices):
+        return self.memmap[(channel,) + slices]
+
+    def brick(self, brick_index):
+        # Slicing the memmap is already free, the page cache does the caching
+        starts, ends = self.brick_region(brick_index)
+        return self.memmap[(slice(None),) +
+            tuple(slice(s, e) for s, e in zip(starts, ends))]
+
+    def read_all(self):
+        return torch.from_numpy(self.memmap).unsqueeze(0)
+
+    def close(self):
+        super().close()
+        del self.memmap
+
+def sidecar_location(raw_location):
+    return raw_location + ".json"
+
+def raw_cache_location(location, field=None):
+    # field names a derived field of the volume, cached next to it
+    if(field is not None):
+        return f"{location}.{field}.raw"
+    return location + ".raw"
+
+def raw_cache_valid(location, field=None):
+    raw = raw_cache_location(location, field)
+    if(not os.path.exists(raw) or not os.path.exists(sidecar_location(raw))):
+        return False
+    with open(sidecar_location(raw), 'r') as fp:
+        meta = json.load(fp)
+    stat = os.stat(location)
+    return meta.get('source_mtime') == stat.st_mtime and \
+        meta.get('source_size') == stat.st_size
+
+def convert_to_raw(reader, raw_location, max_slab_voxels=2**24):
+    # Streams the volume slab by slab along the first spatial axis into a
+    # raw file. Written under temporary names and renamed, so concurrent
+    # jobs never see a partial cache.
+    voxels_per_slice = int(np.prod(reader.shape[1:])) if reader.n_dims > 1 else 1
+    slab_size = max(1, max_slab_voxels // max(voxels_per_slice * reader.n_channels, 1))
+    tmp = f"{raw_location}.{os.getpid()}.tmp"
+    out = np.memmap(tmp, dtype=np.float32, mode='w+',
+        shape=tuple([reader.n_channels] + reader.shape))
+    for start in range(0, reader.shape[0], slab_size):
+        end = min(start + slab_size, reader.shape[0])
+        out[:, start:end] = reader.read([start] + [0]*(reader.n_dims-1),
+            [end] + reader.shape[1:])
+    out.flush()
+    del out
+    stat = os.stat(reader.location)
+    meta = {
+        "shape": reader.shape,
+        "channel_names": reader.channel_names,
+        "dtype": "float32",
+        "source": os.path.abspath(reader.location),
+        "source_mtime": stat.st_mtime,
+        "source_size": stat.st_size
+    }
+    with open(tmp + ".json", 'w') as fp:
+        json.dump(meta, fp, indent=4)
+    os.replace(tmp, raw_location)
+    os.replace(tmp + ".json", sidecar_location(raw_location))
+
+def shared_memory_folder():
+    if(os.path.isdir("/dev/shm")):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def shared_memory_prefix(token=None):
+    # Segments created with a token (one per job sweep, see start_jobs.py)
+    # are only shared within, and removed with, that sweep
+    if(token):
+        return f"gmminr_volume_{token}_"
+    return "gmminr_volume_"
+
+def shared_memory_location(location, token=None):
+    # Segment name keyed by the absolute path of the source, then by its
+    # mtime and size, so a modified file never maps a stale segment and
+    # the segments of older versions can be found and removed
+    stat = os.stat(location)
+    path_key = hashlib.sha1(os.path.abspath(location).encode()).hexdigest()[:16]
+    version_key = hashlib.sha1(f"{stat.st_mtime}:{stat.st_size}".encode()).hexdigest()[:8]
+    return os.path.join(shared_memory_folder(), 
+        f"{shared_memory_prefix(token)}{path_key}_{version_key}.raw")
+
+def remove_stale_shared_volumes(raw):
+    # Removes the segments of older versions of the same source. Jobs that
+    # still map one keep their pages until they unmap it.
+    folder, name = os.path.split(raw)
+    source_prefix = name[:name.rindex("_")+1]
+    for f in os.listdir(folder):
+        if(f.startswith(source_prefix) and not f.startswith(name)):
+            try:
+                os.remove(os.path.join(folder, f))
+            except FileNotFoundError:
+                pass
+
+def open_shared_volume(location, reader, brick_size=64, cache_bricks=64,
+    token=None):
+    # The first job to get the lock decodes the volume into the shared
+    # segment, the others wait for it and then attach to the same pages
+    try:
+        import fcntl
+    except ImportError:
+        raise RuntimeError("shared_memory_data needs POSIX file locks (fcntl), " + \
+            "which this platform does not have. Use volume_cache instead.")
+    raw = shared_memory_location(location, token)
+    with open(raw + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if(not os.path.exists(sidecar_location(raw))):
+            print(f"Creating shared volume {raw}")
+            remove_stale_shared_volumes(raw)
+            source = reader(location, brick_size, cache_bricks)
+            convert_to_raw(source, raw)
+            source.close()
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return RawVolume(raw, brick_size, cache_bricks)
+
+def remove_shared_volumes(token):
+    # Frees the shared volume segments (and their lock files) created with
+    # token, leaving those of other sweeps and jobs on the node alone
+    folder = shared_memory_folder()
+    prefix = shared_memory_prefix(token)
+    for f in os.listdir(folder):
+        if(f.startswith(prefix)):
+            try:
+                os.remove(os.path.join(folder, f))
+            except FileNotFoundError:
+                pass
+
+def open_volume(location, use_cache=False, brick_size=64, cache_bricks=64,
+    shared_memory=False, shared_memory_token=None):
+    # Reader for a .nc or .h5 volume. With use_cache, the raw memory-mapped
+    # cache next to the file is used, and created on first use or when the
+    # source file has changed. With shared_memory, the node-wide shared
+    # segment for the file (and shared_memory_token) is used instead.
+    ext = os.path.splitext(location)[1].lower()
+    if(ext == ".nc"):
+        reader = NetCDFVolume
+    elif(ext in [".h5", ".hdf5"]):
+        reader = HDF5Volume
+    else:
+        raise ValueError(f"Unsupported volume format {ext}")
+
+    if(shared_memory):
+        return open_shared_volume(location, reader, brick_size, cache_bricks,
+            shared_memory_token)
+    if(not use_cache):
+        return reader(location, brick_size, cache_bricks)
+    if(not raw_cache_valid(location)):
+        print(f"Creating raw volume cache {raw_cache_location(location)}")
+        source = reader(location, brick_size, cache_bricks)
+        convert_to_raw(source, raw_cache_location(location))
+        source.close()
+    return RawVolume(raw_cache_location(location), brick_size, cache_bricks)
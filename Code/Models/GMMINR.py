@@ -3,7 +3,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from Other.utility_functions import make_coord_grid    
+from Other.utility_functions import make_coord_grid, CoordGrid
+from Other.profiling import null_profiler
+from Models import gaussians
 
 class LReLULayer(nn.Module):
     def __init__(self, in_features, out_features, bias=True):
@@ -95,6 +97,8 @@ class GMMINR(nn.Module):
         super().__init__()
         
         self.opt = opt
+        # Phase timers, set by train() when profiling
+        self.profiler = null_profiler
         
         # Generate random centers for the gaussians
         self.gaussian_centers = torch.nn.parameter.Parameter(
@@ -114,9 +118,24 @@ class GMMINR(nn.Module):
         cov = torch.bmm(torch.bmm(Q, S), Q.mT)
 
         # Convert to a precision matrix (stabilizes training)
-        self.gaussian_precision = torch.nn.parameter.Parameter(
-            torch.linalg.inv(cov) 
-        ) 
+        # Optionally store the lower triangular cholesky factor L of 
+        # the precision P = L L^T instead of P itself
+        if(opt['covariance_parameterization'] == "cholesky"):
+            self.gaussian_precision_cholesky = torch.nn.parameter.Parameter(
+                torch.linalg.cholesky(torch.linalg.inv(cov))
+            )
+        else:
+            self.gaussian_precision = torch.nn.parameter.Parameter(
+                torch.linalg.inv(cov) 
+            ) 
+        # Precision and normalization constants, reused without recomputing
+        # until the covariance parameters change
+        self.gaussian_cache = None
+        self.gaussian_cache_key = None
+
+        # Feature grid evaluated from the gaussians once for fast inference,
+        # see bake()
+        self.baked_features = None
 
         # Generate random starting features for each gaussian        
         self.gaussian_features = torch.nn.parameter.Parameter(
@@ -126,6 +145,13 @@ class GMMINR(nn.Module):
             ).normal_(0, 1)
         )
         self.pe = PositionalEncoding(opt)
+
+        # Optional spatial acceleration structure to skip gaussians
+        # that are more than culling_sigma standard deviations away
+        self.gaussian_grid = None
+        if(opt['gaussian_culling']):
+            self.gaussian_grid = gaussians.GaussianGrid(
+                opt['culling_grid_resolution'], opt['culling_sigma'])
         
         self.decoder = nn.ModuleList()
         #first_layer_input_size = opt['num_positional_encoding_terms']*opt['n_dims']*2
@@ -155,67 +181,164 @@ class GMMINR(nn.Module):
         
         self.network_parameters = [param for param in self.decoder.parameters()]
         self.network_parameters.append(self.gaussian_features)
+
+    def uses_cholesky(self):
+        return self.opt['covariance_parameterization'] == "cholesky"
+
+    def covariance_parameters(self):
+        if(self.uses_cholesky()):
+            return [self.gaussian_precision_cholesky]
+        return [self.gaussian_precision]
+
+    def get_precision(self):
+        if(self.uses_cholesky()):
+            return gaussians.cholesky_to_precision(self.gaussian_precision_cholesky)
+        return self.gaussian_precision
+
+    def precision_and_log_coefficients(self):
+        # Cached when no gradient is needed (inference, logging, chunked
+        # evaluation) and recomputed once the parameters are updated.
+        # With gradients enabled they are computed once per forward, which
+        # is once per optimizer step during training.
+        p = self.covariance_parameters()[0]
+        key = (p.data_ptr(), p._version, p.shape[0])
+        if(not torch.is_grad_enabled() and self.gaussian_cache_key == key):
+            return self.gaussian_cache
+        precision = self.get_precision()
+        if(self.uses_cholesky()):
+            log_coeff = gaussians.cholesky_log_coefficients(
+                self.gaussian_precision_cholesky)
+        else:
+            log_coeff = gaussians.gaussian_log_coefficients(precision)
+        if(not torch.is_grad_enabled()):
+            self.gaussian_cache = (precision, log_coeff)
+            self.gaussian_cache_key = key
+        return precision, log_coeff
+
+    def load_state_dict(self, state_dict, strict=True):
+        # Convert checkpoints saved with the other covariance parameterization
+        state_dict = dict(state_dict)
+        if(self.uses_cholesky() and "gaussian_precision" in state_dict):
+            state_dict['gaussian_precision_cholesky'] = \
+                gaussians.precision_to_cholesky(state_dict.pop('gaussian_precision'))
+        elif(not self.uses_cholesky() and "gaussian_precision_cholesky" in state_dict):
+            state_dict['gaussian_precision'] = \
+                gaussians.cholesky_to_precision(state_dict.pop('gaussian_precision_cholesky'))
+        self.gaussian_cache_key = None
+        return super().load_state_dict(state_dict, strict)
+
+    def gaussian_feature_vectors(self, x):
+        precision, log_coeff = self.precision_and_log_coefficients()
+        if(self.gaussian_grid is not None):
+            return gaussians.culled_gaussian_features(x, 
+                self.gaussian_centers, precision,
+                self.gaussian_features, self.gaussian_grid, log_coeff,
+                self.gaussian_precision_cholesky if self.uses_cholesky() else None)
+        if(self.opt['gaussian_tile_size'] > 0):
+            return gaussians.tiled_gaussian_features(x, 
+                self.gaussian_centers, precision,
+                self.gaussian_features, self.opt['gaussian_tile_size'], log_coeff)
+        return gaussians.gaussian_features(x, 
+            self.gaussian_centers, precision,
+            self.gaussian_features, log_coeff)
+
+    def gaussian_weights_at(self, x):
+        # Density of every gaussian at every point, [N, G]
+        precision, log_coeff = self.precision_and_log_coefficients()
+        return gaussians.gaussian_weights(x, 
+            self.gaussian_centers, precision, log_coeff)
+
+    def culled_gaussian_weights_at(self, x):
+        # Density of the gaussians overlapping each point, as sparse
+        # (point, gaussian, weight) lists, see culled_gaussian_weights
+        precision, log_coeff = self.precision_and_log_coefficients()
+        return gaussians.culled_gaussian_weights(x, 
+            self.gaussian_centers, precision, self.gaussian_grid, log_coeff,
+            self.gaussian_precision_cholesky if self.uses_cholesky() else None)
+
+    def gaussian_density_at(self, x):
+        precision, log_coeff = self.precision_and_log_coefficients()
+        if(self.gaussian_grid is not None):
+            return gaussians.culled_gaussian_density(x, 
+                self.gaussian_centers, precision,
+                self.gaussian_grid, log_coeff,
+                self.gaussian_precision_cholesky if self.uses_cholesky() else None)
+        if(self.opt['gaussian_tile_size'] > 0):
+            return gaussians.tiled_gaussian_density(x, 
+                self.gaussian_centers, precision,
+                self.opt['gaussian_tile_size'], log_coeff)
+        return gaussians.gaussian_density(x, 
+            self.gaussian_centers, precision, log_coeff)
     
-    def gaussian_density(self, grid):
+    def gaussian_density(self, grid, max_points=100000):
         
         if(self.opt['n_gaussians'] == 0):
             return torch.zeros([grid[0], grid[1], 3])
 
         
-        x = make_coord_grid(
-            grid, 
-            self.opt['data_device'],
-            flatten=False,
+        x = CoordGrid(grid, self.opt['data_device'],
             align_corners=self.opt['align_corners'])
-        x_shape = list(x.shape)
-        x_shape[-1] = 1
-        x = x.flatten(0,1)                
-        x = x.unsqueeze(1).repeat(1,self.opt['n_gaussians'],1)
-        
-        coeff = 1 / (((2* np.pi)**(self.opt['n_dims']/2)) * \
-            (torch.linalg.det(torch.linalg.inv(self.gaussian_precision))**(1/2)))
-        exp_part =  torch.exp((-1/2) * \
-            ((x-self.gaussian_centers.unsqueeze(0)).unsqueeze(-1).mT\
-                .matmul(self.gaussian_precision.unsqueeze(0)))\
-                    .matmul((x-self.gaussian_centers.unsqueeze(0)).unsqueeze(-1))).squeeze()
-        result = coeff.unsqueeze(0) * exp_part
-        
-        result = result.sum(dim=1, keepdim=True).reshape(x_shape)
+        x_shape = list(grid) + [1]
+        
+        result = torch.empty([len(x), 1], device=self.opt['device'])
+        for start in range(0, len(x), max_points):
+            end = min(start+max_points, len(x))
+            result[start:end] = self.gaussian_density_at(
+                x[start:end].to(self.opt['device']))
+        
+        result = result.reshape(x_shape)
         result /= result.max()
         return result
         
+    @torch.no_grad()
+    def bake(self, resolution, max_points=100000):
+        # Evaluates the (scaled) gaussian feature field once on a grid with
+        # the given resolution. Until unbake() is called, forward trilinearly
+        # interpolates features from this grid instead of evaluating every
+        # gaussian, so sample_grid, forward_maxpoints and everything else
+        # built on forward use it. Inference only, gaussians are not trained
+        # through the grid. The grid always aligns corners so that its
+        # nodes span [-1, 1] regardless of opt['align_corners'].
+        if(self.opt['n_gaussians'] == 0):
+            return
+        self.baked_features = None
+        coords = make_coord_grid(resolution, self.opt['device'],
+            flatten=True, align_corners=True)
+        grid = torch.empty([coords.shape[0], self.opt['n_features']],
+            device=self.opt['device'])
+        for start in range(0, coords.shape[0], max_points):
+            end = min(start+max_points, coords.shape[0])
+            grid[start:end] = self.gaussian_feature_vectors(coords[start:end])
+        grid *= ((6/self.opt['n_gaussians'])**0.5)
+        self.baked_features = grid.T.reshape(
+            [1, self.opt['n_features']] + list(resolution))
+
+    def unbake(self):
+        self.baked_features = None
+
+    def baked_feature_vectors(self, x):
+        grid_shape = [1, x.shape[0]] + [1]*(x.shape[1]-1) + [x.shape[1]]
+        features = F.grid_sample(self.baked_features, x.view(grid_shape),
+            mode='bilinear', align_corners=True)
+        return features.view(self.baked_features.shape[1], -1).T
+
     def forward(self, x):     
         
         #decoder_input = self.pe(x)
         decoder_input = x
         
         if(self.opt['n_gaussians'] > 0):
-            
-            gauss_dist = x.unsqueeze(1).repeat(1,self.opt['n_gaussians'],1)
-            coeff = 1 / (((2* np.pi)**(self.opt['n_dims']/2)) * \
-                (torch.linalg.det(torch.linalg.inv(self.gaussian_precision))**(1/2)))
-            
+            with self.profiler.phase("gaussians"):
+                if(self.baked_features is not None):
+                    feature_vectors = self.baked_feature_vectors(x)
+                else:
+                    feature_vectors = self.gaussian_feature_vectors(x)
+                    feature_vectors *= ((6/self.opt['n_gaussians'])**0.5)
 
-            exp_part = torch.exp((-1/2) * \
-                ((gauss_dist-self.gaussian_centers.unsqueeze(0)).unsqueeze(-1).mT\
-                    .matmul(self.gaussian_precision.unsqueeze(0)))\
-                        .matmul((gauss_dist-self.gaussian_centers.unsqueeze(0)).unsqueeze(-1))).squeeze()
-            result = coeff.unsqueeze(0) * exp_part
-            #print(f"result: {result.min()} {result.max()}")
-            feature_vectors = torch.matmul(result.unsqueeze(1),
-                            self.gaussian_features.unsqueeze(0)).squeeze()
-            feature_vectors *= ((6/self.opt['n_gaussians'])**0.5)
-
-            #print(f"feature: {self.gaussian_features[0]}")
-            #print(f"mean: {self.gaussian_features.mean(dim=1)[0]}")
-            #print(f"std: {self.gaussian_features.std(dim=1)[0]}")
-
-            #print(f"exp_part: {exp_part.min():0.02f} {exp_part.max():0.02f}")
-            #print(f"after exp: {torch.exp(exp_part.squeeze()).min():0.02f} {torch.exp(exp_part.squeeze()).max():0.02f}")
-            decoder_input = torch.cat([feature_vectors, decoder_input], dim=1)
-            
-        y = self.decoder(decoder_input)   
-        #print(f"y terms: {y.min():0.02f} {y.max():0.02f}")
+                decoder_input = torch.cat([feature_vectors, decoder_input], dim=1)
+        
+        with self.profiler.phase("decoder"):
+            y = self.decoder(decoder_input)   
 
         return y
 
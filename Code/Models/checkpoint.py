@@ -0,0 +1,154 @@
+import os
+import json
+import random
+import threading
+import queue
+import numpy as np
+import torch
+
+# Full training checkpoints, written every save_every iterations. A
+# checkpoint holds everything train() needs to continue exactly where it
+# stopped: the model, the three optimizers and schedulers, the density
+# controller and sampler state, every RNG state and the iteration.
+# training_state copies all of it to the CPU on the training thread, and
+# a CheckpointWriter serializes the copy in the background. Every file is
+# written under a temporary name and renamed, so a crash mid-write leaves
+# the previous checkpoint intact. model.ckpt.tar and options.json are
+# rewritten after it for load_model and load_options, but a crash between
+# the renames can leave them a checkpoint behind, so resuming takes the
+# options and weights from checkpoint.tar.
+
+def checkpoint_location(folder):
+    return os.path.join(folder, "checkpoint.tar")
+
+def to_cpu(obj):
+    # Copy of obj with every tensor copied to the CPU, recursively
+    if(torch.is_tensor(obj)):
+        return obj.detach().to("cpu", copy=True)
+    if(isinstance(obj, dict)):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if(isinstance(obj, (list, tuple))):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def rng_state():
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "numpy": np.random.get_state(),
+        "random": random.getstate()
+    }
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if(torch.cuda.is_available() and len(state['cuda']) > 0):
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+def training_state(iteration, model, optimizers, schedulers,
+    density_controller, sampler=None, data_state=None):
+    # CPU snapshot after the given iteration has finished. data_state
+    # replaces the current sampler and RNG state when batches are drawn
+    # ahead, see BatchPrefetcher.consumed_state.
+    if(data_state is not None):
+        state = training_state(iteration, model, optimizers, schedulers,
+            density_controller)
+        state['sampler'] = data_state['sampler']
+        state['rng'] = data_state['rng']
+        return state
+    return to_cpu({
+        "iteration": iteration,
+        "opt": dict(model.opt),
+        "model": model.state_dict(),
+        "optimizers": [o.state_dict() for o in optimizers],
+        "schedulers": [s.state_dict() for s in schedulers],
+        "density_control": density_controller.state_dict(),
+        "sampler": sampler.state_dict() if sampler is not None else None,
+        "rng": rng_state()
+    })
+
+def restore_training_state(checkpoint, optimizers, schedulers,
+    density_controller, sampler=None):
+    # Restores everything but the model, which load_model already loaded.
+    # Returns the first iteration to train.
+    if(len(optimizers) != len(checkpoint['optimizers'])):
+        raise ValueError(f"Checkpoint has {len(checkpoint['optimizers'])} optimizers, " + \
+            f"training uses {len(optimizers)}, was parameter_layout changed?")
+    for o, state in zip(optimizers, checkpoint['optimizers']):
+        o.load_state_dict(state)
+    for s, state in zip(schedulers, checkpoint['schedulers']):
+        # The StepLR schedules follow the current opt['iterations'], which
+        # the schedulers were built with. The checkpoint only provides the
+        # position, so resuming with more iterations decays at the new
+        # step size, recomputed from the start of the run.
+        step_size = s.step_size
+        s.load_state_dict(state)
+        if(s.step_size != step_size):
+            s.step_size = step_size
+            for group, base_lr in zip(s.optimizer.param_groups, s.base_lrs):
+                group['lr'] = base_lr * s.gamma ** (s.last_epoch // step_size)
+            s._last_lr = [group['lr'] for group in s.optimizer.param_groups]
+    density_controller.load_state_dict(checkpoint['density_control'])
+    if(sampler is not None and checkpoint['sampler'] is not None):
+        sampler.load_state_dict(checkpoint['sampler'])
+    set_rng_state(checkpoint['rng'])
+    return checkpoint['iteration'] + 1
+
+def load_checkpoint(folder):
+    location = checkpoint_location(folder)
+    if(not os.path.exists(location)):
+        return None
+    # Holds numpy and python RNG states, not only tensors
+    return torch.load(location, map_location="cpu", weights_only=False)
+
+def atomic_save(obj, location):
+    tmp = f"{location}.{os.getpid()}.tmp"
+    torch.save(obj, tmp, pickle_protocol=4)
+    os.replace(tmp, location)
+
+def write_checkpoint(state, folder):
+    os.makedirs(folder, exist_ok=True)
+    atomic_save(state, checkpoint_location(folder))
+    atomic_save({'state_dict': state['model']},
+        os.path.join(folder, "model.ckpt.tar"))
+    tmp = os.path.join(folder, f"options.json.{os.getpid()}.tmp")
+    with open(tmp, 'w') as fp:
+        json.dump(state['opt'], fp, sort_keys=True, indent=4)
+    os.replace(tmp, os.path.join(folder, "options.json"))
+
+class CheckpointWriter():
+    # Serializes snapshots on a background thread. At most one snapshot
+    # waits behind the one being written; save blocks beyond that rather
+    # than dropping a checkpoint.
+    def __init__(self, folder):
+        self.folder = folder
+        self.snapshots = queue.Queue(maxsize=1)
+        self.error = None
+        self.saved = 0
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def worker(self):
+        while(True):
+            state = self.snapshots.get()
+            if(state is None):
+                break
+            try:
+                write_checkpoint(state, self.folder)
+                self.saved += 1
+            except Exception as e:
+                self.error = e
+                print(f"Checkpoint failed: {e!r}")
+
+    def save(self, state):
+        if(self.error is not None):
+            raise self.error
+        self.snapshots.put(state)
+
+    def close(self):
+        # Waits for the queued checkpoints to be written
+        self.snapshots.put(None)
+        self.thread.join()
+        if(self.error is not None):
+            raise self.error
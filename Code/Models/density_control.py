@@ -0,0 +1,198 @@
+import torch
+from Models import gaussians
+
+# Adaptive density control for the gaussians in a GMMINR model.
+# Every density_control_every iterations the gaussians that contribute
+# (almost) nothing are pruned, and the gaussians covering the regions with
+# the highest reconstruction error are split (large gaussians) or
+# cloned (small gaussians). The optimizer states of every resized
+# parameter are updated the same way so Adam's moments stay aligned
+# with their gaussians.
+
+class DensityController():
+    def __init__(self, opt):
+        self.opt = opt
+        self.feature_grad_sum = None
+        self.n_accumulated = 0
+
+    def state_dict(self):
+        return {"feature_grad_sum": self.feature_grad_sum,
+            "n_accumulated": self.n_accumulated}
+
+    def load_state_dict(self, state):
+        self.feature_grad_sum = state['feature_grad_sum']
+        if(self.feature_grad_sum is not None):
+            self.feature_grad_sum = self.feature_grad_sum.to(self.opt['device'])
+        self.n_accumulated = state['n_accumulated']
+
+    def enabled(self, iteration):
+        return self.opt['density_control_every'] > 0 and \
+            self.opt['n_gaussians'] > 0 and \
+            iteration < self.opt['iterations'] * self.opt['density_control_until']
+
+    @torch.no_grad()
+    def accumulate(self, model):
+        # Called after backward to track how much each gaussian's
+        # features matter to the loss
+        if(model.gaussian_features.grad is None):
+            return
+        g = model.gaussian_features.grad.norm(dim=1)
+        if(self.feature_grad_sum is None or
+           self.feature_grad_sum.shape[0] != g.shape[0]):
+            self.feature_grad_sum = torch.zeros_like(g)
+            self.n_accumulated = 0
+        self.feature_grad_sum += g
+        self.n_accumulated += 1
+
+    @torch.no_grad()
+    def statistics(self, model, dataset, n_points, max_weights=2**22):
+        # Per gaussian weight contribution and density weighted residual
+        # from one batch of points. Points are processed in chunks whose
+        # [points, gaussians] weights stay within max_weights elements, or
+        # as sparse (point, gaussian) pairs when the model culls gaussians.
+        data = dataset.get_random_points(n_points)
+        x = data['inputs'].to(self.opt['device'])
+        y = data['data'].to(self.opt['device'])
+        n_gaussians = model.gaussian_centers.shape[0]
+        weight_sum = torch.zeros([n_gaussians], device=self.opt['device'])
+        residual_sum = torch.zeros([n_gaussians], device=self.opt['device'])
+        chunk_size = max(1, max_weights // max(n_gaussians, 1))
+        for start in range(0, x.shape[0], chunk_size):
+            end = min(start+chunk_size, x.shape[0])
+            residual = (model(x[start:end]) - y[start:end]).abs().mean(dim=1)
+            if(model.gaussian_grid is not None):
+                point_ids, gaussian_ids, w = model.culled_gaussian_weights_at(
+                    x[start:end])
+                weight_sum.index_add_(0, gaussian_ids, w)
+                residual_sum.index_add_(0, gaussian_ids, w * residual[point_ids])
+            else:
+                w = model.gaussian_weights_at(x[start:end])
+                weight_sum += w.sum(dim=0)
+                residual_sum += torch.matmul(residual, w)
+        feature_norm = model.gaussian_features.norm(dim=1)
+        contribution = weight_sum * feature_norm / x.shape[0]
+        residual = residual_sum / (weight_sum + 1e-12)
+        return contribution, residual
+
+    def due(self, iteration):
+        # Whether step prunes and densifies at this iteration
+        return self.enabled(iteration) and iteration > 0 and \
+            iteration % self.opt['density_control_every'] == 0
+
+    @torch.no_grad()
+    def step(self, model, dataset, optimizers, iteration):
+        if(not self.due(iteration)):
+            return
+
+        contribution, residual = self.statistics(model, dataset,
+            self.opt['points_per_iteration'])
+
+        # Prune gaussians whose contribution or feature gradient is
+        # negligible relative to the average gaussian
+        threshold = self.opt['prune_threshold']
+        prune = contribution < threshold * contribution.mean()
+        if(self.feature_grad_sum is not None and
+           self.feature_grad_sum.shape[0] == prune.shape[0]):
+            prune |= self.feature_grad_sum < threshold * self.feature_grad_sum.mean()
+        keep = ~prune
+        if(keep.sum() == 0):
+            keep[contribution.argmax()] = True
+
+        # Densify the kept gaussians with the highest residual
+        n_kept = int(keep.sum().item())
+        n_new = min(int(n_kept * self.opt['densify_fraction']),
+            self.opt['max_gaussians'] - n_kept)
+        n_new = max(n_new, 0)
+        kept_ids = torch.nonzero(keep).flatten()
+        densify_ids = kept_ids[torch.topk(residual[kept_ids], n_new).indices]
+
+        densify_gaussians(model, optimizers, keep, densify_ids)
+        self.feature_grad_sum = None
+        self.n_accumulated = 0
+        print(f"Density control: pruned {int(prune.sum().item())}, " + \
+            f"densified {n_new}, {model.gaussian_centers.shape[0]} gaussians")
+
+def resize_parameter(model, name, optimizers, index, new_values):
+    # Replaces the parameter model.<name> with a new Parameter holding
+    # cat(param[index], new_values), and swaps it into the optimizers with
+    # any per-gaussian optimizer state indexed the same way (new gaussians
+    # start at zero). Autograd caches the shape of a Parameter, so resizing
+    # param.data in place is not enough.
+    old = getattr(model, name)
+    new = torch.nn.parameter.Parameter(
+        torch.cat([old.data[index], new_values], dim=0))
+    for optimizer in optimizers:
+        for group in optimizer.param_groups:
+            group['params'] = [new if p is old else p for p in group['params']]
+        if(old not in optimizer.state):
+            continue
+        state = optimizer.state.pop(old)
+        for k in state.keys():
+            if(torch.is_tensor(state[k]) and state[k].dim() > 0 and
+               state[k].shape[0] == old.shape[0]):
+                state[k] = torch.cat([state[k][index],
+                    torch.zeros_like(new_values)], dim=0)
+        optimizer.state[new] = state
+    model.network_parameters = [new if p is old else p 
+        for p in model.network_parameters]
+    setattr(model, name, new)
+
+def densify_gaussians(model, optimizers, keep, densify_ids,
+    split_scale=1.6):
+    centers = model.gaussian_centers.data
+    precision = model.get_precision().data
+    features = model.gaussian_features.data
+    n_dims = centers.shape[1]
+    old_count = centers.shape[0]
+
+    # Large gaussians are split into two smaller children, small gaussians
+    # are cloned. The two children sit symmetrically around the parent at a
+    # sample drawn from it and each take half of its features, so the
+    # field is roughly unchanged.
+    L = gaussians.precision_to_cholesky(precision[densify_ids])
+    z = torch.randn([densify_ids.shape[0], n_dims, 1], device=centers.device)
+    offset = torch.linalg.solve_triangular(L.mT, z, upper=True).squeeze(-1)
+    std = torch.diagonal(torch.linalg.inv_ex(precision[densify_ids])[0],
+        dim1=-2, dim2=-1).clamp(min=0).sqrt().max(dim=1).values
+    split = std > std.median() if std.shape[0] > 0 else std > 0
+    scale = torch.where(split, split_scale, 1.0)
+    offset *= torch.where(split, 1.0, 0.5).unsqueeze(-1)
+
+    # Each parent is replaced by its first child, the second is appended
+    child_centers = torch.cat([centers[densify_ids] + offset,
+        centers[densify_ids] - offset], dim=0)
+    child_features = features[densify_ids].repeat(2, 1) * 0.5
+    child_scale = scale.repeat(2)
+
+    keep = keep.clone()
+    keep[densify_ids] = False
+    index = torch.nonzero(keep).flatten()
+    optimizers = [o for o in optimizers if o is not None]
+
+    resize_parameter(model, "gaussian_centers", optimizers, index, child_centers)
+    if(model.uses_cholesky()):
+        child_cov = model.gaussian_precision_cholesky.data[densify_ids].repeat(2, 1, 1) * \
+            child_scale.view(-1, 1, 1)
+        resize_parameter(model, "gaussian_precision_cholesky", optimizers,
+            index, child_cov)
+    else:
+        child_cov = model.gaussian_precision.data[densify_ids].repeat(2, 1, 1) * \
+            (child_scale**2).view(-1, 1, 1)
+        resize_parameter(model, "gaussian_precision", optimizers,
+            index, child_cov)
+
+    # Features are scaled by sqrt(6/n_gaussians) in forward, so rescale
+    # them to keep the output of the remaining gaussians unchanged. Their
+    # gradients shrink by the same factor, so Adam's moments are rescaled
+    # to match the gradients they will be blended with.
+    new_count = index.shape[0] + child_centers.shape[0]
+    feature_scale = (new_count / old_count)**0.5
+    resize_parameter(model, "gaussian_features", optimizers, index, child_features)
+    model.gaussian_features.data *= feature_scale
+    for optimizer in optimizers:
+        state = optimizer.state.get(model.gaussian_features, {})
+        if('exp_avg' in state):
+            state['exp_avg'] /= feature_scale
+        if('exp_avg_sq' in state):
+            state['exp_avg_sq'] /= feature_scale**2
+    model.opt['n_gaussians'] = new_count
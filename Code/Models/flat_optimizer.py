@@ -0,0 +1,193 @@
+import torch
+
+# Adam over every parameter of every group at once. The parameters are
+# packed into one contiguous flat buffer (each Parameter's .data becomes a
+# view of it), as are their gradients and both of Adam's moments, so a
+# step is a few element-wise ops over the whole buffer instead of several
+# per tensor and per optimizer. Groups keep their own learning rate, which
+# is applied to the group's contiguous segment of the buffer. The update
+# is the same as torch.optim.Adam's (without weight decay, amsgrad or
+# maximize). As there, a parameter that received no gradient since the
+# last zero_grad is skipped, its moments and step count unchanged: a hook
+# marks the parameters autograd accumulates into, and a step with any
+# unmarked parameter updates segment by segment instead of the whole
+# buffer at once.
+#
+# param_groups and state stay the source of truth. Density control swaps
+# resized Parameters and their state into them (see resize_parameter) and
+# load_state_dict replaces the state, so the buffers are repacked whenever
+# the parameters no longer match the packed ones.
+
+# Every parameter starts at a multiple of this many bytes in the buffer,
+# as its own allocation would, so kernels that need aligned inputs for
+# vectorized loads keep their fast path
+alignment = 64
+
+def aligned(n, element_size):
+    k = max(1, alignment // element_size)
+    return (n + k - 1) // k * k
+
+def grad_marker(has_grad, i):
+    # Hook run after autograd accumulated into parameter i. It holds the
+    # flag list, not the optimizer, so hooks do not keep optimizers alive.
+    def mark(p):
+        has_grad[i] = True
+    return mark
+
+class FlatAdam(torch.optim.Optimizer):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps))
+        for group in self.param_groups:
+            if(tuple(group['betas']) != tuple(betas) or group['eps'] != eps):
+                raise ValueError("FlatAdam only supports a learning rate per group, " + \
+                    "betas and eps are shared")
+        self.params = []
+        self.hooks = []
+        self.pack()
+
+    def is_packed(self):
+        i = 0
+        for group in self.param_groups:
+            for p in group['params']:
+                if(i >= len(self.params) or p is not self.params[i]):
+                    return False
+                i += 1
+        return i == len(self.params)
+
+    @torch.no_grad()
+    def pack(self):
+        # Copies the parameters, gradients and moments into new flat
+        # buffers and makes them views of those
+        params = [p for group in self.param_groups for p in group['params']]
+        if(len(set((p.device, p.dtype) for p in params)) > 1):
+            raise ValueError("FlatAdam needs every parameter on one device with one dtype")
+        device = params[0].device if len(params) > 0 else "cpu"
+        dtype = params[0].dtype if len(params) > 0 else torch.float32
+        element_size = torch.empty([], dtype=dtype).element_size()
+        n = sum(aligned(p.numel(), element_size) for p in params)
+        # Padding between parameters stays zero
+        self.flat = torch.zeros([n], device=device, dtype=dtype)
+        self.grad = torch.zeros([n], device=device, dtype=dtype)
+        self.exp_avg = torch.zeros([n], device=device, dtype=dtype)
+        self.exp_avg_sq = torch.zeros([n], device=device, dtype=dtype)
+        self.denom = torch.empty([n], device=device, dtype=dtype)
+
+        for h in self.hooks:
+            h.remove()
+        self.params = params
+        self.grads = []
+        self.segments = []
+        self.has_grad = []
+        self.hooks = []
+        start = 0
+        for group in self.param_groups:
+            # Checkpoints from before per parameter step counts kept one
+            # per group
+            group_step = group.pop('step', 0)
+            for p in group['params']:
+                end = start + p.numel()
+                self.flat[start:end].copy_(p.data.reshape(-1))
+                self.has_grad.append(p.grad is not None)
+                if(p.grad is not None):
+                    self.grad[start:end].copy_(p.grad.reshape(-1))
+                state = self.state[p]
+                state.setdefault('step', group_step)
+                for k in ["exp_avg", "exp_avg_sq"]:
+                    if(k in state):
+                        getattr(self, k)[start:end].copy_(state[k].reshape(-1))
+                    state[k] = getattr(self, k)[start:end].view_as(p)
+                p.data = self.flat[start:end].view_as(p)
+                p.grad = self.grad[start:end].view_as(p)
+                self.grads.append(p.grad)
+                self.segments.append((start, end))
+                self.hooks.append(p.register_post_accumulate_grad_hook(
+                    grad_marker(self.has_grad, len(self.grads)-1)))
+                start = start + aligned(p.numel(), element_size)
+
+    def bind_grads(self):
+        # Gradients set from outside (or to None) since the last step are
+        # moved back into the flat buffer
+        for i, (p, g, (start, end)) in enumerate(zip(self.params, self.grads,
+            self.segments)):
+            if(p.grad is g):
+                continue
+            if(p.grad is None):
+                g.zero_()
+                self.has_grad[i] = False
+            else:
+                self.grad[start:end].copy_(p.grad.reshape(-1))
+                self.has_grad[i] = True
+            p.grad = g
+
+    @torch.no_grad()
+    def zero_grad(self, set_to_none=True):
+        # Gradients stay views of the flat buffer and are zeroed in place,
+        # autograd accumulates into them
+        if(not self.is_packed()):
+            self.pack()
+        self.bind_grads()
+        self.grad.zero_()
+        self.has_grad[:] = [False] * len(self.has_grad)
+
+    def step_spans(self):
+        # (group, start, end, step) for runs of consecutive parameters of a
+        # group that have a gradient and the same step count. Without
+        # skipped parameters there is one span per group.
+        spans = []
+        i = 0
+        for group in self.param_groups:
+            previous = None
+            for p in group['params']:
+                start, end = self.segments[i]
+                step = self.state[p]['step']
+                if(not self.has_grad[i]):
+                    previous = None
+                elif(previous is not None and previous[3] == step):
+                    previous[2] = end
+                else:
+                    previous = [group, start, end, step]
+                    spans.append(previous)
+                i += 1
+        return spans
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if(closure is not None):
+            with torch.enable_grad():
+                loss = closure()
+        if(not self.is_packed()):
+            self.pack()
+        self.bind_grads()
+
+        beta1, beta2 = self.defaults['betas']
+        spans = self.step_spans()
+        if(all(self.has_grad)):
+            self.exp_avg.lerp_(self.grad, 1 - beta1)
+            self.exp_avg_sq.mul_(beta2).addcmul_(self.grad, self.grad, value=1 - beta2)
+            torch.sqrt(self.exp_avg_sq, out=self.denom)
+        else:
+            # Moments of the parameters without a gradient stay unchanged
+            for _, start, end, _ in spans:
+                grad = self.grad[start:end]
+                self.exp_avg[start:end].lerp_(grad, 1 - beta1)
+                self.exp_avg_sq[start:end].mul_(beta2).addcmul_(grad, grad,
+                    value=1 - beta2)
+                torch.sqrt(self.exp_avg_sq[start:end], out=self.denom[start:end])
+        for p, has_grad in zip(self.params, self.has_grad):
+            if(has_grad):
+                self.state[p]['step'] += 1
+        for group, start, end, step in spans:
+            bias_correction1 = 1 - beta1 ** (step + 1)
+            bias_correction2 = 1 - beta2 ** (step + 1)
+            denom = self.denom[start:end].div_(bias_correction2 ** 0.5).add_(group['eps'])
+            self.flat[start:end].addcdiv_(self.exp_avg[start:end], denom,
+                value=-group['lr'] / bias_correction1)
+        # Updates through the flat buffer do not bump the version of the
+        # views, which cached gaussian precisions and grids are keyed on
+        torch.autograd.graph.increment_version(self.params)
+        return loss
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        self.pack()
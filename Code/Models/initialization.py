@@ -0,0 +1,139 @@
+import torch
+from Models import gaussians
+
+# Data driven initialization of the gaussians in a GMMINR model.
+# Points are sampled proportional to the gradient magnitude of the data
+# (mixed with a uniform floor), clustered with a few k-means passes, and
+# each cluster's mean, covariance and mean data value become the center,
+# precision and leading features of a gaussian. Everything runs in chunks
+# so no [voxels, ...] or [samples, gaussians] buffer is ever allocated.
+
+def gradient_magnitude_slab(data, start, end):
+    # Gradient magnitude (summed over channels) of data [1, C, ...]
+    # for the slab [start, end) along the first spatial axis,
+    # using a one voxel halo on each side
+    lo = max(start - 1, 0)
+    hi = min(end + 1, data.shape[2])
+    slab = data[0, :, lo:hi].float()
+    spatial_dims = list(range(1, slab.dim()))
+    if(slab.shape[1] < 2):
+        spatial_dims = spatial_dims[1:]
+    grads = torch.gradient(slab, dim=spatial_dims)
+    mag = torch.zeros_like(slab[0])
+    for g in grads:
+        mag += g.square().sum(dim=0)
+    return mag.sqrt_()[start-lo:start-lo+(end-start)]
+
+def sample_by_gradient(dataset, n_samples, uniform_fraction=0.1,
+    max_slab_voxels=2**22):
+    # Flat voxel indices sampled proportional to the gradient magnitude,
+    # mixed with a uniform distribution. Two levels: first slabs along
+    # the first spatial axis, then voxels within each slab.
+    data = dataset.data
+    depth = data.shape[2]
+    voxels_per_slice = dataset.total_points() // depth
+    slab_size = max(1, max_slab_voxels // voxels_per_slice)
+    slab_starts = list(range(0, depth, slab_size))
+
+    slab_sums = []
+    for start in slab_starts:
+        end = min(start+slab_size, depth)
+        slab_sums.append(gradient_magnitude_slab(data, start, end).sum())
+    slab_sums = torch.stack(slab_sums)
+    total = slab_sums.sum().clamp(min=1e-12)
+    slab_voxels = torch.tensor([min(s+slab_size, depth)-s for s in slab_starts],
+        dtype=torch.float32, device=slab_sums.device) * voxels_per_slice
+    slab_probs = (1 - uniform_fraction) * slab_sums / total + \
+        uniform_fraction * slab_voxels / slab_voxels.sum()
+    slab_counts = torch.bincount(
+        torch.multinomial(slab_probs, n_samples, replacement=True),
+        minlength=len(slab_starts)).tolist()
+
+    samples = []
+    for i, start in enumerate(slab_starts):
+        if(slab_counts[i] == 0):
+            continue
+        end = min(start+slab_size, depth)
+        mag = gradient_magnitude_slab(data, start, end).flatten()
+        probs = (1 - uniform_fraction) * mag / total + \
+            uniform_fraction / dataset.total_points()
+        idx = torch.multinomial(probs, slab_counts[i], replacement=True)
+        samples.append(idx + start * voxels_per_slice)
+    return torch.cat(samples)
+
+def assign_clusters(x, centers, chunk_size=16384):
+    # Index of the closest center to each point, computed in chunks
+    assignment = torch.empty([x.shape[0]], dtype=torch.long, device=x.device)
+    center_sq = centers.square().sum(dim=1)
+    for start in range(0, x.shape[0], chunk_size):
+        end = min(start+chunk_size, x.shape[0])
+        dist = torch.addmm(center_sq.unsqueeze(0), x[start:end], centers.T, alpha=-2)
+        assignment[start:end] = dist.argmin(dim=1)
+    return assignment
+
+def kmeans(x, n_clusters, iterations):
+    centers = x[torch.randperm(x.shape[0], device=x.device)[:n_clusters]].clone()
+    if(centers.shape[0] < n_clusters):
+        centers = torch.cat([centers,
+            torch.rand([n_clusters-centers.shape[0], x.shape[1]],
+                device=x.device)*2-1])
+    for _ in range(iterations):
+        assignment = assign_clusters(x, centers)
+        sums = torch.zeros_like(centers).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=n_clusters)
+        # Empty clusters are re-seeded at random samples
+        empty = counts == 0
+        centers = sums / counts.clamp(min=1).unsqueeze(1)
+        centers[empty] = x[torch.randint(x.shape[0], [int(empty.sum().item())],
+            device=x.device)]
+    return centers, assign_clusters(x, centers)
+
+@torch.no_grad()
+def initialize_from_data(model, dataset, opt):
+    n_gaussians = model.gaussian_centers.shape[0]
+    if(n_gaussians == 0):
+        return
+    if(dataset.data.is_meta):
+        print("Data initialization needs the volume in memory, " + \
+            "keeping the random initialization")
+        return
+    n_dims = opt['n_dims']
+    device = model.gaussian_centers.device
+
+    idx = sample_by_gradient(dataset,
+        max(opt['initialization_samples'], n_gaussians))
+    x = dataset.index_grid[idx.to(dataset.index_grid.device)].to(device)
+    values = dataset.data.flatten(2)[0][:, idx.to(dataset.data.device)].T.to(device)
+
+    centers, assignment = kmeans(x, n_gaussians, opt['kmeans_iterations'])
+
+    # Covariance of each cluster, regularized by the voxel spacing.
+    # Clusters with too few points keep the default isotropic covariance.
+    counts = torch.bincount(assignment, minlength=n_gaussians)
+    diff = x - centers[assignment]
+    scatter = torch.zeros([n_gaussians, n_dims*n_dims], device=device)
+    scatter.index_add_(0, assignment,
+        (diff.unsqueeze(-1) * diff.unsqueeze(-2)).flatten(1))
+    cov = scatter.view(-1, n_dims, n_dims) / counts.clamp(min=1).view(-1, 1, 1)
+    spacing = 2 / min(dataset.data.shape[2:])
+    eye = torch.eye(n_dims, device=device).unsqueeze(0)
+    cov += eye * spacing**2
+    default_cov = eye * (1/n_gaussians)
+    cov = torch.where((counts <= n_dims).view(-1, 1, 1), default_cov, cov)
+    precision = torch.linalg.inv(cov)
+
+    # Leading features are the standardized mean data value of each cluster
+    value_sums = torch.zeros([n_gaussians, values.shape[1]], device=device)
+    value_sums.index_add_(0, assignment, values)
+    cluster_values = value_sums / counts.clamp(min=1).unsqueeze(1)
+    cluster_values = (cluster_values - values.mean(dim=0)) / (values.std(dim=0) + 1e-8)
+    n_value_features = min(values.shape[1], model.gaussian_features.shape[1])
+
+    model.gaussian_centers.copy_(centers)
+    if(model.uses_cholesky()):
+        model.gaussian_precision_cholesky.copy_(
+            gaussians.precision_to_cholesky(precision))
+    else:
+        model.gaussian_precision.copy_(precision)
+    model.gaussian_features[:, :n_value_features] = \
+        cluster_values[:, :n_value_features]
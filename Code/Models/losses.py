@@ -8,6 +8,10 @@ def mse(x, y):
     return F.mse_loss(x, y)
 
 def l1_loss(network_output, target):
+    if('weights' in target):
+        # Importance sampled batch, weights undo the sampling bias
+        err = torch.abs(network_output - target['data'])
+        return (err * target['weights'].unsqueeze(1)).mean()
     return l1(network_output, target['data'])
 
 def l1_occupancy(gt, y):
@@ -7,8 +7,9 @@ import os
 from math import pi
 from Models.options import *
 from Models.GMMINR import GMMINR
+from Other.metrics import volume_metrics
 from Other.utility_functions import create_folder
-from Other.utility_functions import make_coord_grid
+from Other.utility_functions import make_coord_grid, CoordGrid, GridWriter
 
 project_folder_path = os.path.dirname(os.path.abspath(__file__))
 project_folder_path = os.path.join(project_folder_path, "..", "..")
@@ -30,8 +31,10 @@ def load_model(opt, device):
     path_to_load = os.path.join(save_folder, opt["save_name"])
     model = create_model(opt)
 
+    # Saved with pickle protocol 4, which the weights_only unpickler
+    # (the default since torch 2.6) rejects
     ckpt = torch.load(os.path.join(path_to_load, 'model.ckpt.tar'), 
-        map_location = device)
+        map_location = device, weights_only = False)
     
     model.load_state_dict(ckpt['state_dict'])
 
@@ -41,16 +44,66 @@ def create_model(opt):
     return GMMINR(opt)
 
 def sample_grid(model, grid, max_points = 100000):
-    coord_grid = make_coord_grid(grid, 
-        model.opt['device'], flatten=False,
+    # Coordinates are generated per chunk by the lazy CoordGrid
+    coord_grid = CoordGrid(grid, model.opt['device'],
         align_corners=model.opt['align_corners'])
-    coord_grid_shape = list(coord_grid.shape)
-    coord_grid = coord_grid.view(-1, coord_grid.shape[-1])
     vals = forward_maxpoints(model, coord_grid, max_points = max_points)
-    coord_grid_shape[-1] = model.opt['n_outputs']
-    vals = vals.reshape(coord_grid_shape)
+    vals = vals.reshape(list(grid) + [model.opt['n_outputs']])
     return vals
 
+@torch.no_grad()
+def sample_grid_to_file(model, grid, location, max_points = 100000,
+    channel_names = None):
+    '''
+    Streaming version of sample_grid that writes the reconstruction to
+    location (.nc, .h5 or .npy, see GridWriter) as [n_outputs, *grid].
+    Coordinates are generated per slab along the first axis and each slab
+    is written as soon as it is computed, so memory is bounded by
+    max_points (or one slice of the grid if that is larger) instead of
+    by the output resolution.
+    '''
+    grid = list(grid)
+    slice_points = 1
+    for n in grid[1:]:
+        slice_points *= n
+    slab_size = max(1, max_points // slice_points)
+    coord_grid = CoordGrid(grid, model.opt['device'],
+        align_corners=model.opt['align_corners'])
+    with GridWriter(location, grid, model.opt['n_outputs'],
+        channel_names, slab_size) as writer:
+        for start in range(0, grid[0], slab_size):
+            end = min(start+slab_size, grid[0])
+            writer.write(start, end, 
+                sample_slab(model, coord_grid, start, end, max_points)[0])
+
+@torch.no_grad()
+def sample_slab(model, coord_grid, start, end, max_points = 100000):
+    # Model output [1, n_outputs, end-start, ...] at the rows [start, end)
+    # along the first axis of the CoordGrid
+    vals = forward_maxpoints(model, coord_grid.slab(start, end), 
+        max_points = max_points)
+    return vals.T.reshape([1, model.opt['n_outputs'], end-start] + 
+        list(coord_grid.grid_shape[1:]))
+
+@torch.no_grad()
+def reconstruction_metrics(model, dataset, compute_ssim=True, 
+    max_points = 2**21):
+    # PSNR and SSIM of the model against the dataset, streaming slabs of
+    # both so neither volume is materialized (see Other/metrics.py). PSNR
+    # is relative to the data's range from its statistics.
+    shape = list(dataset.data.shape[2:])
+    coord_grid = CoordGrid(shape, model.opt['device'],
+        align_corners=model.opt['align_corners'])
+    slice_points = 1
+    for n in shape[1:]:
+        slice_points *= n
+    slab_size = max(1, max_points // slice_points)
+    return volume_metrics(
+        lambda start, end: sample_slab(model, coord_grid, start, end),
+        dataset.get_slab, shape[0], slab_size, 
+        compute_ssim=compute_ssim, device=model.opt['device'],
+        data_range=(dataset.max() - dataset.min()).item())
+
 def sample_grad_grid(model, grid, 
     output_dim = 0, max_points=1000):
     
@@ -83,13 +136,21 @@ def sample_grad_grid(model, grid,
     
     return output
 
+def image_coordinates(grid, device, align_corners):
+    # Coordinates [h, w, n_dims] of the image plane of grid: the whole grid
+    # in 2D, the middle slice of the last axis in 3D, computed without
+    # the rest of the volume
+    coord_grid = CoordGrid(grid, device, align_corners=align_corners)
+    if(len(grid) == 2):
+        return coord_grid[:].view(grid[0], grid[1], 2)
+    indices = torch.arange(grid[0]*grid[1], device=device) * grid[2] + \
+        int(grid[2]/2)
+    return coord_grid[indices].view(grid[0], grid[1], 3)
+
 def sample_grid_for_image(model, grid, 
     boundary_scaling = 1.0):
-    coord_grid = make_coord_grid(grid, 
-        model.opt['device'], flatten=False,
-        align_corners=model.opt['align_corners'])
-    if(len(coord_grid.shape) == 4):
-        coord_grid = coord_grid[:,:,int(coord_grid.shape[2]/2),:]
+    coord_grid = image_coordinates(grid, model.opt['device'],
+        model.opt['align_corners'])
     
     coord_grid *= boundary_scaling
 
@@ -184,6 +245,7 @@ def forward_w_grad(model, coords):
     return output, coords
 
 def forward_maxpoints(model, coords, max_points=100000):
+    # coords can be a tensor [N, n_dims] or a lazy CoordGrid
     output_shape = list(coords.shape)
     output_shape[-1] = model.opt['n_outputs']
     output = torch.empty(output_shape, 
@@ -11,14 +11,46 @@ class Options():
         opt['n_gaussians']                          = 1000   
         opt['n_features']                           = 16       
         opt['num_positional_encoding_terms']        = 6
+        opt['covariance_parameterization']          = 'precision'
+        opt['gaussian_initialization']              = 'random'
+        opt['initialization_samples']               = 100000
+        opt['kmeans_iterations']                    = 10
+        opt['gaussian_tile_size']                   = 0
+        opt['gaussian_culling']                     = False
+        opt['culling_sigma']                        = 3.0
+        opt['culling_grid_resolution']              = 32
+        opt['density_control_every']                = 0
+        opt['density_control_until']                = 0.5
+        opt['prune_threshold']                      = 0.01
+        opt['densify_fraction']                     = 0.05
+        opt['max_gaussians']                        = 100000
         
         opt['data']                                 = 'tornado.nc'
+        opt['time_series']                          = None
+        opt['procedural_resolution']                = 128
+        opt['warm_start']                           = True
+        opt['warm_start_iterations']                = 1000
         opt['save_name']                            = 'tornado'
         opt['align_corners']                        = True
         opt['n_layers']                             = 4       
         opt['nodes_per_layer']                      = 128
         opt['interpolate']                          = False
+        opt['volume_cache']                         = False
+        opt['shared_memory_data']                   = False
+        opt['shared_memory_token']                  = None
+        opt['brick_size']                           = 64
+        opt['brick_cache_size']                     = 64
+        opt['out_of_core']                          = False
+        opt['resident_bricks']                      = 64
+        opt['bricks_per_batch']                     = 4
+        opt['sampler']                              = 'uniform'
+        opt['importance_brick_size']                = 8
+        opt['importance_uniform_fraction']          = 0.2
+        opt['importance_decay']                     = 0.1
+        opt['prefetch_batches']                     = 0
+        opt['pin_memory']                           = True
         opt['vorticity']                            = False
+        opt['profile']                              = False
 
         opt['train_distributed']                    = False
         opt['device']                               = 'cuda:0'
@@ -32,10 +64,15 @@ class Options():
         opt['lr']                                   = 5e-5 
         opt['beta_1']                               = 0.9
         opt['beta_2']                               = 0.999
+        opt['parameter_layout']                     = 'separate'
 
         opt['iteration_number']                     = 0
         opt['save_every']                           = 100
         opt['log_every']                            = 5
+        opt['log_image']                            = False
+        opt['log_image_every']                      = 100
+        opt['log_image_resolution']                 = 0
+        opt['log_gradient']                         = False
 
         return opt
 
@@ -0,0 +1,108 @@
+import threading
+import queue
+import torch
+
+# TensorBoard logging off the training thread. add_scalar takes tensors
+# as they are (detached, never .item()'d on the training thread) and a
+# background worker resolves everything queued since its last pass with a
+# single device to host copy, then writes it. Functions queued with run()
+# (printing, image rendering) execute on the worker in order. Renders
+# get a snapshot of whatever they need, and a new render is dropped
+# while max_pending_renders are still queued, so a slow render lowers the
+# image cadence instead of stalling training.
+
+class AsyncLogger():
+    def __init__(self, writer, max_pending_renders=1):
+        self.writer = writer
+        self.max_pending_renders = max_pending_renders
+        self.items = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending_renders = 0
+        self.dropped_renders = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, value, step):
+        if(torch.is_tensor(value)):
+            value = value.detach()
+        self.items.put(("scalar", tag, value, step))
+
+    def add_image(self, tag, img, step, dataformats='CHW'):
+        self.items.put(("run", self.writer.add_image,
+            (tag, img, step), {"dataformats": dataformats}))
+
+    def add_text(self, tag, text, step):
+        self.items.put(("run", self.writer.add_text, (tag, text, step), {}))
+
+    def run(self, fn, *args, **kwargs):
+        # Calls fn(*args, **kwargs) on the worker, after everything queued
+        # before it. fn can use this logger or the writer.
+        self.items.put(("run", fn, args, kwargs))
+
+    def render(self, snapshot, fn, *args):
+        # Calls fn(snapshot(), *args) on the worker, unless earlier renders
+        # are still pending. snapshot runs here, on the calling thread, and
+        # must copy everything the render reads. Returns whether queued.
+        with self.lock:
+            if(self.pending_renders >= self.max_pending_renders):
+                self.dropped_renders += 1
+                return False
+            self.pending_renders += 1
+        self.items.put(("render", fn, (snapshot(),) + args, {}))
+        return True
+
+    def write_scalars(self, batch):
+        # Every tensor in the batch resolved with one copy per device
+        tensors = {}
+        for i, (tag, value, step) in enumerate(batch):
+            if(torch.is_tensor(value)):
+                tensors.setdefault(value.device, []).append(i)
+        values = [v for _, v, _ in batch]
+        for device, indices in tensors.items():
+            resolved = torch.stack([values[i].float().reshape(())
+                for i in indices]).cpu().tolist()
+            for i, v in zip(indices, resolved):
+                values[i] = v
+        for (tag, _, step), v in zip(batch, values):
+            self.writer.add_scalar(tag, v, step)
+
+    def worker(self):
+        stop = False
+        while(not stop):
+            items = [self.items.get()]
+            try:
+                while(True):
+                    items.append(self.items.get_nowait())
+            except queue.Empty:
+                pass
+            scalars = []
+            for item in items:
+                if(item is None):
+                    stop = True
+                    break
+                if(item[0] == "scalar"):
+                    scalars.append(item[1:])
+                    continue
+                # Keep the order of scalars and calls
+                self.write_scalars(scalars)
+                scalars = []
+                kind, fn, args, kwargs = item
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e:
+                    self.error = e
+                    print(f"Logging failed: {e!r}")
+                if(kind == "render"):
+                    with self.lock:
+                        self.pending_renders -= 1
+            self.write_scalars(scalars)
+
+    def close(self):
+        # Writes everything still queued
+        self.items.put(None)
+        self.thread.join()
+        if(self.dropped_renders > 0):
+            print(f"Skipped {self.dropped_renders} image renders that " + \
+                "would have waited on the previous one")
+        self.writer.close()
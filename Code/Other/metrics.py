@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from math import exp
+
+# Reconstruction metrics (PSNR, SSIM) computed in bounded memory. SSIM
+# uses a separable gaussian window: one 1D convolution per spatial axis
+# instead of a full window_size^n_dims kernel, which gives the same result
+# as ssim/ssim3D in utility_functions (zero padded, sigma 1.5, same
+# constants). Volumes are evaluated in slabs along the first spatial axis,
+# read from two sources at once (e.g. a model and a Dataset) with a halo
+# of window_size//2 rows, so every row is read exactly once.
+
+def gaussian_window(window_size, sigma=1.5, device="cpu"):
+    g = torch.tensor([exp(-(x - window_size//2)**2/float(2*sigma**2))
+        for x in range(window_size)], dtype=torch.float32, device=device)
+    return g / g.sum()
+
+def separable_filter(x, window):
+    # Gaussian filter of x [b, c, ...] along every spatial axis, zero padded
+    # so the output has the input's shape
+    n_dims = x.dim() - 2
+    conv = [F.conv1d, F.conv2d, F.conv3d][n_dims-1]
+    channels = x.shape[1]
+    r = window.shape[0] // 2
+    for axis in range(n_dims):
+        shape = [1] * n_dims
+        shape[axis] = -1
+        kernel = window.view([1, 1] + shape).repeat([channels] + [1]*(n_dims+1))
+        padding = [0] * n_dims
+        padding[axis] = r
+        x = conv(x, kernel, padding=padding, groups=channels)
+    return x
+
+def ssim_map(img1, img2, window):
+    # SSIM at every voxel of [b, c, ...] tensors
+    mu1 = separable_filter(img1, window)
+    mu2 = separable_filter(img2, window)
+    mu1_sq = mu1.pow(2)
+    mu2_sq = mu2.pow(2)
+    mu1_mu2 = mu1*mu2
+    sigma1_sq = separable_filter(img1*img1, window) - mu1_sq
+    sigma2_sq = separable_filter(img2*img2, window) - mu2_sq
+    sigma12 = separable_filter(img1*img2, window) - mu1_mu2
+
+    C1 = 0.01**2
+    C2 = 0.03**2
+    return ((2*mu1_mu2 + C1)*(2*sigma12 + C2)) / \
+        ((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+
+def ssim(img1, img2, window_size=11):
+    # Mean SSIM of two in-memory [b, c, ...] tensors
+    window = gaussian_window(window_size, device=img1.device)
+    return ssim_map(img1, img2, window).mean()
+
+class SlabStream():
+    # Rows [lo, hi) of a volume read in order along the first spatial axis
+    # with read(start, end) -> [1, c, end-start, ...]. Rows before lo are
+    # dropped and only the missing rows are read.
+    def __init__(self, read):
+        self.read = read
+        self.start = 0
+        self.rows = None
+
+    def get(self, lo, hi):
+        if(self.rows is None):
+            self.rows = self.read(lo, hi)
+            self.start = lo
+            return self.rows
+        end = self.start + self.rows.shape[2]
+        kept = self.rows[:, :, lo-self.start:]
+        if(hi > end):
+            kept = torch.cat([kept, self.read(end, hi).to(kept.device)], dim=2)
+        self.rows = kept
+        self.start = lo
+        return self.rows
+
+def volume_metrics(read_rec, read_gt, depth, slab_size=16, window_size=11,
+    compute_ssim=True, device="cpu", data_range=None):
+    '''
+    PSNR and SSIM of a reconstruction against ground truth, both given as
+    read(start, end) -> [1, c, end-start, ...] over the first spatial axis
+    of a volume depth rows deep. PSNR uses data_range if given (e.g. from
+    the dataset's statistics), otherwise the ground truth's range, as
+    PSNR(rec, gt, gt.max() - gt.min()). Memory is bounded by
+    slab_size + window_size - 1 rows of each source.
+    '''
+    r = window_size // 2 if compute_ssim else 0
+    window = gaussian_window(window_size, device=device)
+    rec_stream = SlabStream(read_rec)
+    gt_stream = SlabStream(read_gt)
+    squared_error = 0.0
+    ssim_sum = 0.0
+    n_values = 0
+    gt_min = np.inf
+    gt_max = -np.inf
+    for start in range(0, depth, slab_size):
+        end = min(start + slab_size, depth)
+        lo = max(start - r, 0)
+        hi = min(end + r, depth)
+        rec = rec_stream.get(lo, hi).to(device)
+        gt = gt_stream.get(lo, hi).to(device)
+        rec_core = rec[:, :, start-lo:end-lo]
+        gt_core = gt[:, :, start-lo:end-lo]
+        squared_error += ((rec_core - gt_core).double()**2).sum().item()
+        n_values += gt_core.numel()
+        if(data_range is None):
+            gt_min = min(gt_min, gt_core.min().item())
+            gt_max = max(gt_max, gt_core.max().item())
+        if(compute_ssim):
+            # Rows past the volume are zero padded by the filter, as in
+            # ssim3D; rows of the halo are real data
+            m = ssim_map(rec, gt, window)[:, :, start-lo:end-lo]
+            ssim_sum += m.double().sum().item()
+
+    mse = squared_error / n_values
+    if(data_range is None):
+        data_range = gt_max - gt_min
+    metrics = {
+        "mse": mse,
+        "psnr": float(20*np.log10(data_range) - 10*np.log10(mse))
+    }
+    if(compute_ssim):
+        metrics["ssim"] = ssim_sum / n_values
+    return metrics
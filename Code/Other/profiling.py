@@ -0,0 +1,206 @@
+import os
+import time
+import json
+import contextlib
+import torch
+
+# Named phase timers and memory tracking cheap enough to leave on during
+# training. On CPU a phase is timed with perf_counter. On CUDA, start and
+# end events are recorded around the phase and only resolved when the
+# statistics are flushed, so timing adds no synchronization to the
+# training step and kernels are attributed to the phase that launched them.
+#
+# On CUDA every phase also records the peak memory held by tensors while
+# it ran. The caching allocator's peak counter is reset when a phase
+# starts, which is host side bookkeeping and needs no synchronization, and
+# the peaks are folded into every enclosing phase and the run's peak. On
+# CPU PyTorch keeps no allocator statistics, so tensor memory is not
+# tracked there and memory is only the process RSS.
+
+def current_rss():
+    # Resident set size of this process in bytes
+    try:
+        with open("/proc/self/statm", 'r') as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def peak_rss():
+    # resource is Unix only, elsewhere the peak is what has been seen
+    try:
+        import resource
+    except ImportError:
+        return current_rss()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PhaseStatistics():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        # Since the last flush, for the TensorBoard scalars
+        self.window_count = 0
+        self.window_total = 0.0
+        # CUDA only, in bytes
+        self.tensor_peak = 0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.window_count += 1
+        self.window_total += seconds
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_ms": 1000 * self.total / max(self.count, 1),
+            "min_ms": 1000 * self.min if self.count > 0 else 0.0,
+            "max_ms": 1000 * self.max
+        }
+
+class Profiler():
+    def __init__(self, device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.cuda = "cuda" in str(device) and torch.cuda.is_available()
+        self.phases = {}
+        self.pending = []
+        self.peak_rss = 0
+        # Tensor peaks of the open (nested) phases, and of the whole run
+        self.open_peaks = []
+        self.tensor_peak = 0
+        self.t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        if(self.cuda):
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            self.open_phase()
+            start.record()
+            yield
+            end.record()
+            self.pending.append((name, start, end))
+            self.statistics(name).tensor_peak = max(
+                self.statistics(name).tensor_peak, self.close_phase())
+        else:
+            t = time.perf_counter()
+            yield
+            self.record(name, time.perf_counter() - t)
+
+    def phase(self, name):
+        # with profiler.phase("backward"): ...
+        if(not self.enabled):
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    def open_phase(self):
+        # The peak so far belongs to the phases that are already open
+        current = torch.cuda.max_memory_allocated(device=self.device)
+        self.open_peaks = [max(p, current) for p in self.open_peaks]
+        self.tensor_peak = max(self.tensor_peak, current)
+        torch.cuda.reset_peak_memory_stats(device=self.device)
+        self.open_peaks.append(0)
+
+    def close_phase(self):
+        peak = max(self.open_peaks.pop(), 
+            torch.cuda.max_memory_allocated(device=self.device))
+        self.open_peaks = [max(p, peak) for p in self.open_peaks]
+        self.tensor_peak = max(self.tensor_peak, peak)
+        return peak
+
+    def tensor_peak_bytes(self, device):
+        # Peak tensor memory on a CUDA device since the start of the run,
+        # also while phases reset the allocator's peak counter
+        return max(self.tensor_peak, 
+            torch.cuda.max_memory_allocated(device=device))
+
+    def statistics(self, name):
+        if(name not in self.phases):
+            self.phases[name] = PhaseStatistics()
+        return self.phases[name]
+
+    def record(self, name, seconds):
+        self.statistics(name).add(seconds)
+
+    def flush(self, blocking=True):
+        # Resolves the recorded CUDA events, waiting on the last one only.
+        # Without blocking, only the phases that already finished are
+        # resolved and the rest wait for a later flush.
+        if(blocking and len(self.pending) > 0):
+            self.pending[-1][2].synchronize()
+        done = 0
+        for name, start, end in self.pending:
+            if(not blocking and not end.query()):
+                break
+            self.record(name, start.elapsed_time(end) / 1000)
+            done += 1
+        self.pending = self.pending[done:]
+        self.peak_rss = max(self.peak_rss, peak_rss())
+
+    def memory(self):
+        # Memory use in GB: process RSS now and at its peak, and on CUDA the
+        # peak memory held by tensors (not tracked on CPU)
+        m = {
+            "rss_GB": current_rss() / (1024**3),
+            "peak_rss_GB": max(self.peak_rss, peak_rss()) / (1024**3)
+        }
+        if(self.cuda):
+            m["tensor_peak_GB"] = self.tensor_peak_bytes(self.device) / (1024**3)
+        return m
+
+    def log(self, writer, iteration):
+        if(not self.enabled):
+            return
+        self.flush(blocking=False)
+        for name, p in self.phases.items():
+            if(p.window_count > 0):
+                writer.add_scalar(f"Phase time (ms)/{name}",
+                    1000 * p.window_total / p.window_count, iteration)
+            p.window_count = 0
+            p.window_total = 0.0
+        for k, v in self.memory().items():
+            writer.add_scalar(f"Memory/{k}", v, iteration)
+
+    def report(self):
+        self.flush()
+        wall = time.perf_counter() - self.t0
+        phases = {name: p.to_dict() for name, p in self.phases.items()}
+        # Share of the wall time since the profiler was created, phases
+        # nested in others (the model's inside logging) count in both
+        for name, p in phases.items():
+            p['fraction'] = p['total_seconds'] / max(wall, 1e-12)
+            if(self.cuda):
+                p['tensor_peak_GB'] = self.phases[name].tensor_peak / (1024**3)
+        return {
+            "wall_seconds": wall,
+            "phases": phases,
+            "memory": self.memory(),
+            "tensor_memory_tracked": self.cuda
+        }
+
+    def summary(self):
+        r = self.report()
+        lines = [f"{'phase' : <18}{'count' : >8}{'mean ms' : >10}" + \
+            f"{'max ms' : >10}{'total s' : >10}{'share' : >8}" + \
+            (f"{'peak GB' : >10}" if self.cuda else "")]
+        for name, p in sorted(r['phases'].items(),
+            key=lambda x: -x[1]['total_seconds']):
+            lines.append(f"{name : <18}{p['count'] : >8}{p['mean_ms'] : >10.3f}" + \
+                f"{p['max_ms'] : >10.3f}{p['total_seconds'] : >10.2f}" + \
+                f"{100 * p['fraction'] : >7.1f}%" + \
+                (f"{p['tensor_peak_GB'] : >10.3f}" if self.cuda else ""))
+        lines.append(", ".join(f"{k} {v : 0.3f}" for k, v in r['memory'].items()))
+        if(not self.cuda):
+            lines.append("Tensor memory is not tracked on CPU, rss is the whole process")
+        return "\n".join(lines)
+
+    def save(self, location):
+        with open(location, 'w') as fp:
+            json.dump(self.report(), fp, indent=4)
+
+null_profiler = Profiler("cpu", enabled=False)
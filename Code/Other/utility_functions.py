@@ -310,6 +310,66 @@ def make_coord_grid(shape, device, flatten=True, align_corners=False):
         ret = ret.view(-1, ret.shape[-1])
     return ret.flip(-1)
 
+class CoordGrid():
+    """
+    Lazy version of make_coord_grid(shape, flatten=True). Coordinates for
+    flat indices, slices or index tensors are computed arithmetically with
+    the same align_corners semantics and axis flip, so nothing of size
+    [voxels, n_dims] is stored. Supports len(), .shape, and indexing
+    like the flattened tensor it replaces.
+    """
+    def __init__(self, shape, device, align_corners=False):
+        self.grid_shape = [int(n) for n in shape]
+        self.device = device
+        self.align_corners = align_corners
+        self.n_points = 1
+        for n in self.grid_shape:
+            self.n_points *= n
+        self.shape = torch.Size([self.n_points, len(self.grid_shape)])
+
+    def __len__(self):
+        return self.n_points
+
+    def axis_coordinates(self, axis, idx):
+        n = self.grid_shape[axis]
+        if(self.align_corners):
+            r = 2.0 / (n-1)
+            return -1.0 + r * idx.to(torch.float32)
+        r = 2.0 / (n+1)
+        return -1.0 + r + r * idx.to(torch.float32)
+
+    def get(self, indices):
+        # Coordinates [k, n_dims] of the flat indices [k]
+        indices = indices.to(self.device)
+        coords = torch.empty([indices.shape[0], len(self.grid_shape)],
+            dtype=torch.float32, device=self.device)
+        for axis in reversed(range(len(self.grid_shape))):
+            n = self.grid_shape[axis]
+            # Flipped, so the last axis is the first coordinate
+            coords[:, len(self.grid_shape)-1-axis] = \
+                self.axis_coordinates(axis, indices % n)
+            indices = torch.div(indices, n, rounding_mode='floor')
+        return coords
+
+    def __getitem__(self, index):
+        if(isinstance(index, slice)):
+            start, stop, step = index.indices(self.n_points)
+            return self.get(torch.arange(start, stop, step, device=self.device))
+        if(isinstance(index, int)):
+            return self.get(torch.tensor([index % self.n_points], 
+                device=self.device))[0]
+        return self.get(torch.as_tensor(index))
+
+    def slab(self, start, end):
+        # Coordinates of the points with index [start, end) along the
+        # first axis, flattened
+        slice_points = self.n_points // self.grid_shape[0]
+        return self[start*slice_points:end*slice_points]
+
+    def materialize(self, flatten=True):
+        return make_coord_grid(self.grid_shape, self.device,
+            flatten=flatten, align_corners=self.align_corners)
+
 def save_obj(obj,location):
     with open(location, 'wb') as f:
         pickle.dump(obj, f, pickle.DEFAULT_PROTOCOL)
@@ -394,6 +454,64 @@ def tensor_to_h5(t, location):
     h['data'] = t[0].clone().detach().cpu().numpy()
     h.close()
 
+class GridWriter():
+    '''
+    Writes a [c, *shape] grid to disk one slab (range along the first
+    spatial axis) at a time. The format comes from the file extension:
+    .nc (one NetCDF variable per channel, readable with nc_to_tensor),
+    .h5 (dataset 'data' as in tensor_to_h5), or .npy (memory mapped).
+    Use it in a with block so the file is closed if writing fails.
+    '''
+    def __init__(self, location, shape, channels, channel_names=None,
+        slab_size=1):
+        self.location = location
+        self.extension = os.path.splitext(location)[1]
+        if(channel_names is None):
+            channel_names = [chr(ord('a')+i) for i in range(channels)]
+        self.channel_names = channel_names
+        chunks = [max(1, min(slab_size, shape[0]))] + list(shape[1:])
+        if(self.extension == ".nc"):
+            self.f = Dataset(location, 'w')
+            dims = ['x', 'y', 'z'][:len(shape)]
+            for i, d in enumerate(dims):
+                self.f.createDimension(d, shape[i])
+            for ch in channel_names:
+                self.f.createVariable(ch, np.float32, dims, chunksizes=chunks)
+        elif(self.extension == ".h5"):
+            self.f = h5py.File(location, mode='w')
+            self.f.create_dataset('data', [channels] + list(shape),
+                dtype=np.float32, chunks=tuple([1] + chunks))
+        elif(self.extension == ".npy"):
+            self.f = np.lib.format.open_memmap(location, mode='w+',
+                dtype=np.float32, shape=tuple([channels] + list(shape)))
+        else:
+            raise ValueError(f"Unsupported output format {self.extension}")
+
+    def write(self, start, end, values):
+        # values: [c, end-start, *shape[1:]]
+        values = values.detach().cpu().numpy()
+        if(self.extension == ".nc"):
+            for i, ch in enumerate(self.channel_names):
+                self.f[ch][start:end] = values[i]
+        elif(self.extension == ".h5"):
+            self.f['data'][:, start:end] = values
+        else:
+            self.f[:, start:end] = values
+
+    def close(self):
+        if(self.extension == ".npy"):
+            self.f.flush()
+            del self.f
+        else:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
 # x,y,z coordiantes either numpy / vtk array 
 def get_vtr(dims, xCoords, yCoords, zCoords, 
             scalar_fields={}, vector_fields={}):
@@ -466,62 +584,72 @@ def solution_to_cdf(data, location, channel_names = ['data']):
 
 def normal(vf, b=None, normalize=True):
     # vf: [1, 3, d, h, w]
-    # jac: [1, 3, 3, d, h, w]
-    
+    # b: [1, 3, d, h, w]
     if b is None:
         b = binormal(vf)
-    b = b.squeeze().flatten(1).permute(1,0).unsqueeze(2)
-    n = torch.cross(b,
-        vf[0].permute(1, 2, 3, 0).flatten(0, 2).unsqueeze(2))
-    n = n.squeeze().permute(1,0).reshape(
-        vf.shape[1], vf.shape[2],
-        vf.shape[3], vf.shape[4]).unsqueeze(0)
+    n = torch.cross(b, vf, dim=1)
     if(normalize):
-        n /= (n.norm(dim=1) + 1e-8)
+        n /= (n.norm(dim=1, keepdim=True) + 1e-8)
     return n
 
-    
 def binormal(vf, jac=None, normalize=True):
     # vf: [1, 3, d, h, w]
     # jac: [1, 3, 3, d, h, w]
     if jac is None:
         jac = jacobian(vf, normalize=normalize)
-    Jt = torch.bmm(jac[0].permute(2, 3, 4, 0, 1).flatten(0, 2), 
-        vf[0].permute(1, 2, 3, 0).flatten(0, 2).unsqueeze(2))
-    b = torch.cross(Jt,
-        vf[0].permute(1, 2, 3, 0).flatten(0, 2).unsqueeze(2))
-    #b = torch.cross(vf[0].permute(1, 2, 3, 0).flatten(0, 2).unsqueeze(2),
-    #    Jt)
-    b = b.squeeze().permute(1,0).reshape(
-        vf.shape[1], vf.shape[2],
-        vf.shape[3], vf.shape[4]).unsqueeze(0)
+    # (J v) x v, pointwise without flattening the volume
+    Jt = (jac * vf.unsqueeze(1)).sum(dim=2)
+    b = torch.cross(Jt, vf, dim=1)
     if(normalize):
-        b /= (b.norm(dim=1) + 1e-8)
+        b /= (b.norm(dim=1, keepdim=True) + 1e-8)
     return b
 
+def linear_pad(data, n_dims):
+    # Pads every spatial axis by one voxel, extrapolating linearly
+    # (2*edge - next), so central differences become one sided at the edges
+    pad = [1, 1] * n_dims
+    return 2*F.pad(data, pad, mode='replicate') - F.pad(data, pad, mode='reflect')
+
+def derivative_kernels(n_channels, n_dims, device):
+    # Central difference kernels [c*n_dims, 1, 3, ...] for a grouped
+    # convolution. Derivative j is along spatial axis n_dims-1-j, so
+    # dimension 0 is the last axis, as in spatial_gradient.
+    k = torch.zeros([n_dims, 1] + [3]*n_dims, device=device)
+    for j in range(n_dims):
+        axis = n_dims - 1 - j
+        lo = [j, 0] + [1]*n_dims
+        hi = [j, 0] + [1]*n_dims
+        lo[2+axis] = 0
+        hi[2+axis] = 2
+        k[tuple(lo)] = -0.5
+        k[tuple(hi)] = 0.5
+    return k.repeat([n_channels] + [1]*(n_dims+1))
+
 def jacobian(data, normalize=True):
-    # Takes [b, c, d, h, w]
-    jac = []
-    for i in range(data.shape[1]):
-        grads = []
-        for j in range(len(data.shape)-2):
-            g = spatial_gradient(data, i, j)
-            grads.append(g)
-        jac.append(torch.cat(grads, dim=1))
-    jac = torch.cat(jac, dim=0).unsqueeze(0)
+    # Takes [b, c, d, h, w] (or [b, c, h, w]) and returns [b, c, n_dims, ...],
+    # every component from one grouped convolution
+    n_dims = len(data.shape) - 2
+    conv = F.conv3d if n_dims == 3 else F.conv2d
+    jac = conv(linear_pad(data, n_dims), 
+        derivative_kernels(data.shape[1], n_dims, data.device),
+        groups=data.shape[1])
+    jac = jac.view(data.shape[0], data.shape[1], n_dims, *data.shape[2:])
     if(normalize):
-        jac /= (data.norm(dim=1) + 1e-8)
+        jac /= (data.norm(dim=1, keepdim=True).unsqueeze(2) + 1e-8)
     return jac
 
-def curl(data):
-    dwdy = spatial_gradient(data,2,1)
-    dvdz = spatial_gradient(data,1,0)
+def curl(data, jac=None):
+    # data: [b, 3, d, h, w] with (u, v, w) channels, x along the last axis
+    if jac is None:
+        jac = jacobian(data, normalize=False)
+    dwdy = jac[:,2,1]
+    dvdz = jac[:,1,2]
     
-    dudz = spatial_gradient(data,0,0)
-    dwdx = spatial_gradient(data,2,2)
+    dudz = jac[:,0,2]
+    dwdx = jac[:,2,0]
     
-    dvdx = spatial_gradient(data,1,2)
-    dudy = spatial_gradient(data,0,1)
+    dvdx = jac[:,1,0]
+    dudy = jac[:,0,1]
     
     x = dwdy - dvdz
     y = dudz - dwdx
@@ -531,72 +659,20 @@ def curl(data):
 def spatial_gradient(data, channel, dimension):
     # takes the gradient along dimension in channel
     # expects data to be [b, c, d, h, w]
-    data_padded = F.pad(data[:,channel:channel+1], 
-        [1, 1, 1, 1, 1, 1],
-        mode = "replicate")
-    
-    data_padded[:,:,0] += data_padded[:,:,1] - \
-        data_padded[:,:,2]
-    data_padded[:,:,:,0] += data_padded[:,:,:,1] - \
-        data_padded[:,:,:,2]
-    data_padded[:,:,:,:,0] += data_padded[:,:,:,:,1] - \
-        data_padded[:,:,:,:,2]
-
-    data_padded[:,:,-1] += -data_padded[:,:,-2] + \
-        data_padded[:,:,-3]
-    data_padded[:,:,:,-1] += -data_padded[:,:,:,-2] + \
-        data_padded[:,:,:,-3]
-    data_padded[:,:,:,:,-1] += -data_padded[:,:,:,:,-2] + \
-        data_padded[:,:,:,:,-3]
-
-    if(dimension == 2):
-        weights = torch.tensor(
-            [[[0, 0, 0], 
-            [0, -0.5, 0],
-            [0, 0, 0]],
-
-            [[0, 0, 0], 
-            [0, 0, 0], 
-            [0, 0, 0]],
-
-            [[0, 0, 0], 
-            [0, 0.5, 0], 
-            [0, 0, 0]]]
-            ).to(data.device).type(torch.float32)
-    elif(dimension == 1):        
-        # the second (b) axis in [a, b, c]
-        weights = torch.tensor([
-            [[0, 0, 0], 
-            [0, 0, 0], 
-            [0, 0, 0]],
-
-            [[0, -0.5, 0], 
-            [0, 0, 0], 
-            [0, 0.5, 0]],
-
-            [[0, 0, 0], 
-            [0, 0, 0], 
-            [0, 0, 0]]]
-            ).to(data.device).type(torch.float32)
-    elif(dimension == 0):
-        # the third (c) axis in [a, b, c]
-        weights = torch.tensor([
-            [[0, 0, 0], 
-            [0, 0, 0], 
-            [0, 0, 0]],
-
-            [[0, 0, 0], 
-            [-0.5, 0, 0.5], 
-            [0, 0, 0]],
-
-            [[0, 0, 0], 
-            [0, 0,  0], 
-            [ 0, 0, 0]]]
-            ).to(data.device).type(torch.float32)
-    weights = weights.view(1, 1, 3, 3, 3)
-    output = F.conv3d(data_padded, weights)
-
-    return output
+    return jacobian(data[:,channel:channel+1], 
+        normalize=False)[:,:,dimension]
+
+def slab_derived_field(read_slab, depth, fn, slab_size):
+    # Applies a stencil operator fn ([1, c, ...] -> [1, c', ...], one voxel
+    # reach) slab by slab along the first spatial axis. read_slab(start, end)
+    # returns that range of the input; each slab is read with a one voxel
+    # halo so the result matches applying fn to the whole volume.
+    for start in range(0, depth, slab_size):
+        end = min(start + slab_size, depth)
+        lo = max(start - 1, 0)
+        hi = min(end + 1, depth)
+        out = fn(read_slab(lo, hi))
+        yield start, end, out[:, :, start-lo:start-lo+(end-start)]
 
 #Modified Code from Scipy-source
 #https://github.com/scipy/scipy/blob/master/scipy/spatial/_hausdorff.pyx
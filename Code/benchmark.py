@@ -0,0 +1,100 @@
+from __future__ import absolute_import, division, print_function
+import argparse
+import sys
+import torch
+from Other.utility_functions import str2bool
+from Benchmarks.gaussians import benchmark_gaussians
+from Benchmarks.data import benchmark_loading, benchmark_shared, benchmark_sampling, \
+    benchmark_derivatives, benchmark_metrics
+from Benchmarks.training import benchmark_initialization, benchmark_importance, \
+    benchmark_bake, benchmark_optimizer
+from Benchmarks.suite import benchmark_suite, compare_results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks parts of the GMMINR pipeline.')
+    parser.add_argument('--benchmark',default="gaussians",type=str,
+        help='Which benchmark to run. Options: gaussians, initialization, bake, sampling, importance, loading, shared, derivatives, metrics, optimizer, suite, compare')
+    parser.add_argument('--device',default="cpu",type=str,
+        help='Which device to benchmark on')
+    parser.add_argument('--methods',default="reference,fused,culled,tiled",type=str,
+        help='Comma separated methods to compare. Options: reference, fused, culled, tiled ' + \
+            'for gaussians, legacy, uniform, uniform_replacement, epoch for sampling, legacy, grouped, chunked for derivatives ' + \
+            'legacy, tiled for metrics and separate, flat (parameter layouts) for optimizer')
+    parser.add_argument('--n_gaussians',default="100,1000",type=str,
+        help='Comma separated numbers of gaussians to test')
+    parser.add_argument('--n_dims',default="2,3",type=str,
+        help='Comma separated numbers of dimensions to test')
+    parser.add_argument('--n_features',default="16",type=str,
+        help='Comma separated features per gaussian, the first is used outside the suite')
+    parser.add_argument('--points_per_iteration',default="10000,50000",type=str,
+        help='Comma separated numbers of points per batch to test')
+    parser.add_argument('--repeats',default=5,type=int,
+        help='Number of timed repeats per configuration')
+    parser.add_argument('--data',default="ABC_flow.nc,vortices.nc,flow_past_cylinder.nc",type=str,
+        help='Comma separated data files for the training benchmarks')
+    parser.add_argument('--iterations',default=2000,type=int,
+        help='Maximum training iterations for the training benchmarks')
+    parser.add_argument('--target_psnr',default=30.0,type=float,
+        help='Target PSNR (dB) for time-to-PSNR measurements')
+    parser.add_argument('--eval_every',default=50,type=int,
+        help='Iterations between PSNR evaluations')
+    parser.add_argument('--load_from',default=None,type=str,
+        help='Saved model to use for the inference benchmarks. If not given, one is trained')
+    parser.add_argument('--bake_resolutions',default="32,64,128",type=str,
+        help='Comma separated feature grid resolutions for the bake benchmark')
+    parser.add_argument('--volume_sizes',default="256,512,1024",type=str,
+        help='Comma separated volume resolutions for the sampling benchmark')
+    parser.add_argument('--n_channels',default=3,type=int,
+        help='Channels of the volume for the sampling benchmark')
+    parser.add_argument('--n_jobs',default=4,type=int,
+        help='Concurrent jobs for the shared memory benchmark')
+    parser.add_argument('--backward',default=True,type=str2bool,
+        help='Whether to include the backward pass in the timing')
+    parser.add_argument('--culling_sigma',default=3.0,type=float,
+        help='Standard deviations the culled method evaluates gaussians out to')
+    parser.add_argument('--n_layers',default="4",type=str,
+        help='Comma separated decoder depths for the suite')
+    parser.add_argument('--nodes_per_layer',default="128",type=str,
+        help='Comma separated decoder widths for the suite')
+    parser.add_argument('--threads',default=str(torch.get_num_threads()),type=str,
+        help='Comma separated torch thread counts for the suite')
+    parser.add_argument('--suite_resolution',default=64,type=int,
+        help='Resolution of the synthetic ABC flow data for the suite')
+    parser.add_argument('--results',default=None,type=str,
+        help='Results json for the suite, Output/benchmarks/suite_<commit>.json by default')
+    parser.add_argument('--baseline',default=None,type=str,
+        help='Results json of another commit to compare against')
+    parser.add_argument('--regression_threshold',default=0.1,type=float,
+        help='Relative change beyond which a worse metric is a regression')
+    args = vars(parser.parse_args())
+
+    torch.manual_seed(0)
+    if(args['benchmark'] == "gaussians"):
+        benchmark_gaussians(args)
+    elif(args['benchmark'] == "initialization"):
+        benchmark_initialization(args)
+    elif(args['benchmark'] == "bake"):
+        benchmark_bake(args)
+    elif(args['benchmark'] == "sampling"):
+        benchmark_sampling(args)
+    elif(args['benchmark'] == "importance"):
+        benchmark_importance(args)
+    elif(args['benchmark'] == "loading"):
+        benchmark_loading(args)
+    elif(args['benchmark'] == "shared"):
+        benchmark_shared(args)
+    elif(args['benchmark'] == "derivatives"):
+        benchmark_derivatives(args)
+    elif(args['benchmark'] == "metrics"):
+        benchmark_metrics(args)
+    elif(args['benchmark'] == "optimizer"):
+        benchmark_optimizer(args)
+    elif(args['benchmark'] == "suite"):
+        if(not benchmark_suite(args)):
+            sys.exit(1)
+    elif(args['benchmark'] == "compare"):
+        if(not compare_results(args['baseline'], args['results'], 
+            args['regression_threshold'])):
+            sys.exit(1)
+    else:
+        print(f"Unknown benchmark {args['benchmark']}")
@@ -5,7 +5,9 @@ import json
 import time
 import subprocess
 import shlex
-from Other.utility_functions import create_path
+import uuid
+from Other.utility_functions import create_path, str2bool
+from Datasets.volume_storage import remove_shared_volumes
 
 project_folder_path = os.path.dirname(os.path.abspath(__file__))
 project_folder_path = os.path.join(project_folder_path, "..")
@@ -53,6 +55,8 @@ if __name__ == '__main__':
         help='Which [cuda] devices(s) to train on, separated with commas. Default: all, which uses all available CUDA devices')
     parser.add_argument('--data_devices',default="same",type=str,
         help='Which devices to put the training data on. "same" as model, or "cpu".')
+    parser.add_argument('--shared_data',default=False,type=str2bool,
+        help='Have jobs share one shared memory copy of each data file, freed when all jobs finish')
     
     os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
     args = vars(parser.parse_args())
@@ -68,6 +72,8 @@ if __name__ == '__main__':
     else:
         available_devices = parse_devices(args['devices'])
     
+    # Shared memory segments of this sweep, removed when it finishes
+    shared_token = uuid.uuid4().hex[:12]
     jobs_training = []
     while(len(commands) + len(jobs_training) > 0):
         # Check if any jobs have finished and a GPU is freed
@@ -96,6 +102,8 @@ if __name__ == '__main__':
             else:
                 data_device = "cpu"
             c = c + "--device " + g + " --data_device " + data_device
+            if(args['shared_data'] and "train.py" in c):
+                c = c + " --shared_memory_data True --shared_memory_token " + shared_token
             c_split = shlex.split(c)
             # Logging location
             create_path(log_location[:-7])
@@ -108,5 +116,7 @@ if __name__ == '__main__':
             # Otherwise wait
             time.sleep(1.0)
 
+    if(args['shared_data']):
+        remove_shared_volumes(shared_token)
     print("All jobs have completed.")
     quit()
\ No newline at end of file
@@ -1,12 +1,13 @@
 from __future__ import absolute_import, division, print_function
 import argparse
 from random import gauss
-from Datasets.datasets import Dataset
+from Datasets.datasets import create_dataset
 import datetime
 from Other.utility_functions import str2bool
 from Models.models import load_model, create_model, save_model
 import torch
 import torch.optim as optim
+import torch.nn.functional as F
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 import time
@@ -16,7 +17,20 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.multiprocessing as mp
 from Models.losses import *
 import shutil
-from Models.models import sample_grid_for_image
+import contextlib
+from Models.models import sample_grid_for_image, reconstruction_metrics, \
+    image_coordinates
+from Models.density_control import DensityController
+from Models.flat_optimizer import FlatAdam
+from Models.initialization import initialize_from_data
+from Datasets.prefetch import BatchPrefetcher
+from Other.profiling import Profiler, null_profiler
+from Other.async_logging import AsyncLogger
+from Models.checkpoint import CheckpointWriter, training_state, \
+    restore_training_state, load_checkpoint
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import json
 
 project_folder_path = os.path.dirname(os.path.abspath(__file__))
 project_folder_path = os.path.join(project_folder_path, "..")
@@ -24,29 +38,96 @@ data_folder = os.path.join(project_folder_path, "Data")
 output_folder = os.path.join(project_folder_path, "Output")
 save_folder = os.path.join(project_folder_path, "SavedModels")
 
-def log_to_writer(iteration, losses, writer, opt):
-    with torch.no_grad():   
-        print_str = f"Iteration {iteration}/{opt['iterations']}, "
-        for key in losses.keys():    
-            print_str = print_str + str(key) + f": {losses[key].item() : 0.05f} " 
-            writer.add_scalar(str(key), losses[key].item(), iteration)
-        print(print_str)
-        GBytes = (torch.cuda.max_memory_allocated(device=opt['device']) \
+def print_losses(iteration, losses, opt):
+    print_str = f"Iteration {iteration}/{opt['iterations']}, "
+    for key in losses.keys():    
+        print_str = print_str + str(key) + f": {losses[key].item() : 0.05f} " 
+    print(print_str)
+
+def log_to_writer(iteration, losses, writer, opt, profiler=null_profiler):
+    # writer is an AsyncLogger, the losses are resolved on its worker
+    losses = {key: losses[key].detach() for key in losses.keys()}
+    for key in losses.keys():
+        writer.add_scalar(str(key), losses[key], iteration)
+    writer.run(print_losses, iteration, losses, opt)
+    if("cuda" in opt['device']):
+        GBytes = (profiler.tensor_peak_bytes(opt['device']) \
             / (1024**3))
         writer.add_scalar('GPU memory (GB)', GBytes, iteration)
 
-def log_image(model, grid_to_sample, writer, iteration, dataset):
-    with torch.no_grad():
-        img = sample_grid_for_image(model, grid_to_sample)
-        writer.add_image('Reconstruction', img.clamp(0, 1), 
-            iteration, dataformats='HWC')
-        gaussian_density = model.gaussian_density(grid_to_sample)
-        gt_img = dataset.get_2D_slice().permute(1, 2, 0).repeat(1, 1, 3).to(gaussian_density.device)
-        gt_img[:,:,0] += gaussian_density[:,:,0]
-        gt_img /= gt_img.max()
-        
-        writer.add_image("Gaussian density", gt_img.clamp(0,1),
-            iteration, dataformats = 'HWC')
+def image_grid(opt, dataset):
+    # Grid whose image plane is rendered, log_image_resolution if set
+    if(opt['log_image_resolution'] > 0):
+        return [opt['log_image_resolution']] * (len(dataset.data.shape) - 2)
+    return list(dataset.data.shape[2:])
+
+def normalize_channels(values, channel_range, channel_dim=-1):
+    # Maps every channel to [0, 1] with its min and max in the data
+    low, high = channel_range
+    shape = [1] * values.dim()
+    shape[channel_dim] = -1
+    low = low.to(values.device).view(shape)
+    high = high.to(values.device).view(shape)
+    return (values - low) / (high - low).clamp(min=1e-12)
+
+def image_ground_truth(dataset, grid_to_sample, channel_range):
+    # Normalized data slice [h, w, 3] matching the rendered image plane
+    gt_img = normalize_channels(dataset.get_2D_slice().float(), 
+        channel_range, 0).unsqueeze(0)
+    if(list(gt_img.shape[2:]) != list(grid_to_sample[:2])):
+        gt_img = F.interpolate(gt_img, size=list(grid_to_sample[:2]),
+            mode='bilinear', align_corners=True)
+    gt_img = gt_img[0].permute(1, 2, 0)
+    if(gt_img.shape[-1] == 1):
+        gt_img = gt_img.repeat(1, 1, 3)
+    return gt_img[..., :3]
+
+def model_snapshot(model):
+    # Options and parameter copies, all a render needs from the live model
+    return dict(model.opt), {k: v.detach().clone() 
+        for k, v in model.state_dict().items()}
+
+def create_render_model(opt):
+    # A model to load snapshots into. It is built on the meta device and
+    # then allocated uninitialized, so unlike create_model it draws nothing
+    # from the global RNG that training and the prefetcher sample from.
+    meta_opt = dict(opt)
+    meta_opt['device'] = 'meta'
+    with torch.device('meta'):
+        model = create_model(meta_opt)
+    model = model.to_empty(device=opt['device'])
+    model.opt = opt
+    model.train(False)
+    return model
+
+@torch.no_grad()
+def log_image(snapshot, renderer, grid_to_sample, gt_img, channel_range, 
+    writer, iteration):
+    # Runs on the AsyncLogger worker, with a model of its own in renderer
+    opt, state = snapshot
+    model = renderer.get('model')
+    if(model is None or 
+       model.gaussian_centers.shape != state['gaussian_centers'].shape):
+        model = create_render_model(opt)
+        renderer['model'] = model
+    model.opt = opt
+    model.load_state_dict(state)
+
+    img = normalize_channels(sample_grid_for_image(model, grid_to_sample),
+        channel_range)
+    writer.add_image('Reconstruction', img.clamp(0, 1), 
+        iteration, dataformats='HWC')
+    coords = image_coordinates(grid_to_sample, opt['device'], 
+        opt['align_corners'])
+    gaussian_density = model.gaussian_density_at(
+        coords.view(-1, coords.shape[-1])).view(coords.shape[0], coords.shape[1])
+    gaussian_density /= gaussian_density.max()
+    density_img = gt_img.clone().to(gaussian_density.device)
+    density_img[:,:,0] += gaussian_density
+    density_img /= density_img.max()
+    
+    writer.add_image("Gaussian density", density_img.clamp(0,1),
+        iteration, dataformats = 'HWC')
 
 def log_grad_image(model, grid_to_sample, writer, iteration):
     grad_img = model.sample_grad_grid_for_image(grid_to_sample)
@@ -62,13 +143,37 @@ def log_grad_image(model, grid_to_sample, writer, iteration):
                 grad_img[output_index][...,input_index:input_index+1].clamp(0, 1), 
                 iteration, dataformats='HWC')
 
-def logging(writer, iteration, losses, opt, grid_to_sample, dataset):
+def logging(writer, iteration, losses, opt, model, images=None,
+    profiler=null_profiler):
+    # writer is an AsyncLogger, images the image state from train()
     if(iteration % 5 == 0):
-        log_to_writer(iteration, losses, writer, opt)
-        if(opt['log_image']):
-            log_image(model, grid_to_sample, writer, iteration, dataset)
+        log_to_writer(iteration, losses, writer, opt, profiler)
+        profiler.log(writer, iteration)
+    if(images is not None and iteration % opt['log_image_every'] == 0):
+        writer.render(lambda: model_snapshot(model), log_image, 
+            images['renderer'], images['grid'], images['gt'], 
+            images['range'], writer.writer, iteration)
                     
-def train(rank, model, dataset, opt):
+def create_optimizers(model, opt):
+    # Gaussian centers, covariances and the network (with the gaussian
+    # features) each have their own learning rate
+    if(opt['parameter_layout'] == "flat"):
+        # One optimizer stepping every parameter in one contiguous buffer,
+        # with the three learning rates as groups
+        return [FlatAdam([
+            {'params': [model.gaussian_centers], 'lr': 0.1},
+            {'params': model.covariance_parameters(), 'lr': 0.1},
+            {'params': model.network_parameters, 'lr': opt['lr']}],
+            betas=[opt['beta_1'], opt['beta_2']])]
+    optimizer_gmm_centers = optim.Adam([model.gaussian_centers], lr=0.1,
+        betas=[opt['beta_1'], opt['beta_2']]) 
+    optimizer_gmm_cov = optim.Adam(model.covariance_parameters(), lr=0.1,
+        betas=[opt['beta_1'], opt['beta_2']])
+    optimizer_network = optim.Adam(model.network_parameters, lr=opt["lr"],
+        betas=[opt['beta_1'], opt['beta_2']]) 
+    return [optimizer_gmm_centers, optimizer_gmm_cov, optimizer_network]
+
+def train(rank, model, dataset, opt, callback=None, checkpoint=None):
     print("Training on device " + str(rank))
     if(opt['train_distributed']):        
         print("Initializing process group.")
@@ -89,65 +194,221 @@ def train(rank, model, dataset, opt):
         os.path.join(save_folder, opt["save_name"]))
 
 
-    optimizer_gmm_centers = optim.Adam([model.gaussian_centers], lr=0.1,
-        betas=[opt['beta_1'], opt['beta_2']]) 
-    optimizer_gmm_cov = optim.Adam([model.gaussian_precision], lr=0.1,
-        betas=[opt['beta_1'], opt['beta_2']])
-    optimizer_network = optim.Adam(model.network_parameters, lr=opt["lr"],
-        betas=[opt['beta_1'], opt['beta_2']]) 
-
-    scheduler_gmm_centers = torch.optim.lr_scheduler.StepLR(optimizer_gmm_centers, 
-        step_size=opt['iterations']//3, gamma=0.1)
-    scheduler_gmm_cov = torch.optim.lr_scheduler.StepLR(optimizer_gmm_cov, 
-        step_size=opt['iterations']//3, gamma=0.1)
-    scheduler_network = torch.optim.lr_scheduler.StepLR(optimizer_network, 
-        step_size=opt['iterations']//3, gamma=0.1)
+    optimizers = create_optimizers(model, opt)
+    step_phases = ["step"] if opt['parameter_layout'] == "flat" else \
+        ["step_centers", "step_covariance", "step_network"]
+    schedulers = [torch.optim.lr_scheduler.StepLR(o, 
+        step_size=opt['iterations']//3, gamma=0.1) for o in optimizers]
 
     if((rank == 0 and opt['train_distributed']) or not opt['train_distributed']):
         if(os.path.exists(os.path.join(project_folder_path, "tensorboard", opt['save_name']))):
             shutil.rmtree(os.path.join(project_folder_path, "tensorboard", opt['save_name']))
-        writer = SummaryWriter(os.path.join('tensorboard',opt['save_name']))
-        gt_img = dataset.get_2D_slice()
-        #gt_img -= dataset.min()
-        #gt_img /= (dataset.max() - dataset.min())
-        writer.add_image("Ground Truth", gt_img, 0, dataformats="CHW")
+        writer = AsyncLogger(
+            SummaryWriter(os.path.join('tensorboard',opt['save_name'])))
+        # One streaming pass the first time a data file is trained on,
+        # persisted next to it, then logged images are normalized with
+        # the data's per channel range
+        writer.add_text("Data statistics", 
+            dataset.statistics().summary().replace("\n", "  \n"), 0)
+        channel_range = dataset.channel_range()
+        gt_img = normalize_channels(dataset.get_2D_slice().float(), 
+            channel_range, 0)
+        writer.add_image("Ground Truth", gt_img.clamp(0, 1), 0, dataformats="CHW")
+        images = None
+        if(opt['log_image']):
+            grid_to_sample = image_grid(opt, dataset)
+            images = {"renderer": {}, "grid": grid_to_sample,
+                "gt": image_ground_truth(dataset, grid_to_sample, channel_range),
+                "range": channel_range}
     
     model.train(True)
 
     loss_func = get_loss_func(opt)
+    density_controller = DensityController(opt)
+    profiler = Profiler(opt['device'], opt['profile'])
+    model_to_profile = model.module if opt['train_distributed'] else model
+    model_to_profile.profiler = profiler
 
-    for iteration in range(0, opt['iterations']):
+    sampler = dataset.sampler
+    start_iteration = 0
+    if(checkpoint is not None):
+        # Before the prefetcher starts drawing from the restored RNG
+        start_iteration = restore_training_state(checkpoint, optimizers,
+            schedulers, density_controller, sampler)
+        print(f"Resuming from iteration {start_iteration}")
+    checkpointer = None
+    if(opt['save_every'] > 0 and 
+       ((rank == 0 and opt['train_distributed']) or not opt['train_distributed'])):
+        checkpointer = CheckpointWriter(os.path.join(save_folder, opt['save_name']))
+    prefetcher = None
+    if(opt['prefetch_batches'] > 0):
+        prefetcher = BatchPrefetcher(dataset, opt['points_per_iteration'],
+            opt['device'], opt['prefetch_batches'], opt['pin_memory'],
+            snapshot=checkpointer is not None)
+    # Held while the training thread uses the dataset or its sampler, which
+    # the prefetcher draws from concurrently
+    dataset_lock = prefetcher.lock if prefetcher is not None else \
+        contextlib.nullcontext()
+
+    data_state = None
+    for iteration in range(start_iteration, opt['iterations']):
         opt['iteration_number'] = iteration
 
-        optimizer_gmm_centers.zero_grad()
-        optimizer_gmm_cov.zero_grad()
-        optimizer_network.zero_grad()
+        for optimizer in optimizers:
+            optimizer.zero_grad()
         
-        data = dataset.get_random_points(opt['points_per_iteration'])
-        for k in data.keys():
-            data[k] = data[k].to(opt['device'])
+        with profiler.phase("sampling"):
+            if(prefetcher is not None):
+                data = prefetcher.next()
+                # Sampler and RNG state a checkpoint after this iteration
+                # resumes drawing from
+                data_state = prefetcher.consumed_state
+            else:
+                data = dataset.get_random_points(opt['points_per_iteration'])
+            for k in data.keys():
+                data[k] = data[k].to(opt['device'])
         
         model_output = model(data['inputs'])
         losses = {}
-        loss = loss_func(model_output, data)
-        losses['fitting_loss'] = loss
+        with profiler.phase("loss"):
+            loss = loss_func(model_output, data)
+            losses['fitting_loss'] = loss
+            if('indices' in data and opt['sampler'] == "importance"):
+                residuals = (model_output.detach() - data['data']).abs().mean(dim=1)
+                if(prefetcher is not None):
+                    prefetcher.run(dataset.sampler.update, data['indices'], residuals)
+                else:
+                    dataset.sampler.update(data['indices'], residuals)
 
-        loss.backward()
+        with profiler.phase("backward"):
+            loss.backward()
+        if(not opt['train_distributed']):
+            with profiler.phase("density_control"):
+                density_controller.accumulate(model)
         
-        optimizer_gmm_centers.step()
-        optimizer_gmm_cov.step()
-        optimizer_network.step()
-        scheduler_gmm_centers.step()
-        scheduler_gmm_cov.step()
-        scheduler_network.step()
+        for optimizer, phase in zip(optimizers, step_phases):
+            with profiler.phase(phase):
+                optimizer.step()
+        for scheduler in schedulers:
+            scheduler.step()
+
+        if(not opt['train_distributed']):
+            with profiler.phase("density_control"):
+                if(density_controller.due(iteration)):
+                    with dataset_lock:
+                        density_controller.step(model, dataset, optimizers, 
+                            iteration)
         
         if((rank == 0 and opt['train_distributed']) or not opt['train_distributed']):
-            logging(writer, iteration, losses, opt, dataset.data.shape[2:], dataset)
+            with profiler.phase("logging"):
+                logging(writer, iteration, losses, opt, model_to_profile, 
+                    images, profiler)
+                if(prefetcher is not None and iteration % 5 == 0):
+                    writer.add_scalar('Data stall fraction', 
+                        prefetcher.stall_fraction(), iteration)
+
+        if(checkpointer is not None and (iteration+1) % opt['save_every'] == 0):
+            with profiler.phase("checkpoint"):
+                with dataset_lock:
+                    state = training_state(iteration, model_to_profile,
+                        optimizers, schedulers, density_controller, sampler,
+                        data_state)
+                checkpointer.save(state)
+
+        # Optional hook for benchmarks, returning True stops training
+        if(callback is not None):
+            with dataset_lock:
+                stop = callback(iteration, model, losses)
+            if(stop):
+                break
     
+    if(prefetcher is not None):
+        print(prefetcher.summary())
+        prefetcher.close()
+
     if((rank == 0 and opt['train_distributed']) or not opt['train_distributed']):
         writer.close()
 
-    save_model(model, opt)
+    if(checkpointer is not None):
+        if(opt['iterations'] > start_iteration and 
+           (iteration+1) % opt['save_every'] != 0):
+            checkpointer.save(training_state(iteration, model_to_profile,
+                optimizers, schedulers, density_controller, sampler, 
+                data_state))
+        checkpointer.close()
+    else:
+        save_model(model, opt)
+    model_to_profile.profiler = null_profiler
+    if(opt['profile'] and 
+       ((rank == 0 and opt['train_distributed']) or not opt['train_distributed'])):
+        print(profiler.summary())
+        profiler.save(os.path.join(save_folder, opt['save_name'], "profile.json"))
+
+def time_series_files(opt):
+    # Data files of the time series in timestep order, opt['time_series']
+    # is a glob pattern relative to the data folder
+    files = sorted(glob.glob(os.path.join(data_folder, opt['time_series'])))
+    return [os.path.relpath(f, data_folder) for f in files]
+
+def train_time_series(opt):
+    # Trains one model per timestep, streaming the timesteps in order.
+    # The next timestep is loaded in the background while the current one
+    # trains. With warm_start, each model starts from the previous
+    # timestep's gaussians, features and decoder and is only fine-tuned
+    # for warm_start_iterations.
+    files = time_series_files(opt)
+    if(len(files) == 0):
+        print(f"No data files match {opt['time_series']}")
+        return
+    save_name = opt['save_name']
+    iterations = opt['iterations']
+    loader = ThreadPoolExecutor(max_workers=1)
+    
+    def timestep_options(t):
+        opt_t = dict(opt)
+        opt_t['data'] = files[t]
+        opt_t['save_name'] = f"{save_name}_t{t:04d}"
+        return opt_t
+
+    next_dataset = loader.submit(create_dataset, timestep_options(0))
+    model = None
+    report = []
+    for t in range(len(files)):
+        opt_t = timestep_options(t)
+        dataset = next_dataset.result()
+        if(t+1 < len(files)):
+            next_dataset = loader.submit(create_dataset, timestep_options(t+1))
+
+        t0 = time.time()
+        if(model is None or not opt['warm_start']):
+            opt_t['iterations'] = iterations
+            model = create_model(opt_t)
+            if(opt_t['gaussian_initialization'] == "data"):
+                initialize_from_data(model, dataset, opt_t)
+        else:
+            # Density control may have changed the number of gaussians
+            opt_t['iterations'] = opt['warm_start_iterations']
+            opt_t['n_gaussians'] = model.gaussian_centers.shape[0]
+            model.opt = opt_t
+        train(opt_t['device'], model, dataset, opt_t)
+        seconds = time.time() - t0
+
+        metrics = reconstruction_metrics(model, dataset)
+        report.append({"timestep": t, "data": files[t], 
+            "iterations": opt_t['iterations'], "seconds": seconds, 
+            "psnr": metrics['psnr'], "ssim": metrics['ssim']})
+        print(f"Timestep {t+1}/{len(files)} ({files[t]}): " + \
+            f"{opt_t['iterations']} iterations, {seconds : 0.02f} seconds, " + \
+            f"{metrics['psnr'] : 0.02f} dB, SSIM {metrics['ssim'] : 0.04f}")
+        del dataset
+    loader.shutdown()
+
+    total = sum(r['seconds'] for r in report)
+    print(f"Trained {len(files)} timesteps in {total : 0.02f} seconds")
+    folder = os.path.join(save_folder, save_name)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "time_series.json"), 'w') as fp:
+        json.dump(report, fp, indent=4)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Trains an implicit model on data.')
@@ -160,9 +421,38 @@ if __name__ == '__main__':
         help='Number of gaussians in model')
     parser.add_argument('--n_features',default=None,type=int,
         help='Number of features in the feature grid')   
+    parser.add_argument('--covariance_parameterization',default=None,type=str,
+        help='How gaussian covariances are stored. Options: precision, cholesky (lower triangular factor of the precision)')
+    parser.add_argument('--gaussian_initialization',default=None,type=str,
+        help='How gaussians are initialized. Options: random, data (gradient weighted sampling and k-means on the data)')
+    parser.add_argument('--initialization_samples',default=None,type=int,
+        help='Number of points sampled from the data for data initialization')
+    parser.add_argument('--kmeans_iterations',default=None,type=int,
+        help='Number of k-means passes for data initialization')
+    parser.add_argument('--gaussian_tile_size',default=None,type=int,
+        help='If > 0, evaluates gaussians this many points at a time and recomputes them in backward to save memory. Does not support double backward.')
+    parser.add_argument('--gaussian_culling',default=None,type=str2bool,
+        help='Only evaluate gaussians within culling_sigma standard deviations of each point')
+    parser.add_argument('--culling_sigma',default=None,type=float,
+        help='Number of standard deviations a gaussian is evaluated out to when culling. ' + \
+            'A skipped gaussian has less than exp(-culling_sigma^2/2) of its peak density ' + \
+            'at the point, 1e-2 at 3, 3e-4 at 4 and 4e-6 at 5')
+    parser.add_argument('--culling_grid_resolution',default=None,type=int,
+        help='Cells per dimension in the uniform grid used for gaussian culling')
+
+    parser.add_argument('--density_control_every',default=None,type=int,
+        help='Prune and densify gaussians every this many iterations. 0 disables it. Not supported with train_distributed.')
+    parser.add_argument('--density_control_until',default=None,type=float,
+        help='Fraction of the iterations after which density control stops')
+    parser.add_argument('--prune_threshold',default=None,type=float,
+        help='Gaussians with contribution or feature gradient below this fraction of the mean are pruned')
+    parser.add_argument('--densify_fraction',default=None,type=float,
+        help='Fraction of the gaussians with the highest residual to split or clone at each density control step')
+    parser.add_argument('--max_gaussians',default=None,type=int,
+        help='Density control never grows the model beyond this many gaussians')
 
     parser.add_argument('--data',default=None,type=str,
-        help='Data file name')
+        help='Data file name, or procedural:<name> for an analytic field (ABC_flow, flow_past_cylinder, vortices)')
     parser.add_argument('--save_name',default=None,type=str,
         help='Save name for the model')
     parser.add_argument('--align_corners',default=None,type=str2bool,
@@ -173,9 +463,51 @@ if __name__ == '__main__':
         help='Nodes per layer in the model')    
     parser.add_argument('--interpolate',default=None,type=str2bool,
         help='Whether or not to use interpolation during training')    
+    parser.add_argument('--procedural_resolution',default=None,type=int,
+        help='Nominal grid resolution of procedural:<name> data, used for normalization and evaluation')
+    parser.add_argument('--time_series',default=None,type=str,
+        help='Glob pattern (relative to the data folder) of the timesteps to train in order, one model per timestep')
+    parser.add_argument('--warm_start',default=None,type=str2bool,
+        help='Start each timestep of a time series from the previous timestep\'s model')
+    parser.add_argument('--warm_start_iterations',default=None,type=int,
+        help='Fine-tuning iterations for each warm started timestep')
+    parser.add_argument('--volume_cache',default=None,type=str2bool,
+        help='Convert the data once to a raw memory-mapped cache next to the data file and load from it')
+    parser.add_argument('--shared_memory_data',default=None,type=str2bool,
+        help='Load the data through a node-wide shared memory segment shared by concurrent jobs')
+    parser.add_argument('--shared_memory_token',default=None,type=str,
+        help='Scopes shared memory segments to the jobs using the same token, set by start_jobs.py for each sweep')
+    parser.add_argument('--brick_size',default=None,type=int,
+        help='Edge length in voxels of the bricks volumes are read in')
+    parser.add_argument('--brick_cache_size',default=None,type=int,
+        help='Number of bricks kept in the LRU brick cache of a volume reader')
+    parser.add_argument('--out_of_core',default=None,type=str2bool,
+        help='Stream bricks of the data from disk instead of loading it all to data_device. Only with the uniform sampler')
+    parser.add_argument('--resident_bricks',default=None,type=int,
+        help='Bricks kept on data_device in out of core training')
+    parser.add_argument('--bricks_per_batch',default=None,type=int,
+        help='Bricks swapped into the working set in the background per batch in out of core training')
+    parser.add_argument('--sampler',default=None,type=str,
+        help='How voxels are drawn for each batch. uniform draws random voxels ' + \
+            'without replacement within a batch, uniform_replacement draws independent ' + \
+            'random voxels (cheaper, with duplicates), epoch visits every voxel once per epoch in random order, ' + \
+            'importance draws voxels in proportion to the current error')
+    parser.add_argument('--importance_brick_size',default=None,type=int,
+        help='Edge length in voxels of the bricks the importance sampler tracks error for')
+    parser.add_argument('--importance_uniform_fraction',default=None,type=float,
+        help='Fraction of the importance sampling distribution that stays uniform')
+    parser.add_argument('--importance_decay',default=None,type=float,
+        help='Rate of the moving average of each brick\'s error in the importance sampler')
+    parser.add_argument('--prefetch_batches',default=None,type=int,
+        help='Batches sampled ahead on a background thread. 0 samples each batch synchronously. ' + \
+            'Not reproducible with the importance sampler, whose updates are applied asynchronously')
+    parser.add_argument('--pin_memory',default=None,type=str2bool,
+        help='Stage prefetched CPU batches in pinned memory for asynchronous copies to the GPU')
+    parser.add_argument('--profile',default=None,type=str2bool,
+        help='Time the phases of every training step and track memory (process RSS, and on CUDA the peak tensor memory of every phase), logged to TensorBoard and saved to profile.json')
     parser.add_argument('--vorticity',default=None,type=str2bool,
-        help='Whether or not to use interpolation during training')    
-    
+        help='Train on the vorticity (curl) of the data, computed once and cached next to the data file')
+
     parser.add_argument('--train_distributed',default=None,type=str2bool,
         help='Train on multiple GPUs')
     parser.add_argument('--device',default=None, type=str,
@@ -199,15 +531,23 @@ if __name__ == '__main__':
         help='Beta1 for the adam optimizer')
     parser.add_argument('--beta_2',default=None, type=float,
         help='Beta2 for the adam optimizer')
+    parser.add_argument('--parameter_layout',default=None, type=str,
+        help='How parameters are laid out for the optimizer. Options: separate (one adam optimizer per parameter group), ' + \
+            'flat (one adam optimizer over a single contiguous buffer of all parameters, lower per step overhead)')
 
     parser.add_argument('--iteration_number',default=None, type=int,
         help="Not used.")
     parser.add_argument('--save_every',default=None, type=int,
-        help='How often to save the model')
+        help='Iterations between full checkpoints (model, optimizers, schedulers, RNG), 0 to only save at the end')
     parser.add_argument('--log_every',default=None, type=int,
         help='How often to log the loss')
     parser.add_argument('--load_from',default=None, type=str,
-        help='Model to load to start training from')
+        help='Model to load to start training from, resuming from its checkpoint if it has one. ' + \
+            'A different --iterations keeps the position but stretches the learning rate schedule to the new total')
+    parser.add_argument('--log_image_every',default=None, type=int,
+        help='Iterations between image renders, skipped while the previous render is still running')
+    parser.add_argument('--log_image_resolution',default=None, type=int,
+        help='Resolution of the rendered images, 0 for the data resolution')
     parser.add_argument('--log_image',default=None, type=str2bool,
         help='Whether or not to log an image. Slows down training.')
     parser.add_argument('--log_gradient',default=None, type=str2bool,
@@ -224,6 +564,14 @@ if __name__ == '__main__':
     os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
     torch.manual_seed(11235813)
 
+    if(args['time_series'] is not None and args['load_from'] is None):
+        opt = Options.get_default()
+        for k in args.keys():
+            if args[k] is not None:
+                opt[k] = args[k]
+        train_time_series(opt)
+        quit()
+
     if(args['load_from'] is None):
         # Init models
         model = None
@@ -234,17 +582,33 @@ if __name__ == '__main__':
             if args[k] is not None:
                 opt[k] = args[k]
 
-        dataset = Dataset(opt)
+        dataset = create_dataset(opt)
         model = create_model(opt)
+        if(opt['gaussian_initialization'] == "data"):
+            initialize_from_data(model, dataset, opt)
+        checkpoint = None
     else:        
-        opt = load_options(os.path.join(save_folder, args["load_from"]))
-        opt["device"] = args["device"]
+        # Resumes the optimizers, schedulers, RNG and iteration when the
+        # model was saved with periodic checkpoints. The checkpoint holds
+        # its own options and weights, which are used instead of
+        # options.json and model.ckpt.tar: those are rewritten after it,
+        # so an interrupted write can leave them older than the checkpoint.
+        checkpoint = load_checkpoint(os.path.join(save_folder, args["load_from"]))
+        if(checkpoint is not None):
+            opt = Options.get_default()
+            opt.update(checkpoint['opt'])
+        else:
+            opt = load_options(os.path.join(save_folder, args["load_from"]))
         opt["save_name"] = args["load_from"]
         for k in args.keys():
             if args[k] is not None:
                 opt[k] = args[k]
-        dataset = Dataset(opt)
-        model = load_model(opt, opt['device'])
+        dataset = create_dataset(opt)
+        if(checkpoint is not None):
+            model = create_model(opt)
+            model.load_state_dict(checkpoint['model'])
+        else:
+            model = load_model(opt, opt['device'])
 
     now = datetime.datetime.now()
     start_time = time.time()
@@ -254,12 +618,12 @@ if __name__ == '__main__':
         os.environ['MASTER_ADDR'] = '127.0.0.1'              
         os.environ['MASTER_PORT'] = '29500' 
         mp.spawn(train,
-            args=(model, dataset, opt),
+            args=(model, dataset, opt, None, checkpoint),
             nprocs=opt['gpus_per_node'],
             join=True)
     else:
         train(opt['device'], model, 
-                dataset,opt)
+                dataset,opt, checkpoint=checkpoint)
         
     opt['iteration_number'] = 0
     save_model(model, opt)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules under Code/ import each other as top level packages
+# (Models, Datasets, Other), as when running train.py from Code/
+code_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Code")
+sys.path.insert(0, os.path.abspath(code_folder))
@@ -0,0 +1,50 @@
+import os
+import pytest
+import torch
+from Models.options import Options
+from Models.models import create_model
+from Models.checkpoint import load_checkpoint
+from Datasets.datasets import create_dataset
+from Datasets.procedural import write_field
+from train import train
+
+@pytest.fixture(scope="module")
+def volume(tmp_path_factory):
+    location = str(tmp_path_factory.mktemp("data") / "abc16.nc")
+    write_field("ABC_flow", 16, location)
+    return location
+
+def training_run(volume, folder, checkpoint=None, stop=None, **options):
+    # Model after training into folder, optionally resumed from a
+    # checkpoint or stopped after iteration stop
+    opt = Options.get_default()
+    opt.update(data=volume, n_dims=3, n_outputs=3, n_gaussians=32,
+        device="cpu", data_device="cpu", points_per_iteration=1000,
+        iterations=30, save_every=10, log_every=1000, log_image=False,
+        save_name=str(folder))
+    opt.update(options)
+    torch.manual_seed(0)
+    dataset = create_dataset(opt)
+    model = create_model(opt)
+    if(checkpoint is not None):
+        model.load_state_dict(checkpoint['model'])
+    callback = (lambda iteration, model, losses: iteration == stop) \
+        if stop is not None else None
+    train("cpu", model, dataset, opt, callback, checkpoint)
+    return model
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"sampler": "epoch", "prefetch_batches": 2},
+    {"parameter_layout": "flat"},
+])
+def test_resume_matches_uninterrupted_training(volume, tmp_path, options):
+    full = training_run(volume, tmp_path / "full", **options)
+    training_run(volume, tmp_path / "interrupted", stop=14, **options)
+    # Stopping early saves a checkpoint at the last iteration
+    checkpoint = load_checkpoint(str(tmp_path / "interrupted"))
+    assert checkpoint['iteration'] == 14
+    resumed = training_run(volume, tmp_path / "interrupted",
+        checkpoint=checkpoint, **options)
+    for (name, p), q in zip(full.state_dict().items(), resumed.state_dict().values()):
+        assert torch.equal(p, q), name
@@ -0,0 +1,59 @@
+import torch
+from Models.options import Options
+from Models.models import create_model
+from Models.flat_optimizer import FlatAdam
+from train import create_optimizers
+
+def training_run(parameter_layout, iterations=10):
+    # Model parameters after training with the optimizers and StepLR
+    # schedules train.py creates for parameter_layout
+    opt = Options.get_default()
+    opt.update(n_dims=3, n_outputs=3, n_gaussians=64, n_features=4,
+        device="cpu", parameter_layout=parameter_layout)
+    torch.manual_seed(0)
+    model = create_model(opt)
+    optimizers = create_optimizers(model, opt)
+    schedulers = [torch.optim.lr_scheduler.StepLR(o, step_size=4, gamma=0.1)
+        for o in optimizers]
+    g = torch.Generator().manual_seed(1)
+    for _ in range(iterations):
+        x = torch.rand([256, 3], generator=g) * 2 - 1
+        y = torch.rand([256, 3], generator=g)
+        for o in optimizers:
+            o.zero_grad()
+        torch.nn.functional.mse_loss(model(x), y).backward()
+        for o in optimizers:
+            o.step()
+        for s in schedulers:
+            s.step()
+    return model, optimizers
+
+def test_flat_layout_matches_separate_adam():
+    flat, optimizers = training_run("flat")
+    assert isinstance(optimizers[0], FlatAdam)
+    separate, _ = training_run("separate")
+    for (name, p), q in zip(flat.named_parameters(), separate.parameters()):
+        torch.testing.assert_close(p, q, rtol=1e-4, atol=1e-6, msg=name)
+
+def test_parameters_without_gradient_are_skipped():
+    # As in torch.optim.Adam, a parameter autograd did not reach since the
+    # last zero_grad keeps its value, moments and step count
+    def parameters():
+        g = torch.Generator().manual_seed(0)
+        return [torch.nn.Parameter(torch.randn([n], generator=g)) for n in [5, 3, 7, 2]]
+    flat_params = parameters()
+    torch_params = parameters()
+    groups = lambda p: [{'params': p[:3], 'lr': 0.1}, {'params': p[3:], 'lr': 0.01}]
+    flat = FlatAdam(groups(flat_params))
+    reference = torch.optim.Adam(groups(torch_params))
+    for iteration in range(8):
+        for params, optimizer in [(flat_params, flat), (torch_params, reference)]:
+            optimizer.zero_grad()
+            # The second and last parameters only get gradients every other step
+            used = params if iteration % 2 == 0 else [params[0], params[2]]
+            sum((p**2).sum() for p in used).backward()
+            optimizer.step()
+        for p, q in zip(flat_params, torch_params):
+            torch.testing.assert_close(p, q)
+            torch.testing.assert_close(flat.state[p]['exp_avg'], reference.state[q]['exp_avg'])
+            assert flat.state[p]['step'] == reference.state[q]['step'].item()
@@ -0,0 +1,113 @@
+import pytest
+import torch
+from Models import gaussians
+
+def random_gaussians(n_gaussians, n_dims=3, n_features=4, seed=0):
+    # Gaussians as GMMINR initializes them, precision n_gaussians * I
+    # rotated by a householder matrix, so larger mixtures are narrower
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.rand([n_gaussians, n_dims], generator=g) * 2 - 1
+    v = torch.rand([n_gaussians, n_dims, 1], generator=g)
+    v /= torch.linalg.norm(v, dim=1, keepdim=True)
+    Q = torch.eye(n_dims) - 2 * torch.bmm(v, v.mT)
+    precision = n_gaussians * torch.bmm(Q, Q.mT)
+    features = torch.randn([n_gaussians, n_features], generator=g)
+    return centers, precision, features
+
+def direct_features(x, centers, precision, features):
+    # (x-mu)^T P (x-mu) on the [N, G, D] differences
+    diff = x.unsqueeze(1) - centers.unsqueeze(0)
+    q = torch.einsum('ngi,gij,ngj->ng', diff, precision, diff)
+    log_coeff = gaussians.gaussian_log_coefficients(precision)
+    return torch.matmul(torch.exp(log_coeff.unsqueeze(0) - 0.5 * q), features)
+
+def relative_error(a, ref):
+    return ((a.double() - ref).norm() / ref.norm()).item()
+
+def values_and_gradients(method, x, centers, precision, features):
+    params = [t.clone().requires_grad_(True) for t in
+        [x, centers, precision, features]]
+    out = method(*params)
+    out.backward(torch.ones_like(out))
+    return [out.detach()] + [t.grad for t in params]
+
+methods = {
+    "fused": gaussians.gaussian_features,
+    "tiled": lambda x, c, p, f: gaussians.tiled_gaussian_features(x, c, p, f, 64),
+}
+
+@pytest.mark.parametrize("method", methods.keys())
+@pytest.mark.parametrize("n_gaussians", [64, 10000])
+def test_matches_direct_form(method, n_gaussians):
+    centers, precision, features = random_gaussians(n_gaussians)
+    x = torch.rand([256, 3], generator=torch.Generator().manual_seed(1)) * 2 - 1
+    # Points next to some gaussians, where the weights are not all ~0
+    x[:64] = centers[:64] + 0.1 * n_gaussians**-0.5
+
+    reference = values_and_gradients(direct_features, 
+        *[t.double() for t in [x, centers, precision, features]])
+    result = values_and_gradients(methods[method], x, centers, precision, features)
+    names = ["output", "x grad", "centers grad", "precision grad", "features grad"]
+    for name, r, ref in zip(names, result, reference):
+        assert r.dtype == torch.float32
+        assert relative_error(r, ref) < 1e-4, name
+
+def test_density_matches_features_of_ones():
+    centers, precision, _ = random_gaussians(500)
+    x = centers[:100] + 0.01
+    ones = torch.ones([500, 1])
+    torch.testing.assert_close(
+        gaussians.gaussian_density(x, centers, precision),
+        gaussians.gaussian_features(x, centers, precision, ones))
+    torch.testing.assert_close(
+        gaussians.tiled_gaussian_density(x, centers, precision, 32),
+        gaussians.gaussian_features(x, centers, precision, ones))
+
+@pytest.mark.parametrize("cholesky", [False, True])
+def test_culling_error_within_bound(cholesky):
+    # Culling skips a gaussian only where its density is below
+    # culling_error_bound(n_sigma) of its peak
+    centers, precision, features = random_gaussians(200)
+    x = torch.rand([2000, 3], generator=torch.Generator().manual_seed(1)) * 2 - 1
+    direct = direct_features(*[t.double() for t in [x, centers, precision, features]])
+    peak_sum = (gaussians.gaussian_coefficients(precision.double()).unsqueeze(-1) * \
+        features.double().abs()).sum(dim=0)
+    errors = []
+    for n_sigma in [2.0, 3.0, 4.0, 5.0]:
+        grid = gaussians.GaussianGrid(resolution=16, n_sigma=n_sigma)
+        culled = gaussians.culled_gaussian_features(x.double(), centers.double(),
+            precision.double(), features.double(), grid,
+            cholesky=gaussians.precision_to_cholesky(precision.double()) if cholesky else None)
+        error = (culled - direct).abs()
+        assert (error <= gaussians.culling_error_bound(n_sigma) * peak_sum + 1e-9).all()
+        errors.append(error.max().item())
+    assert errors == sorted(errors, reverse=True)
+
+def gmminr(covariance_parameterization, seed=0):
+    from Models.options import Options
+    from Models.models import create_model
+    opt = Options.get_default()
+    opt.update(n_dims=3, n_outputs=3, n_gaussians=64, n_features=4,
+        device="cpu", covariance_parameterization=covariance_parameterization)
+    torch.manual_seed(seed)
+    return create_model(opt)
+
+def test_covariance_parameterizations_round_trip():
+    # A precision checkpoint loads into a cholesky model and back without
+    # changing the model's output
+    precision_model = gmminr("precision")
+    cholesky_model = gmminr("cholesky", seed=1)
+    x = torch.rand([500, 3], generator=torch.Generator().manual_seed(2)) * 2 - 1
+    with torch.no_grad():
+        expected = precision_model(x)
+        cholesky_model.load_state_dict(precision_model.state_dict())
+        L = cholesky_model.gaussian_precision_cholesky
+        assert torch.equal(L, L.tril())
+        assert (torch.diagonal(L, dim1=-2, dim2=-1) > 0).all()
+        torch.testing.assert_close(cholesky_model(x), expected, rtol=1e-4, atol=1e-5)
+
+        restored = gmminr("precision", seed=2)
+        restored.load_state_dict(cholesky_model.state_dict())
+        torch.testing.assert_close(restored.gaussian_precision,
+            precision_model.gaussian_precision, rtol=1e-4, atol=1e-3)
+        torch.testing.assert_close(restored(x), expected, rtol=1e-4, atol=1e-5)
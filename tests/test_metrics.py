@@ -0,0 +1,32 @@
+import pytest
+import torch
+from Other import metrics
+from Other.utility_functions import PSNR, ssim, ssim3D
+
+def noisy_pair(shape, seed=0):
+    # A smooth field and a noisy reconstruction of it
+    g = torch.Generator().manual_seed(seed)
+    x = torch.linspace(0, 6, shape[-1])
+    gt = torch.sin(x + torch.rand([1, 3] + [1]*(len(shape)-1) + [1], generator=g))
+    gt = gt.expand([1, 3] + shape).contiguous()
+    gt = gt + 0.1 * torch.rand([1, 3] + shape, generator=g)
+    rec = gt + 0.05 * torch.randn(gt.shape, generator=g)
+    return rec, gt
+
+def test_separable_ssim_matches_ssim():
+    rec, gt = noisy_pair([20, 24])
+    torch.testing.assert_close(metrics.ssim(rec, gt), ssim(rec, gt))
+
+def test_separable_ssim_matches_ssim3D():
+    rec, gt = noisy_pair([12, 16, 14])
+    torch.testing.assert_close(metrics.ssim(rec, gt), ssim3D(rec, gt))
+
+@pytest.mark.parametrize("slab_size", [3, 5, 100])
+def test_volume_metrics_match_whole_volume(slab_size):
+    # Slabs thinner than the SSIM window read their halo from the
+    # neighbouring slabs
+    rec, gt = noisy_pair([13, 16, 14])
+    m = metrics.volume_metrics(lambda s, e: rec[:, :, s:e],
+        lambda s, e: gt[:, :, s:e], rec.shape[2], slab_size=slab_size)
+    assert m['psnr'] == pytest.approx(PSNR(rec, gt, gt.max() - gt.min()).item(), rel=1e-4)
+    assert m['ssim'] == pytest.approx(ssim3D(rec, gt).item(), rel=1e-5)
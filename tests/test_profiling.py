@@ -0,0 +1,73 @@
+import torch
+from Other.profiling import Profiler
+
+class FakeAllocator():
+    # The caching allocator's allocated and peak counters
+    def __init__(self):
+        self.allocated = 0
+        self.peak = 0
+
+    def allocate(self, n):
+        self.allocated += n
+        self.peak = max(self.peak, self.allocated)
+
+    def max_memory_allocated(self, device=None):
+        return self.peak
+
+    def reset_peak_memory_stats(self, device=None):
+        self.peak = self.allocated
+
+class FakeEvent():
+    def __init__(self, enable_timing=False):
+        pass
+    def record(self):
+        pass
+    def synchronize(self):
+        pass
+    def query(self):
+        return True
+    def elapsed_time(self, end):
+        return 1.0
+
+def test_cuda_phase_tensor_peaks(monkeypatch):
+    allocator = FakeAllocator()
+    monkeypatch.setattr(torch.cuda, "max_memory_allocated", allocator.max_memory_allocated)
+    monkeypatch.setattr(torch.cuda, "reset_peak_memory_stats", allocator.reset_peak_memory_stats)
+    monkeypatch.setattr(torch.cuda, "Event", FakeEvent)
+    profiler = Profiler("cuda:0")
+    profiler.cuda = True
+
+    allocator.allocate(100)
+    with profiler.phase("forward"):
+        allocator.allocate(50)
+        with profiler.phase("gaussians"):
+            allocator.allocate(200)
+            allocator.allocate(-200)
+        allocator.allocate(20)
+    allocator.allocate(-170)
+    with profiler.phase("backward"):
+        allocator.allocate(30)
+    allocator.allocate(-30)
+
+    r = profiler.report()
+    GB = 1024**3
+    assert r['tensor_memory_tracked']
+    # Nested peaks count in the enclosing phase, and the run's peak is
+    # kept although phases reset the counter
+    assert r['phases']['gaussians']['tensor_peak_GB'] * GB == 350
+    assert r['phases']['forward']['tensor_peak_GB'] * GB == 350
+    assert r['phases']['backward']['tensor_peak_GB'] * GB == 30
+    assert r['memory']['tensor_peak_GB'] * GB == 350
+    assert profiler.tensor_peak_bytes("cuda:0") == 350
+    assert "peak GB" in profiler.summary()
+
+def test_cpu_reports_rss_only():
+    profiler = Profiler("cpu")
+    with profiler.phase("forward"):
+        torch.ones([1000]).sum()
+    r = profiler.report()
+    assert not r['tensor_memory_tracked']
+    assert "tensor_peak_GB" not in r['memory']
+    assert "tensor_peak_GB" not in r['phases']['forward']
+    assert r['memory']['peak_rss_GB'] > 0
+    assert "not tracked on CPU" in profiler.summary()
@@ -0,0 +1,40 @@
+import pytest
+import torch
+from Datasets.samplers import FeistelPermutation, UniformSampler, EpochSampler
+
+@pytest.mark.parametrize("n", [1, 2, 3, 17, 256, 1000, 4097])
+def test_feistel_permutation_is_a_permutation(n):
+    torch.manual_seed(0)
+    permutation = FeistelPermutation(n)
+    for _ in range(3):
+        p = permutation(torch.arange(n))
+        assert torch.equal(p.sort().values, torch.arange(n))
+        permutation.rekey()
+
+def test_feistel_permutation_depends_on_key():
+    torch.manual_seed(0)
+    permutation = FeistelPermutation(1000)
+    i = torch.arange(1000)
+    first = permutation(i)
+    torch.testing.assert_close(permutation(i), first)
+    torch.testing.assert_close(permutation(i[100:200]), first[100:200])
+    permutation.rekey()
+    assert not torch.equal(permutation(i), first)
+
+def test_uniform_sampler_draws_without_replacement():
+    torch.manual_seed(0)
+    sampler = UniformSampler(5000, "cpu")
+    indices, _ = sampler.sample(4000)
+    assert indices.shape[0] == 4000
+    assert indices.unique().shape[0] == 4000
+    assert indices.min() >= 0 and indices.max() < 5000
+
+def test_epoch_sampler_visits_every_voxel_once_per_epoch():
+    torch.manual_seed(0)
+    sampler = EpochSampler(1000, "cpu")
+    indices = torch.cat([sampler.sample(300)[0] for _ in range(10)])
+    for epoch in range(3):
+        torch.testing.assert_close(indices[epoch*1000:(epoch+1)*1000].sort().values,
+            torch.arange(1000))
+    # Epochs are shuffled differently
+    assert not torch.equal(indices[:1000], indices[1000:2000])
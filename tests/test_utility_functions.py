@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+from Other.utility_functions import CoordGrid, make_coord_grid, jacobian, \
+    curl, slab_derived_field
+
+@pytest.mark.parametrize("shape", [[7], [5, 9], [4, 6, 3]])
+@pytest.mark.parametrize("align_corners", [False, True])
+def test_coord_grid_matches_make_coord_grid(shape, align_corners):
+    grid = CoordGrid(shape, "cpu", align_corners=align_corners)
+    expected = make_coord_grid(shape, "cpu", align_corners=align_corners)
+    assert grid.shape == expected.shape
+    assert len(grid) == expected.shape[0]
+    torch.testing.assert_close(grid[:], expected)
+    torch.testing.assert_close(grid[3:len(grid):4], expected[3::4])
+    torch.testing.assert_close(grid[-1], expected[-1])
+    indices = torch.randperm(len(grid), generator=torch.Generator().manual_seed(0))
+    torch.testing.assert_close(grid[indices], expected[indices])
+    torch.testing.assert_close(grid.slab(1, 3),
+        expected.view(shape + [len(shape)])[1:3].reshape(-1, len(shape)))
+    torch.testing.assert_close(grid.materialize(flatten=False),
+        make_coord_grid(shape, "cpu", flatten=False, align_corners=align_corners))
+
+def numpy_jacobian(data):
+    # Central differences inside, one sided at the edges, which is what the
+    # previous per (channel, dimension) spatial_gradient computed with its
+    # linearly extrapolated padding. Dimension 0 is the last axis.
+    data = data.numpy()
+    n_dims = data.ndim - 2
+    jac = [[np.gradient(data[:, c], axis=n_dims-j) for j in range(n_dims)]
+        for c in range(data.shape[1])]
+    return torch.tensor(np.array(jac)).permute(2, 0, 1, *range(3, n_dims+3))
+
+@pytest.mark.parametrize("shape", [[9, 8], [6, 7, 8]])
+def test_jacobian_matches_central_differences(shape):
+    data = torch.randn([2, 3] + shape, generator=torch.Generator().manual_seed(0))
+    torch.testing.assert_close(jacobian(data, normalize=False),
+        numpy_jacobian(data))
+    torch.testing.assert_close(jacobian(data), numpy_jacobian(data) /
+        (data.norm(dim=1, keepdim=True).unsqueeze(2) + 1e-8))
+
+def test_curl_matches_central_differences():
+    data = torch.randn([1, 3, 6, 7, 8], generator=torch.Generator().manual_seed(0))
+    # x is the last axis
+    d = lambda c, axis: torch.tensor(np.gradient(data[:, c].numpy(), axis=axis))
+    u, v, w = 0, 1, 2
+    x, y, z = 3, 2, 1
+    expected = torch.stack([d(w, y) - d(v, z), d(u, z) - d(w, x),
+        d(v, x) - d(u, y)], dim=1)
+    torch.testing.assert_close(curl(data), expected)
+
+def test_slab_derived_field_matches_whole_volume():
+    data = torch.randn([1, 3, 11, 5, 6], generator=torch.Generator().manual_seed(0))
+    out = torch.empty_like(data)
+    for start, end, values in slab_derived_field(
+        lambda s, e: data[:, :, s:e], data.shape[2], curl, 4):
+        out[:, :, start:end] = values
+    torch.testing.assert_close(out, curl(data))